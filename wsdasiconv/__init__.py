@@ -24,7 +24,6 @@ http://www.gnu.org/licenses/agpl-3.0.html
 """
 
 from pyramid.config import Configurator
-from sqlalchemy import engine_from_config
 
 __version__ = "0.2"
 
@@ -34,15 +33,48 @@ def main(global_config, **settings):
     """ This function returns a Pyramid WSGI application.
     """
     from wsdasiconv.model import initialize_sql
-    engine = engine_from_config(settings, 'sqlalchemy.')
+    # pool de conexoes configurado pelas opcoes 'sqlalchemy.' e 'pool.'
+    from wsdasiconv.conexoes import cria_engine
+    engine = cria_engine(settings, 'primario')
     initialize_sql(engine)
+    # busca textual por indices de trigramas, se disponiveis
+    from wsdasiconv.busca import configura_busca
+    configura_busca(engine, settings.get('busca.trigramas', 'auto'))
+    # leituras da API nas replicas, se configuradas; o banco primario fica
+    # reservado para a carga e a manutencao
+    from wsdasiconv.replicas import configura_replicas
+    configura_replicas(engine, settings)
+    # limites de custo e de tempo das consultas
+    from wsdasiconv.custo import configura_custos
+    configura_custos(settings)
+    # marcador da carga noturna, lido do banco primario, que a carga
+    # atualiza ao terminar: renova as contagens e fronteiras em cache
+    from wsdasiconv.contagem import configura_carga
+    configura_carga(engine, int(settings.get('carga.intervalo_verificacao',
+        60)))
+    # contagens de registros em paralelo com a consulta das paginas
+    from wsdasiconv.contagem import configura_contagens
+    configura_contagens(int(settings.get('contagem.threads', 4)))
+    # serializacao rdf direta ou pelo rdflib
+    from wsdasiconv.triplas import configura_rdf
+    configura_rdf(settings)
+    # leitura das listagens em linhas ou pelo ORM
+    from wsdasiconv.linhas import configura_linhas
+    configura_linhas(settings)
     config = Configurator(settings=settings)
     config.add_static_view('static', 'wsdasiconv:static')
+    config.add_view('wsdasiconv.webservice.replicas_indisponiveis',
+        context='wsdasiconv.replicas.ReplicasIndisponiveis')
+    # deteccao de sessoes nao fechadas por requisicoes anteriores
+    config.add_subscriber('wsdasiconv.webservice.verifica_conexoes',
+        'pyramid.events.NewRequest')
     
     # consultas a recursos nao-informacionais (ver http-range-14)
     config.add_route('id', '/id/{classe}/{id}', view='wsdasiconv.webservice.redir_resource')
     # consulta a recursos informacionais
     config.add_route('dados/classe/id.formato', '/dados/{classe}/{id}.{formato}', view='wsdasiconv.webservice.detalhe_recurso')
+    # consulta a varios recursos informacionais pelos ids (parametro 'ids')
+    config.add_route('dados/classe.formato', '/dados/{classe}.{formato}', view='wsdasiconv.webservice.detalhe_recursos')
     
     # esta rota de negociacao de conteudo HTTP so deve ser usada se as acima falharem
     config.add_route('dados/classe/id', '/dados/{classe}/{id}', view='wsdasiconv.webservice.conneg_dados')
@@ -52,6 +84,11 @@ def main(global_config, **settings):
         '/v' + versao_api + '/consulta/{metodo}.{formato}',
         view='wsdasiconv.webservice.consulta')
     
+    # agregacoes (agrupar_por) sobre os registros dos metodos da API
+    config.add_route('agregacao/metodo.formato',
+        '/v' + versao_api + '/agregacao/{metodo}.{formato}',
+        view='wsdasiconv.webservice.agregacao')
+    
     # esta rota de negociacao de conteudo HTTP so deve ser usada se as acima falharem
     config.add_route('consulta/metodo',
         '/v' + versao_api + '/consulta/{metodo}',
@@ -73,6 +110,12 @@ def main(global_config, **settings):
         '/v' + versao_api + '/visao/{dbview}.csv',
         view='wsdasiconv.webservice.view_relatorio')
     
+    # estado dos pools de conexoes (diagnostico)
+    if settings.get('pool.exibe_estado', 'nao') == 'sim':
+        config.add_route('estado/conexoes.json',
+            '/v' + versao_api + '/estado/conexoes.json',
+            view='wsdasiconv.webservice.estado_conexoes')
+    
     return config.make_wsgi_app()
 
 
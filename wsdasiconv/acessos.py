@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo acessos.py da API de dados abertos do SICONV.
+=======================================================
+
+© 2011-2013 Ministério do Planejamento, Orçamento e Gestão
+
+Este arquivo e parte do webservice de dados abertos do SICONV,
+o Sistema de Cadastro de Convênios e Contratos de Repasse.
+
+A documentacao esta disponível em http://api.convenios.gov.br/siconv/doc/
+
+O webservice de dados abertos do SICONV é um software livre; você pode
+redistribui-lo e/ou modifica-lo dentro dos termos da Licença Pública Geral
+Affero GNU como publicada pela Fundação do Software Livre (FSF); na versão 3
+da Licença, ou (na sua opnião) qualquer versão subsequente.
+
+Este programa é distribuido na esperança que possa ser  util,
+mas SEM NENHUMA GARANTIA; sem uma garantia implicita de ADEQUAÇÂO a qualquer
+MERCADO ou APLICAÇÃO EM PARTICULAR. Veja a
+Licença Pública Geral Affero GNU para maiores detalhes.
+
+http://www.gnu.org/licenses/agpl-3.0.html
+"""
+
+from datetime import date, time, datetime
+from decimal import Decimal
+from inspect import isclass
+from types import GeneratorType, NoneType
+
+from rdflib.term import URIRef
+
+# especies de valores dos campos, com uma formatacao propria em cada
+# formato de saida (ver os agregadores em serializer.py)
+TEXTO = 'texto'
+NUMERO = 'numero'
+LOGICO = 'logico'
+NULO = 'nulo'
+DECIMAL = 'decimal'
+DATA = 'data'
+HORA = 'hora'
+URI = 'uri'
+OBJETO = 'objeto'
+DICIONARIO = 'dicionario'
+LISTA = 'lista'
+# subclasses dos tipos acima e demais valores: formatacao geral
+OUTRO = 'outro'
+
+# especies dos tipos de valores, completada a cada novo tipo encontrado
+especies = {
+    unicode: TEXTO,
+    str: TEXTO,
+    int: NUMERO,
+    long: NUMERO,
+    float: NUMERO,
+    bool: LOGICO,
+    NoneType: NULO,
+    Decimal: DECIMAL,
+    date: DATA,
+    datetime: DATA,
+    time: HORA,
+    URIRef: URI,
+    dict: DICIONARIO,
+    list: LISTA,
+    tuple: LISTA,
+    set: LISTA,
+    frozenset: LISTA,
+    GeneratorType: LISTA,
+}
+
+def especie(valor):
+    '''
+    Retorna a especie do valor, pelo seu tipo exato. Os objetos expostos
+    (ExposedObject) sao da especie OBJETO; os demais tipos, OUTRO.
+    '''
+    tipo = type(valor)
+    try:
+        return especies[tipo]
+    except KeyError:
+        from serializer import ExposedObject
+        especies[tipo] = OBJETO if issubclass(tipo, ExposedObject) else OUTRO
+        return especies[tipo]
+
+class Campo(object):
+    """Um atributo serializado: o nome do atributo e o nome usado na saida
+    (sem o prefixo 'href_').
+    """
+    __slots__ = ('atr', 'nome', 'nome_xml')
+
+    def __init__(self, atr):
+        self.atr = atr
+        self.nome = atr[5:] if atr.startswith('href_') else atr
+        # nome do elemento XML, em utf-8
+        self.nome_xml = (self.nome if isinstance(self.nome, unicode)
+            else self.nome.decode('utf-8')).encode('utf-8')
+
+class PlanoCampos(object):
+    """Os campos serializados de uma classe (ou de um conjunto de
+    atributos, como __expostos__ ou __resumidos__), compilados uma vez e
+    percorridos pelos agregadores em cada objeto.
+    """
+
+    def __init__(self, nomes):
+        self.nomes = nomes
+        self.sequencia = tuple(nomes)
+        self.campos = tuple(Campo(atr) for atr in self.sequencia)
+        # ultima selecao de campos e os campos selecionados
+        self.selecao = (None, None)
+
+    def seleciona(self, campos):
+        '''
+        Retorna os campos do plano que estao entre os campos solicitados,
+        ou todos se campos for None. A selecao de cada requisicao (a mesma
+        lista para todos os objetos) e' calculada uma vez.
+        '''
+        if campos is None:
+            return self.campos
+        selecao = self.selecao
+        if selecao[0] is campos:
+            return selecao[1]
+        selecionados = tuple(campo for campo in self.campos
+            if campo.atr in campos)
+        self.selecao = (campos, selecionados)
+        return selecionados
+
+# planos por (classe, atributo com os nomes dos campos)
+planos = {}
+
+def plano_campos(obj, atributo_serializar):
+    '''
+    Retorna o plano dos campos do objeto (ou classe) a serializar, listados
+    no atributo atributo_serializar. O plano e' refeito se a lista de
+    campos mudar, como nos objetos com a lista propria (ResultadoAgregado).
+    '''
+    classe = obj if isclass(obj) else obj.__class__
+    nomes = getattr(obj, atributo_serializar)
+    plano = planos.get((classe, atributo_serializar))
+    if plano is None or (plano.nomes is not nomes and
+            plano.sequencia != tuple(nomes)):
+        plano = planos[classe, atributo_serializar] = PlanoCampos(nomes)
+    return plano
+
+def compila_planos(classes, atributos=('__expostos__', '__resumidos__')):
+    '''
+    Compila na inicializacao os planos dos campos das classes do modelo.
+    '''
+    for cls in classes:
+        for atributo in atributos:
+            if getattr(cls, atributo, None) is not None:
+                plano_campos(cls, atributo)
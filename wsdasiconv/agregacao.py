@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo agregacao.py da API de dados abertos do SICONV.
+=======================================================
+
+© 2011-2013 Ministério do Planejamento, Orçamento e Gestão
+
+Este arquivo e parte do webservice de dados abertos do SICONV,
+o Sistema de Cadastro de Convênios e Contratos de Repasse.
+
+A documentacao esta disponível em http://api.convenios.gov.br/siconv/doc/
+
+O webservice de dados abertos do SICONV é um software livre; você pode
+redistribui-lo e/ou modifica-lo dentro dos termos da Licença Pública Geral
+Affero GNU como publicada pela Fundação do Software Livre (FSF); na versão 3
+da Licença, ou (na sua opnião) qualquer versão subsequente.
+
+Este programa é distribuido na esperança que possa ser  util,
+mas SEM NENHUMA GARANTIA; sem uma garantia implicita de ADEQUAÇÂO a qualquer
+MERCADO ou APLICAÇÃO EM PARTICULAR. Veja a
+Licença Pública Geral Affero GNU para maiores detalhes.
+
+http://www.gnu.org/licenses/agpl-3.0.html
+"""
+
+from sqlalchemy import extract
+from sqlalchemy import func as sqlfunc
+from sqlalchemy import Numeric
+from sqlalchemy.orm import Query, aliased, class_mapper
+from sqlalchemy.orm.interfaces import MANYTOONE
+from sqlalchemy.orm.properties import ColumnProperty, RelationshipProperty
+
+from rdflib.term import URIRef, Literal, BNode
+from rdflib.namespace import RDF
+
+from namespace import QB
+from serializer import ExposedObject
+from planos import PlanoFiltros
+
+# partes de uma coluna de data aceitas no fim do caminho de uma dimensao
+# (ex.: 'data_assinatura.ano')
+partes_data = {
+    'ano': 'year',
+    'mes': 'month',
+}
+
+# funcoes de agregacao das medidas sobre as colunas numericas
+# (ex.: 'soma_valor_global'), alem da contagem de registros
+funcoes_medidas = {
+    'soma': sqlfunc.sum,
+    'media': sqlfunc.avg,
+}
+CONTAGEM = 'contagem'
+
+def dimensao(cls, caminho):
+    '''
+    Resolve o caminho de uma dimensao de agrupamento declarada na classe
+    (__agrupamentos__), como 'proponente.municipio._uf' ou
+    'data_assinatura.ano'.
+
+    Retorna uma tupla (relacionamentos, coluna, parte): os nomes dos
+    relacionamentos percorridos, o nome da coluna na classe de destino e
+    a parte da data (ou None). So sao aceitos relacionamentos
+    muitos-para-um, que nao multiplicam os registros agregados.
+    '''
+    passos = caminho.split(".")
+    mapper = class_mapper(cls)
+    relacionamentos = []
+    while passos:
+        prop = mapper.get_property(passos.pop(0))
+        if isinstance(prop, RelationshipProperty):
+            if prop.direction is not MANYTOONE:
+                raise ValueError(u"A dimensão '%s' percorre um relacionamento que não é muitos-para-um: %s." % \
+                    (caminho, prop.key))
+            relacionamentos.append(prop.key)
+            mapper = prop.mapper
+            continue
+        parte = None
+        if passos:
+            parte = passos.pop(0)
+            if parte not in partes_data or passos:
+                raise ValueError(u"A dimensão '%s' tem uma parte de data desconhecida: %s." % \
+                    (caminho, parte))
+        return tuple(relacionamentos), prop.key, parte
+    raise ValueError(u"A dimensão '%s' não termina em uma coluna." % caminho)
+
+def medidas_disponiveis(cls):
+    '''
+    Retorna os nomes das medidas aceitas para a classe: a contagem de
+    registros e a soma e a media de cada coluna numerica exposta.
+    '''
+    expostos = getattr(cls, '__expostos__', [])
+    medidas = [CONTAGEM]
+    for prop in class_mapper(cls).iterate_properties:
+        if isinstance(prop, ColumnProperty) and prop.key in expostos and \
+                isinstance(prop.columns[0].type, Numeric):
+            medidas.extend("%s_%s" % (funcao, prop.key)
+                for funcao in sorted(funcoes_medidas))
+    return medidas
+
+def expressao_medida(cls, nome):
+    '''
+    Retorna a expressao SQL da medida (ver medidas_disponiveis).
+    '''
+    if nome == CONTAGEM:
+        return sqlfunc.count()
+    funcao, coluna = nome.split("_", 1)
+    tipo = class_mapper(cls).get_property(coluna).columns[0].type
+    return funcoes_medidas[funcao](getattr(cls, coluna), type_=tipo)
+
+class PlanoAgregacao(PlanoFiltros):
+    """Plano reutilizavel de uma agregacao sobre um metodo da API.
+
+    Aplica os mesmos filtros da consulta do metodo e agrupa os registros
+    pelas dimensoes solicitadas, calculando as medidas no banco de dados.
+    Os relacionamentos das dimensoes sao percorridos com LEFT OUTER JOIN
+    (apenas muitos-para-um), de modo que cada registro conta uma so vez e
+    os registros sem o relacionamento formam o grupo nulo.
+    """
+
+    def __init__(self, metodo, params, expressao, agrupar_por, medidas):
+        super(PlanoAgregacao, self).__init__(metodo, params, expressao)
+        cls = metodo.model_class
+        self.nomes = list(agrupar_por) + list(medidas)
+
+        # dimensoes: um alias por caminho de relacionamentos, reaproveitado
+        # pelas dimensoes que compartilham o caminho
+        aliases = {(): cls}
+        juncoes = []
+        dimensoes = []
+        for nome in agrupar_por:
+            relacionamentos, coluna, parte = dimensao(cls,
+                cls.__agrupamentos__[nome])
+            for n in range(len(relacionamentos)):
+                caminho = relacionamentos[:n + 1]
+                if caminho not in aliases:
+                    origem = aliases[caminho[:-1]]
+                    relacionamento = getattr(origem, caminho[-1])
+                    aliases[caminho] = aliased(
+                        relacionamento.property.mapper.class_)
+                    juncoes.append((aliases[caminho], relacionamento))
+            expressao = getattr(aliases[relacionamentos], coluna)
+            if parte is not None:
+                expressao = extract(partes_data[parte], expressao)
+            dimensoes.append(expressao)
+
+        colunas = [expressao.label(nome)
+            for expressao, nome in zip(dimensoes, agrupar_por)]
+        colunas.extend(expressao_medida(cls, nome).label(nome)
+            for nome in medidas)
+        q = Query(colunas).select_from(cls)
+        for juncao in juncoes:
+            q = q.outerjoin(juncao)
+        for criterio in self.criterios:
+            q = q.filter(criterio)
+        self.agrupada = q.group_by(*dimensoes).order_by(*dimensoes)
+
+    def consulta(self, session, valores):
+        '''
+        Retorna a consulta agregada associada a sessao, com os valores dos
+        filtros ligados.
+        '''
+        return self.agrupada.with_session(session).params(**valores)
+
+class ResultadoAgregado(ExposedObject):
+    """Um grupo do resultado de uma agregacao: os valores das dimensoes e
+    das medidas, serializados como atributos.
+    """
+    __element_name__ = "grupo"
+    # os grupos nao tem identificador nem uri proprios: sem colunas de
+    # identificacao no CSV
+    __colunas_identificacao__ = ()
+    # rotulos das colunas na tabela HTML (agregacao.pt) que diferem dos
+    # rotulos gerais (serializer.labels)
+    __rotulos__ = {
+        "uf": u"UF",
+    }
+
+    def __init__(self, nomes, valores, conjunto_uri, metodo_uri):
+        self.__expostos__ = self.__resumidos__ = list(nomes)
+        for nome, valor in zip(nomes, valores):
+            setattr(self, nome, valor)
+        # uri do documento da agregacao (com os parametros) e do metodo,
+        # base das propriedades rdf das dimensoes e medidas
+        self.conjunto_uri = conjunto_uri
+        self.metodo_uri = metodo_uri
+
+    def __repr__(self):
+        return '<grupo: ' + repr(dict((nome, getattr(self, nome))
+            for nome in self.__expostos__)) + '>'
+
+    def repr_rdf(self):
+        """Representa o grupo como uma observacao do vocabulario Data Cube.
+        """
+        grupo = BNode()
+        triplas = [
+            (grupo, RDF['type'], QB['Observation']),
+            (grupo, QB['dataSet'], URIRef(self.conjunto_uri + "#dataset")),
+        ]
+        for nome in self.__expostos__:
+            valor = getattr(self, nome)
+            if valor is not None:
+                triplas.append((grupo, URIRef(self.metodo_uri + "#" + nome),
+                    Literal(valor)))
+        return triplas
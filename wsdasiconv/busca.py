@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo busca.py da API de dados abertos do SICONV.
+=======================================================
+
+© 2011-2013 Ministério do Planejamento, Orçamento e Gestão
+
+Este arquivo e parte do webservice de dados abertos do SICONV,
+o Sistema de Cadastro de Convênios e Contratos de Repasse.
+
+A documentacao esta disponível em http://api.convenios.gov.br/siconv/doc/
+
+O webservice de dados abertos do SICONV é um software livre; você pode
+redistribui-lo e/ou modifica-lo dentro dos termos da Licença Pública Geral
+Affero GNU como publicada pela Fundação do Software Livre (FSF); na versão 3
+da Licença, ou (na sua opnião) qualquer versão subsequente.
+
+Este programa é distribuido na esperança que possa ser  util,
+mas SEM NENHUMA GARANTIA; sem uma garantia implicita de ADEQUAÇÂO a qualquer
+MERCADO ou APLICAÇÃO EM PARTICULAR. Veja a
+Licença Pública Geral Affero GNU para maiores detalhes.
+
+http://www.gnu.org/licenses/agpl-3.0.html
+"""
+
+
+from sqlalchemy import func as sqlfunc
+from sqlalchemy.orm.properties import RelationshipProperty
+
+# funcao imutavel que remove acentos, usada nos indices de trigramas
+# (a funcao unaccent do PostgreSQL nao e' imutavel e nao pode ser indexada)
+FUNCAO_NORMALIZA = "f_unaccent"
+
+# modos de configuracao da busca (parametro 'busca.trigramas' do .ini)
+MODOS_BUSCA = ('auto', 'sim', 'nao')
+
+# indica se a busca usa os indices de trigramas. Definido na inicializacao
+# da aplicacao por configura_busca.
+busca_indexada = False
+
+def suporta_trigramas(engine):
+    '''
+    Verifica se o banco de dados possui a extensao pg_trgm e a funcao de
+    normalizacao de acentos criadas por ddl_busca.
+    '''
+    if engine.dialect.name != 'postgresql':
+        return False
+    conn = engine.connect()
+    try:
+        extensao = conn.execute(
+            "SELECT count(*) FROM pg_extension WHERE extname = 'pg_trgm'"
+        ).scalar()
+        funcao = conn.execute(
+            "SELECT count(*) FROM pg_proc WHERE proname = %(nome)s",
+            nome=FUNCAO_NORMALIZA).scalar()
+    finally:
+        conn.close()
+    return bool(extensao and funcao)
+
+def configura_busca(engine, modo='auto'):
+    '''
+    Define se as buscas textuais usarao os indices de trigramas.
+
+    modo: 'auto' verifica o suporte no banco de dados, 'sim' e 'nao'
+    forcam o uso ou nao dos indices.
+    '''
+    global busca_indexada
+    if modo not in MODOS_BUSCA:
+        raise ValueError(u"Modo de busca desconhecido: '%s'." % modo)
+    if modo == 'auto':
+        busca_indexada = suporta_trigramas(engine)
+    else:
+        busca_indexada = (modo == 'sim')
+    return busca_indexada
+
+def compara_texto(atributo, valor):
+    '''
+    Comparacao de parametros do tipo 'ilike': busca de trecho de texto,
+    sem distincao de maiusculas e, se houver indices de trigramas, tambem
+    sem distincao de acentos.
+    '''
+    if busca_indexada:
+        return sqlfunc.f_unaccent(atributo).ilike(sqlfunc.f_unaccent(valor))
+    return atributo.ilike(valor)
+
+def colunas_busca(metodos):
+    '''
+    Retorna as colunas (tabela, coluna) consultadas pelos parametros de
+    comparacao 'ilike' dos metodos informados, sem repeticoes.
+    '''
+    colunas = []
+    for metodo in metodos:
+        for param, declaracao in sorted(metodo.parameters.items()):
+            if declaracao.get("comparison", None) != "ilike":
+                continue
+            cls = metodo.model_class
+            steps = declaracao.get("query_attribute", param).split(".")
+            for step in steps[:-1]:
+                prop = getattr(cls, step).property
+                if not isinstance(prop, RelationshipProperty):
+                    break
+                cls = prop.mapper.class_
+            coluna = getattr(cls, steps[-1]).property.columns[0]
+            if (coluna.table.name, coluna.name) not in colunas:
+                colunas.append((coluna.table.name, coluna.name))
+    return colunas
+
+def ddl_busca(metodos):
+    '''
+    Gera os comandos SQL (PostgreSQL) que criam as extensoes, a funcao de
+    normalizacao e os indices de trigramas dos parametros de busca textual.
+    '''
+    comandos = [
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+        "CREATE EXTENSION IF NOT EXISTS unaccent",
+        "CREATE OR REPLACE FUNCTION %s(text) RETURNS text AS "
+        "$$ SELECT unaccent('unaccent', $1) $$ "
+        "LANGUAGE sql IMMUTABLE STRICT" % FUNCAO_NORMALIZA,
+    ]
+    for tabela, coluna in colunas_busca(metodos):
+        indice = "ix_trgm_%s_%s" % (tabela, coluna)
+        comandos.append("DROP INDEX IF EXISTS %s" % indice)
+        comandos.append(
+            "CREATE INDEX %s ON %s USING gin (%s(%s) gin_trgm_ops)" % \
+                (indice, tabela, FUNCAO_NORMALIZA, coluna))
+    return comandos
+
+def cria_indices_busca(engine, metodos):
+    '''
+    Executa no banco de dados os comandos gerados por ddl_busca.
+    Deve ser executada apos a criacao do esquema e a cada nova carga
+    completa das tabelas.
+    '''
+    conn = engine.connect()
+    try:
+        for comando in ddl_busca(metodos):
+            conn.execute(comando)
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    # imprime o DDL dos indices de busca, ou o executa no banco informado:
+    # python -m wsdasiconv.busca [url do banco]
+    from sys import argv
+    from wsdasiconv.webservice import consultas
+    if len(argv) > 1:
+        from sqlalchemy import create_engine
+        cria_indices_busca(create_engine(argv[1]), consultas)
+    else:
+        for comando in ddl_busca(consultas):
+            print comando + ";"
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo carregamento.py da API de dados abertos do SICONV.
+=======================================================
+
+© 2011-2013 Ministério do Planejamento, Orçamento e Gestão
+
+Este arquivo e parte do webservice de dados abertos do SICONV,
+o Sistema de Cadastro de Convênios e Contratos de Repasse.
+
+A documentacao esta disponível em http://api.convenios.gov.br/siconv/doc/
+
+O webservice de dados abertos do SICONV é um software livre; você pode
+redistribui-lo e/ou modifica-lo dentro dos termos da Licença Pública Geral
+Affero GNU como publicada pela Fundação do Software Livre (FSF); na versão 3
+da Licença, ou (na sua opnião) qualquer versão subsequente.
+
+Este programa é distribuido na esperança que possa ser  util,
+mas SEM NENHUMA GARANTIA; sem uma garantia implicita de ADEQUAÇÂO a qualquer
+MERCADO ou APLICAÇÃO EM PARTICULAR. Veja a
+Licença Pública Geral Affero GNU para maiores detalhes.
+
+http://www.gnu.org/licenses/agpl-3.0.html
+"""
+
+
+from sqlalchemy.orm import class_mapper, defer, undefer
+from sqlalchemy.orm import joinedload, subqueryload
+from sqlalchemy.orm.properties import ColumnProperty, RelationshipProperty
+
+# colunas usadas como rotulo dos objetos pelos serializadores (HTML e RDF),
+# carregadas mesmo que nao sejam solicitadas
+rotulos = ('nome', 'descricao')
+
+def atributos_mapeados(cls):
+    '''
+    Retorna os nomes dos atributos mapeados (colunas e relacionamentos)
+    da classe.
+    '''
+    return set(prop.key for prop in class_mapper(cls).iterate_properties)
+
+def dependencias(cls, atributo):
+    '''
+    Retorna os atributos mapeados necessarios para obter o atributo
+    informado, ou None se nao for possivel determina-los.
+
+    Os atributos derivados (propriedades) declaram suas dependencias no
+    dicionario __dependencias__ da classe. Uma dependencia pode ser um
+    caminho de relacionamentos, como '_programas.programa'. As propriedades
+    'href_' montam URLs a partir da chave primaria, que e' sempre carregada.
+    '''
+    if atributo.split('.')[0] in atributos_mapeados(cls):
+        return set([atributo])
+    declaradas = getattr(cls, '__dependencias__', {})
+    if atributo in declaradas:
+        necessarios = set()
+        for dependencia in declaradas[atributo]:
+            recursivas = dependencias(cls, dependencia)
+            if recursivas is None:
+                return None
+            necessarios.update(recursivas)
+        return necessarios
+    if atributo.startswith('href_'):
+        return set()
+    return None
+
+def atributos_necessarios(cls, campos):
+    '''
+    Retorna os atributos mapeados necessarios para serializar os campos
+    informados, ou None se todos devem ser carregados.
+    '''
+    if campos is None:
+        return None
+    mapeados = atributos_mapeados(cls)
+    necessarios = set(rotulo for rotulo in rotulos if rotulo in mapeados)
+    for campo in campos:
+        dependentes = dependencias(cls, campo)
+        if dependentes is None:
+            return None
+        necessarios.update(dependente.split('.')[0]
+            for dependente in dependentes)
+    return necessarios
+
+def opcoes_adiamento(cls, necessarios):
+    '''
+    Retorna as opcoes de consulta que adiam (defer) o carregamento das
+    colunas que nao estao entre os atributos necessarios, e que antecipam
+    (undefer) as colunas necessarias adiadas por padrao no modelo.
+
+    As colunas da chave primaria e as chaves estrangeiras nunca sao
+    adiadas: sao usadas na URI dos objetos e no carregamento dos
+    relacionamentos.
+    '''
+    if necessarios is None:
+        return []
+    opcoes = []
+    for prop in class_mapper(cls).iterate_properties:
+        if not isinstance(prop, ColumnProperty):
+            continue
+        if prop.key in necessarios:
+            if prop.deferred:
+                opcoes.append(undefer(prop.key))
+            continue
+        if prop.deferred or coluna_chave(prop):
+            continue
+        opcoes.append(defer(prop.key))
+    return opcoes
+
+def coluna_chave(prop):
+    '''
+    Indica se a coluna mapeada faz parte da chave primaria ou de uma chave
+    estrangeira.
+    '''
+    colunas = [col for col in prop.columns if getattr(col, 'table', None) is not None]
+    return any(col.primary_key or col.foreign_keys for col in colunas)
+
+def colunas_carregadas(cls, necessarios=None):
+    '''
+    Retorna os nomes das colunas mapeadas da classe lidas pela consulta com
+    as opcoes de opcoes_adiamento(cls, necessarios): as necessarias e as
+    chaves, ou todas as que nao sao adiadas por padrao, se necessarios for
+    None.
+    '''
+    colunas = []
+    for prop in class_mapper(cls).iterate_properties:
+        if not isinstance(prop, ColumnProperty):
+            continue
+        if necessarios is None:
+            if not prop.deferred:
+                colunas.append(prop.key)
+        elif prop.key in necessarios or (not prop.deferred and
+                coluna_chave(prop)):
+            colunas.append(prop.key)
+    return colunas
+
+def caminhos_relacionamentos(cls, campos):
+    '''
+    Retorna os caminhos de relacionamentos (tuplas de nomes) percorridos
+    para serializar os campos informados, a partir dos atributos mapeados e
+    das dependencias declaradas. Campos sem dependencias conhecidas sao
+    ignorados.
+    '''
+    caminhos = set()
+    for campo in campos:
+        for dependencia in dependencias(cls, campo) or ():
+            mapper = class_mapper(cls)
+            caminho = ()
+            for passo in dependencia.split('.'):
+                prop = mapper.get_property(passo)
+                if not isinstance(prop, RelationshipProperty):
+                    break
+                caminho += (passo,)
+                caminhos.add(caminho)
+                mapper = prop.mapper
+    return caminhos
+
+def plano_carregamento(cls, campos, juntados=(), subconsultas=()):
+    '''
+    Escolhe a estrategia de carregamento antecipado (eager) de cada
+    relacionamento usado pelos campos. Retorna uma lista ordenada de tuplas
+    (caminho, estrategia), com a estrategia 'joined' ou 'subquery':
+
+    * muitos-para-um: 'joined' (LEFT OUTER JOIN na propria consulta, que nao
+      multiplica as linhas);
+    * colecoes: 'subquery' (uma consulta adicional por relacionamento,
+      qualquer que seja o tamanho da pagina).
+
+    juntados e subconsultas sao os relacionamentos declarados no metodo
+    (preloaded_atrs e subquery_atrs), cuja estrategia prevalece. Eles tambem
+    sao carregados se os campos nao tiverem dependencias conhecidas.
+    '''
+    caminhos = caminhos_relacionamentos(cls, campos)
+    if atributos_necessarios(cls, campos) is None:
+        caminhos.update(tuple(atr.split('.')) for atr in juntados)
+        caminhos.update(tuple(atr.split('.')) for atr in subconsultas)
+    plano = []
+    for caminho in sorted(caminhos, key=lambda caminho: (len(caminho), caminho)):
+        nome = '.'.join(caminho)
+        if nome in subconsultas:
+            estrategia = 'subquery'
+        elif nome in juntados:
+            estrategia = 'joined'
+        else:
+            mapper = class_mapper(cls)
+            for passo in caminho:
+                prop = mapper.get_property(passo)
+                mapper = prop.mapper
+            estrategia = 'subquery' if prop.uselist else 'joined'
+        plano.append((nome, estrategia))
+    return plano
+
+def carrega_colecoes(cls, plano):
+    '''
+    Indica se o plano de carregamento (ver plano_carregamento) carrega
+    alguma colecao, por subconsulta ou por juncao (caminhos com algum
+    relacionamento para muitos, que multiplicam as linhas da consulta).
+    '''
+    for caminho, estrategia in plano:
+        if estrategia == 'subquery':
+            return True
+        mapper = class_mapper(cls)
+        for passo in caminho.split('.'):
+            prop = mapper.get_property(passo)
+            if prop.uselist:
+                return True
+            mapper = prop.mapper
+    return False
+
+estrategias_carregamento = {
+    'joined': joinedload,
+    'subquery': subqueryload,
+}
+
+def opcoes_carregamento(plano):
+    '''
+    Retorna as opcoes de consulta de um plano de carregamento (ver
+    plano_carregamento).
+    '''
+    return [estrategias_carregamento[estrategia](caminho)
+        for caminho, estrategia in plano]
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo conexoes.py da API de dados abertos do SICONV.
+=======================================================
+
+© 2011-2013 Ministério do Planejamento, Orçamento e Gestão
+
+Este arquivo e parte do webservice de dados abertos do SICONV,
+o Sistema de Cadastro de Convênios e Contratos de Repasse.
+
+A documentacao esta disponível em http://api.convenios.gov.br/siconv/doc/
+
+O webservice de dados abertos do SICONV é um software livre; você pode
+redistribui-lo e/ou modifica-lo dentro dos termos da Licença Pública Geral
+Affero GNU como publicada pela Fundação do Software Livre (FSF); na versão 3
+da Licença, ou (na sua opnião) qualquer versão subsequente.
+
+Este programa é distribuido na esperança que possa ser  util,
+mas SEM NENHUMA GARANTIA; sem uma garantia implicita de ADEQUAÇÂO a qualquer
+MERCADO ou APLICAÇÃO EM PARTICULAR. Veja a
+Licença Pública Geral Affero GNU para maiores detalhes.
+
+http://www.gnu.org/licenses/agpl-3.0.html
+"""
+
+import logging
+from bisect import bisect_left
+from threading import Lock, local
+from time import time
+
+from sqlalchemy import engine_from_config, event, exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool, NullPool
+
+from configuracao import sim
+
+log = logging.getLogger(__name__)
+
+# opcoes do pool que nao se aplicam sem o pool da aplicacao (modo pgbouncer)
+OPCOES_POOL = ('pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle')
+
+# limites (em segundos) das faixas do histograma de espera por conexoes
+FAIXAS_ESPERA = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30)
+
+class Histograma(object):
+    """Contagem de medidas por faixas de valores (limites superiores),
+    alem do total, da soma e do maximo das medidas.
+    """
+    def __init__(self, faixas=FAIXAS_ESPERA):
+        self.faixas = tuple(faixas)
+        self.contagens = [0] * (len(self.faixas) + 1)
+        self.total = 0
+        self.soma = 0.0
+        self.maximo = 0.0
+        self.trava = Lock()
+
+    def registra(self, valor):
+        with self.trava:
+            self.contagens[bisect_left(self.faixas, valor)] += 1
+            self.total += 1
+            self.soma += valor
+            self.maximo = max(self.maximo, valor)
+
+    def como_dict(self):
+        with self.trava:
+            faixas = [("ate_%gs" % faixa, contagem) for faixa, contagem
+                in zip(self.faixas, self.contagens)]
+            faixas.append(("acima_%gs" % self.faixas[-1], self.contagens[-1]))
+            return {
+                'faixas': dict(faixas),
+                'total': self.total,
+                'media': self.soma / self.total if self.total else 0.0,
+                'maximo': self.maximo,
+            }
+
+class QueuePoolMedido(QueuePool):
+    """QueuePool que registra no histograma o tempo de espera de cada
+    obtencao de conexao, incluindo a abertura de novas conexoes e a
+    verificacao (pre-ping) na retirada.
+    """
+    histograma = None
+
+    def mede(self, obtem):
+        inicio = time()
+        try:
+            return obtem()
+        finally:
+            if self.histograma is not None:
+                self.histograma.registra(time() - inicio)
+
+    def connect(self):
+        return self.mede(super(QueuePoolMedido, self).connect)
+
+    def unique_connection(self):
+        # usado pelo engine (Engine.raw_connection) para as sessoes
+        return self.mede(super(QueuePoolMedido, self).unique_connection)
+
+    def recreate(self):
+        # o pool e' recriado quando as conexoes caem; mantem as medidas
+        pool = super(QueuePoolMedido, self).recreate()
+        pool.histograma = self.histograma
+        return pool
+
+def pre_ping(dbapi_con, con_record, con_proxy):
+    '''
+    Verifica a conexao na retirada do pool; se ela caiu (reinicio do banco,
+    timeout do firewall), o pool a descarta e abre outra.
+    '''
+    cursor = dbapi_con.cursor()
+    try:
+        cursor.execute("SELECT 1")
+    except Exception:
+        raise exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+# conexoes retiradas pela thread atual: {id do registro: (retirada, url)}
+estado_thread = local()
+
+def retiradas():
+    if not hasattr(estado_thread, 'retiradas'):
+        estado_thread.retiradas = {}
+    return estado_thread.retiradas
+
+def registra_retirada(dbapi_con, con_record, con_proxy):
+    retiradas()[id(con_record)] = (time(),
+        getattr(estado_thread, 'requisicao', None))
+
+def registra_devolucao(dbapi_con, con_record):
+    # a devolucao pode ocorrer em outra thread (coleta de lixo)
+    retiradas().pop(id(con_record), None)
+
+class Pools(object):
+    """Registro dos engines da aplicacao e das suas medidas, para o
+    diagnostico do uso das conexoes.
+    """
+    def __init__(self):
+        self.engines = []
+        self.vazamentos = 0
+        self.trava = Lock()
+
+    def registra(self, nome, engine):
+        self.engines.append((nome, engine))
+
+    def registra_vazamento(self):
+        with self.trava:
+            self.vazamentos += 1
+
+    def estado(self):
+        estado = {}
+        for nome, engine in self.engines:
+            pool = engine.pool
+            item = {'classe': pool.__class__.__name__}
+            if isinstance(pool, QueuePool):
+                item.update({
+                    'tamanho': pool.size(),
+                    'disponiveis': pool.checkedin(),
+                    'em_uso': pool.checkedout(),
+                    'excedentes': max(pool.overflow(), 0),
+                })
+            if getattr(pool, 'histograma', None) is not None:
+                item['espera'] = pool.histograma.como_dict()
+            estado[nome] = item
+        return {'pools': estado, 'sessoes_nao_fechadas': self.vazamentos}
+
+pools = Pools()
+
+# modo de compatibilidade com o PgBouncer em pool de transacoes: sem pool
+# na aplicacao e sem estado de sessao no banco (SET LOCAL em vez de SET).
+# Definido na inicializacao da aplicacao por cria_engine.
+modo_pgbouncer = False
+
+def cria_engine(settings, nome, url=None):
+    '''
+    Cria um engine com as opcoes 'sqlalchemy.' do .ini (pool_size,
+    max_overflow, pool_timeout, pool_recycle) e as opcoes 'pool.' da
+    aplicacao: pre_ping, pgbouncer e preenche (abre as conexoes do pool na
+    inicializacao). A url, se informada, substitui a 'sqlalchemy.url'.
+    '''
+    global modo_pgbouncer
+    opcoes = dict(settings)
+    if url is not None:
+        opcoes['sqlalchemy.url'] = url
+    modo_pgbouncer = sim(settings.get('pool.pgbouncer'))
+    extras = {}
+    if modo_pgbouncer:
+        # o PgBouncer mantem o pool; a aplicacao abre uma conexao por uso
+        for opcao in OPCOES_POOL:
+            opcoes.pop('sqlalchemy.' + opcao, None)
+        extras['poolclass'] = NullPool
+    else:
+        u = make_url(opcoes['sqlalchemy.url'])
+        if u.get_dialect().get_pool_class(u) is QueuePool:
+            extras['poolclass'] = QueuePoolMedido
+    engine = engine_from_config(opcoes, 'sqlalchemy.', **extras)
+
+    if isinstance(engine.pool, QueuePoolMedido):
+        engine.pool.histograma = Histograma()
+    if sim(settings.get('pool.pre_ping')):
+        event.listen(engine.pool, 'checkout', pre_ping)
+    event.listen(engine.pool, 'checkout', registra_retirada)
+    event.listen(engine.pool, 'checkin', registra_devolucao)
+    if sim(settings.get('pool.preenche')) and isinstance(engine.pool, QueuePool):
+        preenche(engine)
+    pools.registra(nome, engine)
+    return engine
+
+def preenche(engine):
+    '''
+    Abre as conexoes permanentes do pool, evitando que as primeiras
+    requisicoes esperem pela abertura das conexoes.
+    '''
+    conexoes = []
+    try:
+        for n in range(engine.pool.size()):
+            conexoes.append(engine.pool.connect())
+    except exc.SQLAlchemyError, e:
+        log.warning("pool %s preenchido com %d conexoes: %s",
+            engine.url.database, len(conexoes), e)
+    for conexao in conexoes:
+        conexao.close()
+
+def verifica_sessoes(registros, requisicao):
+    '''
+    Chamada no inicio de cada requisicao: as conexoes ainda retiradas pela
+    thread pertencem a sessoes que uma requisicao anterior nao fechou (por
+    exemplo, por uma excecao antes do fechamento). Registra o vazamento e
+    fecha as sessoes, devolvendo as conexoes ao pool.
+
+    registros: as sessoes com escopo de thread (scoped_session)
+    requisicao: identificacao da nova requisicao (caminho e parametros)
+    '''
+    abertas = retiradas()
+    if abertas:
+        agora = time()
+        for retirada, origem in abertas.values():
+            log.warning("sessao nao fechada pela requisicao %s "
+                "(conexao retirada ha %.1f segundos)", origem, agora - retirada)
+            pools.registra_vazamento()
+        for registro in registros:
+            registro.remove()
+        abertas.clear()
+    estado_thread.requisicao = requisicao
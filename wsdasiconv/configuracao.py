@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo configuracao.py da API de dados abertos do SICONV.
+=========================================================
+
+© 2011-2013 Ministério do Planejamento, Orçamento e Gestão
+
+Este arquivo e parte do webservice de dados abertos do SICONV,
+o Sistema de Cadastro de Convênios e Contratos de Repasse.
+
+A documentacao esta disponível em http://api.convenios.gov.br/siconv/doc/
+
+O webservice de dados abertos do SICONV é um software livre; você pode
+redistribui-lo e/ou modifica-lo dentro dos termos da Licença Pública Geral
+Affero GNU como publicada pela Fundação do Software Livre (FSF); na versão 3
+da Licença, ou (na sua opnião) qualquer versão subsequente.
+
+Este programa é distribuido na esperança que possa ser  util,
+mas SEM NENHUMA GARANTIA; sem uma garantia implicita de ADEQUAÇÂO a qualquer
+MERCADO ou APLICAÇÃO EM PARTICULAR. Veja a
+Licença Pública Geral Affero GNU para maiores detalhes.
+
+http://www.gnu.org/licenses/agpl-3.0.html
+"""
+
+
+# leitura das opcoes do .ini comuns aos modulos da aplicacao
+
+def sim(valor):
+    '''
+    Interpreta uma opcao booleana do .ini ('sim', 'true' ou '1'). Opcoes
+    ausentes equivalem a 'nao'.
+    '''
+    return (valor or 'nao').strip().lower() in ('sim', 'true', '1')
@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo contagem.py da API de dados abertos do SICONV.
+=======================================================
+
+© 2011-2013 Ministério do Planejamento, Orçamento e Gestão
+
+Este arquivo e parte do webservice de dados abertos do SICONV,
+o Sistema de Cadastro de Convênios e Contratos de Repasse.
+
+A documentacao esta disponível em http://api.convenios.gov.br/siconv/doc/
+
+O webservice de dados abertos do SICONV é um software livre; você pode
+redistribui-lo e/ou modifica-lo dentro dos termos da Licença Pública Geral
+Affero GNU como publicada pela Fundação do Software Livre (FSF); na versão 3
+da Licença, ou (na sua opnião) qualquer versão subsequente.
+
+Este programa é distribuido na esperança que possa ser  util,
+mas SEM NENHUMA GARANTIA; sem uma garantia implicita de ADEQUAÇÂO a qualquer
+MERCADO ou APLICAÇÃO EM PARTICULAR. Veja a
+Licença Pública Geral Affero GNU para maiores detalhes.
+
+http://www.gnu.org/licenses/agpl-3.0.html
+"""
+
+import re
+import logging
+from threading import Lock
+from datetime import datetime, timedelta, time
+from time import time as instante
+from multiprocessing.pool import ThreadPool
+
+from sqlalchemy import select, exc
+
+from model import carga_dados
+
+log = logging.getLogger(__name__)
+
+# modos de contagem do total de registros de uma consulta
+MODOS_CONTAGEM = {
+    'exata': u"Contagem exata, feita a cada requisição",
+    'cache': u"Contagem exata, reaproveitada até a próxima carga de dados",
+    'estimada': u"Estimativa do planejador do banco de dados",
+    'nenhuma': u"Sem contagem: informa apenas se há mais registros",
+}
+MODO_PADRAO = 'cache'
+
+# as atualizacoes sao feitas na madrugada e terminam, em geral, antes das
+# 3:00 (o mesmo horario usado para a expiracao do cache http)
+HORA_CARGA = 3
+
+def geracao_relogio(agora=None):
+    '''
+    Retorna o horario previsto de termino da carga noturna mais recente.
+    Usado apenas enquanto nenhuma carga foi registrada no banco de dados
+    (ver registra_carga).
+    '''
+    if agora is None:
+        agora = datetime.now()
+    fim = datetime.combine(agora.date(), time(HORA_CARGA, 0))
+    if agora < fim:
+        fim -= timedelta(days=1)
+    return fim
+
+class MarcadorCarga(object):
+    """Le o marcador da carga noturna (o horario de termino da carga mais
+    recente, gravado no banco de dados por registra_carga), no maximo uma
+    vez a cada intervalo segundos.
+
+    Como o marcador fica no banco de dados, todos os processos do
+    webservice percebem o fim da carga, qualquer que seja o horario.
+    """
+
+    def __init__(self, engine=None, intervalo=60):
+        self.engine = engine
+        self.intervalo = intervalo
+        self.valor = None
+        self.lido_em = None
+        self.lock = Lock()
+
+    def le(self):
+        '''
+        Le o marcador no banco de dados (None se nenhuma carga foi
+        registrada).
+        '''
+        conn = self.engine.connect()
+        try:
+            if not conn.dialect.has_table(conn, carga_dados.name):
+                return None
+            return conn.execute(select([carga_dados.c.termino],
+                carga_dados.c.id == 1)).scalar()
+        finally:
+            conn.close()
+
+    def atual(self):
+        '''
+        Retorna o marcador da carga mais recente. Sem banco de dados
+        configurado ou sem carga registrada, usa o horario previsto
+        (ver geracao_relogio).
+        '''
+        if self.engine is None:
+            return geracao_relogio()
+        with self.lock:
+            agora = instante()
+            if self.lido_em is None or agora - self.lido_em >= self.intervalo:
+                try:
+                    self.valor = self.le()
+                except exc.DBAPIError, e:
+                    # mantem o marcador lido anteriormente
+                    log.warning("marcador da carga indisponivel: %s", e)
+                self.lido_em = agora
+            valor = self.valor
+        return valor if valor is not None else geracao_relogio()
+
+marcador_carga = MarcadorCarga()
+
+def geracao_carga():
+    '''
+    Retorna o marcador da carga noturna mais recente (ver MarcadorCarga).
+    Os dados consultados nao mudam entre duas cargas.
+    '''
+    return marcador_carga.atual()
+
+# a carga de cada noite termina no maximo 12 horas antes do horario previsto
+# (HORA_CARGA); um marcador mais antigo e' o de uma noite anterior
+JANELA_CARGA = timedelta(hours=12)
+
+def carga_atrasada(agora=None):
+    '''
+    Indica se a carga da ultima noite ainda nao foi registrada, passado o
+    horario previsto de termino (o marcador e' de uma noite anterior).
+    '''
+    return geracao_carga() < geracao_relogio(agora) - JANELA_CARGA
+
+def expiracao_cache(agora=None):
+    '''
+    Retorna a expiracao do cache http das respostas: o horario previsto de
+    termino da proxima carga ou, se a ultima carga atrasou, o intervalo
+    entre as leituras do marcador, para que os clientes revalidem a
+    resposta (e-tag) logo que ela terminar.
+    '''
+    if agora is None:
+        agora = datetime.now()
+    if carga_atrasada(agora):
+        return agora + timedelta(seconds=marcador_carga.intervalo)
+    return geracao_relogio(agora) + timedelta(days=1)
+
+def registra_carga(engine, termino=None):
+    '''
+    Grava no banco de dados o marcador de termino da carga (por padrao, o
+    horario atual). Deve ser chamada ao fim de cada carga; os processos do
+    webservice descartam as contagens e as fronteiras em cache ao ler o
+    novo marcador.
+    '''
+    if termino is None:
+        termino = datetime.now()
+    carga_dados.create(engine, checkfirst=True)
+    conn = engine.connect()
+    try:
+        transacao = conn.begin()
+        conn.execute(carga_dados.delete())
+        conn.execute(carga_dados.insert(), id=1, termino=termino)
+        transacao.commit()
+    finally:
+        conn.close()
+    return termino
+
+def configura_carga(engine, intervalo=60):
+    '''
+    Le o marcador da carga no banco de dados informado, no maximo uma vez a
+    cada intervalo segundos (ver MarcadorCarga).
+    '''
+    global marcador_carga
+    marcador_carga = MarcadorCarga(engine, intervalo)
+    return marcador_carga
+
+class CacheContagem(object):
+    """Armazena contagens exatas por metodo e valores de filtros.
+
+    As contagens valem ate o termino da proxima carga noturna, quando sao
+    descartadas: o cache compara o marcador da carga (ver geracao_carga)
+    com o das contagens guardadas.
+    """
+
+    max_entradas = 10000
+
+    def __init__(self):
+        self.entradas = {}
+        self.geracao = geracao_carga()
+        self.lock = Lock()
+
+    @staticmethod
+    def chave(metodo, valores):
+        '''
+        Gera a chave do cache a partir do id do metodo e dos valores ja
+        normalizados (apos 'transform') dos filtros utilizados.
+        '''
+        return (metodo, tuple(sorted(
+            (param, repr(valor)) for param, valor in valores.items()
+            if valor is not None)))
+
+    def _confere_geracao(self):
+        geracao = geracao_carga()
+        if geracao != self.geracao:
+            # houve carga nova desde que as contagens foram feitas
+            self.entradas.clear()
+            self.geracao = geracao
+
+    def obtem(self, chave):
+        with self.lock:
+            self._confere_geracao()
+            return self.entradas.get(chave, None)
+
+    def guarda(self, chave, total):
+        with self.lock:
+            self._confere_geracao()
+            if len(self.entradas) >= self.max_entradas:
+                self.entradas.clear()
+            self.entradas[chave] = total
+
+    def invalida(self):
+        with self.lock:
+            self.entradas.clear()
+            self.geracao = geracao_carga()
+
+cache_contagem = CacheContagem()
+
+re_linhas_plano = re.compile(r"rows=(\d+)")
+re_custo_plano = re.compile(r"cost=[\d.]+\.\.([\d.]+)")
+
+def explica(session, query):
+    '''
+    Retorna a primeira linha do plano de execucao (EXPLAIN) da consulta, ou
+    None se o banco de dados nao for PostgreSQL.
+    '''
+    conn = session.connection()
+    if conn.dialect.name != 'postgresql':
+        return None
+    compilado = query.statement.compile(dialect=conn.dialect)
+    plano = conn.execute(u"EXPLAIN " + unicode(compilado), compilado.params)
+    linha = plano.fetchone()
+    plano.close()
+    return linha[0] if linha else None
+
+def linhas_plano(linha):
+    '''
+    Retorna a quantidade de registros da linha do plano de execucao, ou
+    None se a linha nao a informar.
+    '''
+    m = re_linhas_plano.search(linha or "")
+    return int(m.group(1)) if m else None
+
+def custo_plano(linha):
+    '''
+    Retorna o custo total estimado da linha do plano de execucao, ou None
+    se a linha nao o informar.
+    '''
+    m = re_custo_plano.search(linha or "")
+    return float(m.group(1)) if m else None
+
+def estima_registros(session, query):
+    '''
+    Retorna a quantidade de registros estimada pelo planejador do banco de
+    dados, ou None se a estimativa nao estiver disponivel.
+    '''
+    return linhas_plano(explica(session, query))
+
+def contagem_sem_consulta(modo, chave=None):
+    '''
+    Retorna a contagem que dispensa o banco de dados, como uma tupla
+    (total, modo utilizado): a do modo 'nenhuma' e as que estao em cache.
+    Retorna None se for preciso consultar o banco de dados.
+    '''
+    if modo == 'nenhuma':
+        return None, modo
+    if modo == 'cache' and chave is not None:
+        total = cache_contagem.obtem(chave)
+        if total is not None:
+            return total, modo
+    return None
+
+def conta_registros(session, query, modo, chave=None, conta=None,
+        custo_maximo=None):
+    '''
+    Conta os registros da consulta conforme o modo de contagem solicitado.
+
+    conta: funcao opcional, sem argumentos, que faz a contagem exata. Se
+    omitida, e' usado query.count().
+    custo_maximo: custo estimado da consulta acima do qual a contagem
+    exata da lugar a estimativa do planejador.
+
+    Retorna uma tupla (total, modo utilizado). O total e' None no modo
+    'nenhuma'. Se a estimativa nao estiver disponivel, a contagem e' exata.
+    '''
+    if conta is None:
+        conta = query.count
+    pronta = contagem_sem_consulta(modo, chave)
+    if pronta is not None:
+        return pronta
+    if modo == 'estimada':
+        total = estima_registros(session, query)
+        if total is not None:
+            return total, modo
+        modo = 'exata'
+    cache = modo == 'cache' and chave is not None
+    if custo_maximo:
+        # a contagem exata percorreria todos os registros da consulta
+        linha = explica(session, query)
+        custo = custo_plano(linha)
+        if custo is not None and custo > custo_maximo:
+            return linhas_plano(linha), 'estimada'
+    total = conta()
+    if cache:
+        cache_contagem.guarda(chave, total)
+        return total, modo
+    return total, 'exata'
+
+class ContagemPronta(object):
+    """Contagem ja conhecida antes da consulta (ver contagem_sem_consulta),
+    com a mesma interface (get) das contagens em paralelo.
+    """
+    def __init__(self, resultado):
+        self.resultado = resultado
+
+    def get(self):
+        return self.resultado
+
+class ContagemAdiada(object):
+    """Contagem executada apenas quando o resultado e' solicitado (get),
+    usada quando nao ha threads para as contagens em paralelo.
+    """
+    def __init__(self, funcao):
+        self.funcao = funcao
+
+    def get(self):
+        return self.funcao()
+
+# threads que executam as contagens em paralelo com a consulta da pagina.
+# Definidas na inicializacao da aplicacao por configura_contagens.
+threads_contagem = None
+
+def configura_contagens(quantidade):
+    '''
+    Cria as threads das contagens em paralelo (0 desativa o paralelismo).
+    Cada contagem em andamento ocupa uma conexao a mais do pool.
+    '''
+    global threads_contagem
+    if threads_contagem is not None:
+        threads_contagem.terminate()
+    threads_contagem = ThreadPool(quantidade) if quantidade else None
+    return threads_contagem
+
+def conta_em_paralelo(funcao, paralela=True):
+    '''
+    Inicia a contagem (funcao sem argumentos) em uma das threads de
+    contagem. Retorna um objeto cujo metodo get() aguarda e devolve o
+    resultado ou levanta a excecao da contagem. Se paralela for falso ou
+    nao houver threads, a contagem e' feita no get().
+    '''
+    if not paralela or threads_contagem is None:
+        return ContagemAdiada(funcao)
+    return threads_contagem.apply_async(funcao)
+
+if __name__ == "__main__":
+    # registra o termino da carga no banco informado, ao fim da carga:
+    # python -m wsdasiconv.contagem <url do banco>
+    from sys import argv
+    from sqlalchemy import create_engine
+    print registra_carga(create_engine(argv[1]))
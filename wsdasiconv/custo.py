@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo custo.py da API de dados abertos do SICONV.
+=======================================================
+
+© 2011-2013 Ministério do Planejamento, Orçamento e Gestão
+
+Este arquivo e parte do webservice de dados abertos do SICONV,
+o Sistema de Cadastro de Convênios e Contratos de Repasse.
+
+A documentacao esta disponível em http://api.convenios.gov.br/siconv/doc/
+
+O webservice de dados abertos do SICONV é um software livre; você pode
+redistribui-lo e/ou modifica-lo dentro dos termos da Licença Pública Geral
+Affero GNU como publicada pela Fundação do Software Livre (FSF); na versão 3
+da Licença, ou (na sua opnião) qualquer versão subsequente.
+
+Este programa é distribuido na esperança que possa ser  util,
+mas SEM NENHUMA GARANTIA; sem uma garantia implicita de ADEQUAÇÂO a qualquer
+MERCADO ou APLICAÇÃO EM PARTICULAR. Veja a
+Licença Pública Geral Affero GNU para maiores detalhes.
+
+http://www.gnu.org/licenses/agpl-3.0.html
+"""
+
+from contagem import explica, custo_plano
+
+# codigo de erro (SQLSTATE) do PostgreSQL para o cancelamento de uma
+# instrucao pelo statement_timeout
+CANCELADA_TEMPO_LIMITE = '57014'
+
+class ConsultaCara(Exception):
+    """O custo estimado pelo planejador do banco de dados para a consulta
+    ultrapassa o maximo configurado para o metodo.
+    """
+
+class LimitesCusto(object):
+    """Limites de custo e de tempo das consultas, lidos do .ini.
+
+    Cada limite tem um valor geral ('custo.tempo_limite') que pode ser
+    substituido por formato ('custo.tempo_limite.csv'), por metodo
+    ('custo.tempo_limite.propostas') ou por metodo e formato
+    ('custo.tempo_limite.propostas.csv'), nessa ordem de precedencia
+    crescente. Os limites sao:
+
+    * custo.tempo_limite: statement_timeout das consultas, em milissegundos
+    * custo.maximo: custo estimado acima do qual a consulta e' recusada
+    * custo.contagem_exata: custo estimado acima do qual a contagem exata
+      do total de registros da lugar a estimativa do planejador
+    """
+
+    def __init__(self, settings=None):
+        self.valores = {}
+        for chave, valor in (settings or {}).items():
+            if chave.startswith('custo.') and valor and valor.strip():
+                self.valores[chave] = int(valor)
+
+    def limite(self, nome, metodo, formato):
+        base = 'custo.' + nome
+        for chave in (base + '.' + metodo + '.' + formato,
+                base + '.' + metodo, base + '.' + formato, base):
+            if chave in self.valores:
+                return self.valores[chave] or None
+        return None
+
+    def tempo_limite(self, metodo, formato):
+        return self.limite('tempo_limite', metodo, formato)
+
+    def custo_maximo(self, metodo, formato):
+        return self.limite('maximo', metodo, formato)
+
+    def custo_contagem(self, metodo, formato):
+        return self.limite('contagem_exata', metodo, formato)
+
+# limites em uso. Definidos na inicializacao da aplicacao por
+# configura_custos; sem configuracao, nao ha limites.
+limites = LimitesCusto()
+
+def configura_custos(settings):
+    global limites
+    limites = LimitesCusto(settings)
+    return limites
+
+def define_tempo_limite(session, milissegundos):
+    '''
+    Define o statement_timeout da transacao da sessao (PostgreSQL). O SET
+    LOCAL vale ate o fim da transacao, inclusive com o PgBouncer em pool de
+    transacoes, e e' desfeito quando a sessao e' fechada.
+    '''
+    if not milissegundos:
+        return
+    conn = session.connection()
+    if conn.dialect.name != 'postgresql':
+        return
+    conn.execute("SET LOCAL statement_timeout = %d" % int(milissegundos))
+
+def admite(session, query, maximo):
+    '''
+    Recusa a consulta (ConsultaCara) se o seu custo estimado pelo
+    planejador (EXPLAIN, sem executa-la) ultrapassar o maximo. Retorna o
+    custo estimado, ou None se nao estiver disponivel.
+    '''
+    if not maximo:
+        return None
+    custo = custo_plano(explica(session, query))
+    if custo is not None and custo > maximo:
+        raise ConsultaCara(custo, maximo)
+    return custo
+
+def tempo_esgotado(erro):
+    '''
+    Indica se o erro do banco de dados (DBAPIError) e' o cancelamento da
+    instrucao por ter excedido o statement_timeout.
+    '''
+    return getattr(getattr(erro, 'orig', None), 'pgcode', None) == \
+        CANCELADA_TEMPO_LIMITE
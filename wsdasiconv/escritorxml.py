@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo escritorxml.py da API de dados abertos do SICONV.
+=======================================================
+
+© 2011-2013 Ministério do Planejamento, Orçamento e Gestão
+
+Este arquivo e parte do webservice de dados abertos do SICONV,
+o Sistema de Cadastro de Convênios e Contratos de Repasse.
+
+A documentacao esta disponível em http://api.convenios.gov.br/siconv/doc/
+
+O webservice de dados abertos do SICONV é um software livre; você pode
+redistribui-lo e/ou modifica-lo dentro dos termos da Licença Pública Geral
+Affero GNU como publicada pela Fundação do Software Livre (FSF); na versão 3
+da Licença, ou (na sua opnião) qualquer versão subsequente.
+
+Este programa é distribuido na esperança que possa ser  util,
+mas SEM NENHUMA GARANTIA; sem uma garantia implicita de ADEQUAÇÂO a qualquer
+MERCADO ou APLICAÇÃO EM PARTICULAR. Veja a
+Licença Pública Geral Affero GNU para maiores detalhes.
+
+http://www.gnu.org/licenses/agpl-3.0.html
+"""
+
+from datetime import datetime
+
+# estruturas do amara, retornadas pelos metodos repr_xml dos objetos
+from amara.writers.struct import E, NS
+
+# declaracao do documento e indentacao, como no xmlprettyprinter do amara
+DECLARACAO = '<?xml version="1.0" encoding="utf-8"?>\n'
+INDENTACAO = '  '
+
+def texto_atributo(valor):
+    '''
+    Converte o valor de um atributo em unicode, como o amara (amara.lib.U).
+    '''
+    if isinstance(valor, unicode):
+        return valor
+    elif isinstance(valor, str):
+        return valor.decode('utf-8')
+    elif isinstance(valor, datetime):
+        return valor.isoformat()
+    return unicode(valor)
+
+def escapa_texto(texto):
+    return texto.replace(u'&', u'&amp;').replace(u'<', u'&lt;') \
+        .replace(u'>', u'&gt;').replace(u'\r', u'&#13;')
+
+def serializa_atributo(nome, valor):
+    '''
+    Retorna o atributo ' nome="valor"' em utf-8. Os valores com aspas e sem
+    apostrofos sao delimitados por apostrofos, como no amara.
+    '''
+    valor = valor.replace(u'&', u'&amp;').replace(u'<', u'&lt;') \
+        .replace(u'\t', u'&#9;').replace(u'\n', u'&#10;') \
+        .replace(u'\r', u'&#13;')
+    if u'"' in valor and u"'" not in valor:
+        return (u" %s='%s'" % (nome, valor)).encode('utf-8')
+    return (u' %s="%s"' % (nome, valor.replace(u'"', u'&quot;'))).encode('utf-8')
+
+# ordem dos atributos para cada sequencia de nomes
+ordens_atributos = {}
+
+def ordem_atributos(nomes):
+    '''
+    Retorna a ordem em que o amara escreve os atributos de nomes (na ordem
+    do dicionario recebido): a do dicionario indexado por (namespace, nome)
+    que ele monta. A ordem e' calculada uma vez para cada sequencia.
+    '''
+    ordem = ordens_atributos.get(nomes)
+    if ordem is None:
+        indexado = {}
+        for nome in nomes:
+            indexado[None, texto_atributo(nome)] = nome
+        ordem = ordens_atributos[nomes] = tuple(indexado.itervalues())
+    return ordem
+
+def serializa_atributos(atributos):
+    '''
+    Serializa os atributos de um dicionario, na ordem do amara e sem os
+    valores None.
+    '''
+    if not atributos:
+        return ''
+    nomes = tuple(nome for nome, valor in atributos.iteritems()
+        if valor is not None)
+    return ''.join(serializa_atributo(texto_atributo(nome),
+        texto_atributo(atributos[nome])) for nome in ordem_atributos(nomes))
+
+class EscritorXML(object):
+    """Escreve um documento XML indentado em partes (str, utf-8), com o
+    mesmo resultado do structwriter do amara (indent=True).
+
+    Os eventos (abre, texto, fecha) acumulam o texto em partes, que sao
+    retiradas com esvazia a cada objeto serializado. Estruturas do amara
+    (E), como as dos metodos repr_xml, sao escritas com alimenta.
+    """
+
+    def __init__(self):
+        self.partes = []
+        # nome do elemento cuja marca de abertura ainda nao foi fechada
+        self.aberto = None
+        self.nivel = 0
+        # o primeiro elemento e os que seguem um texto nao sao indentados
+        self.pode_indentar = False
+
+    def esvazia(self):
+        partes = "".join(self.partes)
+        self.partes = []
+        return partes
+
+    def inicia(self):
+        self.partes.append(DECLARACAO)
+
+    def abre(self, nome, atributos=''):
+        '''
+        Abre o elemento nome (str, utf-8), com os atributos ja serializados.
+        '''
+        partes = self.partes
+        if self.aberto is not None:
+            partes.append('>')
+            self.aberto = None
+        if self.pode_indentar:
+            partes.append('\n' + INDENTACAO * self.nivel)
+        partes.append('<' + nome + atributos)
+        self.aberto = nome
+        self.nivel += 1
+        self.pode_indentar = True
+
+    def fecha(self, nome):
+        self.nivel -= 1
+        partes = self.partes
+        if self.aberto is not None:
+            # elemento sem conteudo: forma abreviada
+            self.aberto = None
+            partes.append('/>')
+        else:
+            if self.pode_indentar:
+                partes.append('\n' + INDENTACAO * self.nivel)
+            partes.append('</' + nome + '>')
+        self.pode_indentar = True
+
+    def texto(self, texto):
+        '''
+        Escreve o texto (unicode) no elemento aberto.
+        '''
+        if self.aberto is not None:
+            self.partes.append('>')
+            self.aberto = None
+        self.partes.append(escapa_texto(texto).encode('utf-8'))
+        self.pode_indentar = False
+
+    def elemento(self, nome, atributos, conteudo):
+        '''
+        Escreve o elemento nome (str, utf-8) com os atributos (dicionario)
+        e o conteudo, como E(nome, atributos, conteudo) no amara.
+        '''
+        self.abre(nome, serializa_atributos(atributos))
+        self.alimenta(conteudo)
+        self.fecha(nome)
+
+    def alimenta(self, obj):
+        '''
+        Escreve uma estrutura do amara (E), um texto ou um iteravel delas,
+        como structwriter.feed.
+        '''
+        if isinstance(obj, E):
+            nome = obj.qname.encode('utf-8')
+            self.abre(nome, ''.join(serializa_atributo(qname, valor)
+                for qname, valor in obj.attributes.itervalues())
+                if obj.attributes else '')
+            conteudo = [item for item in obj.content if not isinstance(item, NS)]
+            # como no amara, um primeiro item vazio descarta o conteudo
+            if conteudo and conteudo[0]:
+                for item in conteudo:
+                    self.alimenta(item)
+            self.fecha(nome)
+        elif isinstance(obj, NS):
+            return
+        elif isinstance(obj, basestring):
+            self.texto(texto_atributo(obj))
+        else:
+            try:
+                itens = iter(obj)
+            except TypeError:
+                if callable(obj):
+                    self.alimenta(obj())
+                else:
+                    self.alimenta(unicode(obj))
+            else:
+                for item in itens:
+                    self.alimenta(item)
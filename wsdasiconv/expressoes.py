@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo expressoes.py da API de dados abertos do SICONV.
+=======================================================
+
+© 2011-2013 Ministério do Planejamento, Orçamento e Gestão
+
+Este arquivo e parte do webservice de dados abertos do SICONV,
+o Sistema de Cadastro de Convênios e Contratos de Repasse.
+
+A documentacao esta disponível em http://api.convenios.gov.br/siconv/doc/
+
+O webservice de dados abertos do SICONV é um software livre; você pode
+redistribui-lo e/ou modifica-lo dentro dos termos da Licença Pública Geral
+Affero GNU como publicada pela Fundação do Software Livre (FSF); na versão 3
+da Licença, ou (na sua opnião) qualquer versão subsequente.
+
+Este programa é distribuido na esperança que possa ser  util,
+mas SEM NENHUMA GARANTIA; sem uma garantia implicita de ADEQUAÇÂO a qualquer
+MERCADO ou APLICAÇÃO EM PARTICULAR. Veja a
+Licença Pública Geral Affero GNU para maiores detalhes.
+
+http://www.gnu.org/licenses/agpl-3.0.html
+"""
+
+import re
+
+# operadores logicos do parametro 'filtro', em ordem crescente de precedencia
+OU = 'ou'
+E = 'e'
+NAO = 'nao'
+palavras_operadores = {
+    u"ou": OU,
+    u"e": E,
+    u"nao": NAO,
+    u"não": NAO,
+}
+
+# limites que protegem o banco de dados de expressoes muito grandes
+MAX_ATOMOS = 30
+MAX_PROFUNDIDADE = 10
+
+# cada token e' um parentese, um atomo 'parametro:valor' (o valor pode vir
+# entre aspas duplas, para conter espacos ou parenteses) ou uma palavra
+re_token = re.compile(r'''\s*(?:
+      (?P<abre>\()
+    | (?P<fecha>\))
+    | (?P<param>\w+):(?:"(?P<aspas>[^"]*)"|(?P<valor>[^\s()"]+))
+    | (?P<palavra>[^\s()]+)
+    )''', re.UNICODE | re.VERBOSE)
+
+def tokens(texto):
+    '''
+    Divide a expressao em tokens: tuplas (tipo, conteudo).
+    '''
+    posicao = 0
+    texto = texto.rstrip()
+    while posicao < len(texto):
+        m = re_token.match(texto, posicao)
+        if m is None:
+            raise ValueError(u"Expressão de filtro mal formada em: '%s'." % \
+                texto[posicao:])
+        posicao = m.end()
+        if m.group('abre'):
+            yield ('(', None)
+        elif m.group('fecha'):
+            yield (')', None)
+        elif m.group('param'):
+            valor = m.group('aspas')
+            if valor is None:
+                valor = m.group('valor')
+            yield ('atomo', (m.group('param'), valor))
+        else:
+            palavra = m.group('palavra')
+            operador = palavras_operadores.get(palavra.lower(), None)
+            if operador is None:
+                raise ValueError(u"Termo desconhecido na expressão de filtro: '%s'. Use parametro:valor, 'e', 'ou', 'nao' e parênteses." % \
+                    palavra)
+            yield (operador, None)
+
+class _Analisador(object):
+    """Analisador descendente recursivo da expressao de filtro.
+
+    Gramatica:
+        expressao := termo ('ou' termo)*
+        termo     := fator ('e' fator)*
+        fator     := 'nao' fator | '(' expressao ')' | parametro:valor
+    """
+
+    def __init__(self, texto):
+        self.tokens = list(tokens(texto))
+        self.posicao = 0
+        self.atomos = 0
+
+    def proximo(self):
+        if self.posicao < len(self.tokens):
+            return self.tokens[self.posicao][0]
+        return None
+
+    def consome(self):
+        token = self.tokens[self.posicao]
+        self.posicao += 1
+        return token
+
+    def analisa(self):
+        if not self.tokens:
+            raise ValueError(u"A expressão de filtro está vazia.")
+        no = self.expressao(0)
+        if self.proximo() is not None:
+            raise ValueError(u"Expressão de filtro mal formada: '%s' inesperado." % \
+                self.proximo())
+        return no
+
+    def expressao(self, profundidade):
+        return self.sequencia(OU, self.termo, profundidade)
+
+    def termo(self, profundidade):
+        return self.sequencia(E, self.fator, profundidade)
+
+    def sequencia(self, operador, operando, profundidade):
+        nos = [operando(profundidade)]
+        while self.proximo() == operador:
+            self.consome()
+            nos.append(operando(profundidade))
+        if len(nos) == 1:
+            return nos[0]
+        return (operador, tuple(nos))
+
+    def fator(self, profundidade):
+        # cada parentese e cada 'nao' aprofunda a recursao
+        if profundidade > MAX_PROFUNDIDADE:
+            raise ValueError(u"A expressão de filtro tem mais de %d níveis de parênteses ou negações." % \
+                MAX_PROFUNDIDADE)
+        tipo = self.proximo()
+        if tipo is None:
+            raise ValueError(u"Expressão de filtro incompleta.")
+        tipo, conteudo = self.consome()
+        if tipo == NAO:
+            return (NAO, self.fator(profundidade + 1))
+        if tipo == '(':
+            no = self.expressao(profundidade + 1)
+            if self.proximo() != ')':
+                raise ValueError(u"Expressão de filtro mal formada: faltou fechar parênteses.")
+            self.consome()
+            return no
+        if tipo == 'atomo':
+            self.atomos += 1
+            if self.atomos > MAX_ATOMOS:
+                raise ValueError(u"A expressão de filtro tem mais de %d condições." % \
+                    MAX_ATOMOS)
+            return ('atomo', conteudo[0], conteudo[1])
+        raise ValueError(u"Expressão de filtro mal formada: '%s' inesperado." % tipo)
+
+def analisa_expressao(texto):
+    '''
+    Analisa a expressao do parametro 'filtro', como
+    'uf:SP,RJ ou (id_situacao:3 e nao id_modalidade:1)'.
+
+    Retorna a arvore da expressao, feita de tuplas:
+        ('atomo', parametro, valor)
+        ('nao', no)
+        ('e', (no, no, ...))
+        ('ou', (no, no, ...))
+    Levanta ValueError se a expressao for mal formada.
+    '''
+    return _Analisador(texto).analisa()
+
+def atomos(no):
+    '''
+    Percorre os atomos da arvore em pre-ordem, retornando tuplas
+    (parametro, valor).
+    '''
+    tipo = no[0]
+    if tipo == 'atomo':
+        yield no[1], no[2]
+    elif tipo == NAO:
+        for atomo in atomos(no[1]):
+            yield atomo
+    else:
+        for filho in no[1]:
+            for atomo in atomos(filho):
+                yield atomo
+
+def mapeia_atomos(no, funcao):
+    '''
+    Retorna uma copia da arvore com o valor de cada atomo substituido por
+    funcao(parametro, valor).
+    '''
+    tipo = no[0]
+    if tipo == 'atomo':
+        return ('atomo', no[1], funcao(no[1], no[2]))
+    if tipo == NAO:
+        return (NAO, mapeia_atomos(no[1], funcao))
+    return (tipo, tuple(mapeia_atomos(filho, funcao) for filho in no[1]))
+
+def quantidade_valores(valor):
+    '''
+    Quantidade de valores de um parametro com multiplos valores (lista), ou
+    None se o valor for unico.
+    '''
+    if isinstance(valor, list):
+        return len(valor)
+    return None
+
+def forma(no):
+    '''
+    Retorna a forma da expressao: a arvore sem os valores, que sao
+    substituidos pela sua quantidade. Expressoes com a mesma forma
+    compartilham o mesmo plano de consulta.
+    '''
+    return mapeia_atomos(no, lambda param, valor: quantidade_valores(valor))
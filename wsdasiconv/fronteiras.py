@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo fronteiras.py da API de dados abertos do SICONV.
+=======================================================
+
+© 2011-2013 Ministério do Planejamento, Orçamento e Gestão
+
+Este arquivo e parte do webservice de dados abertos do SICONV,
+o Sistema de Cadastro de Convênios e Contratos de Repasse.
+
+A documentacao esta disponível em http://api.convenios.gov.br/siconv/doc/
+
+O webservice de dados abertos do SICONV é um software livre; você pode
+redistribui-lo e/ou modifica-lo dentro dos termos da Licença Pública Geral
+Affero GNU como publicada pela Fundação do Software Livre (FSF); na versão 3
+da Licença, ou (na sua opnião) qualquer versão subsequente.
+
+Este programa é distribuido na esperança que possa ser  util,
+mas SEM NENHUMA GARANTIA; sem uma garantia implicita de ADEQUAÇÂO a qualquer
+MERCADO ou APLICAÇÃO EM PARTICULAR. Veja a
+Licença Pública Geral Affero GNU para maiores detalhes.
+
+http://www.gnu.org/licenses/agpl-3.0.html
+"""
+
+from bisect import bisect_right
+from threading import Lock
+
+from sqlalchemy import select, and_
+from sqlalchemy.engine import reflection
+from sqlalchemy.orm import Session as SessaoBase
+
+from model import fronteiras_offset
+from paginacao import codifica_cursor
+from contagem import geracao_carga, cache_contagem, CacheContagem
+from contagem import MarcadorCarga
+from planos import PlanoConsulta
+
+# intervalo, em registros, entre as fronteiras
+INTERVALO_FRONTEIRAS = 500
+
+# listagens filtradas: as fronteiras so sao montadas sob demanda (percorrendo
+# as chaves da consulta) se o total de registros ja contado nao passar disto
+MAX_REGISTROS_SOB_DEMANDA = 100000
+
+def nome_ordem(ordem):
+    '''
+    Representa a ordenacao (nome, decrescente) como no parametro 'ordem'
+    ('' para a ordenacao padrao, pela chave primaria).
+    '''
+    if ordem is None:
+        return u""
+    nome, decrescente = ordem
+    return (u"-" if decrescente else u"") + nome
+
+def ordens(metodo):
+    '''
+    Retorna as ordenacoes das listagens do metodo: a padrao e as colunas
+    de ordenacao do modelo (__ordenacoes__), crescentes e decrescentes.
+    '''
+    resultado = [None]
+    for nome in getattr(metodo.model_class, '__ordenacoes__', []):
+        resultado.extend([(nome, False), (nome, True)])
+    return resultado
+
+def monta_fronteiras(plano, session, valores, intervalo=INTERVALO_FRONTEIRAS):
+    '''
+    Percorre as chaves da consulta do plano e retorna a lista das
+    fronteiras (posicao, cursor), em ordem crescente de posicao.
+    '''
+    ordem = nome_ordem(plano.ordem)
+    return [(posicao, codifica_cursor(chave, posicao, ordem or None))
+        for posicao, chave in plano.fronteiras(session, valores, intervalo)]
+
+class CacheFronteiras(object):
+    """Armazena as fronteiras por listagem (metodo, filtros e ordenacao).
+
+    Como as contagens (ver contagem.CacheContagem), as fronteiras valem ate
+    o termino da proxima carga noturna (a mudanca do marcador da carga),
+    quando sao descartadas. So sao guardadas as fronteiras calculadas nos
+    dados da carga atual (ver guarda).
+    """
+
+    max_entradas = 1000
+
+    def __init__(self):
+        self.entradas = {}
+        self.geracao = geracao_carga()
+        self.lock = Lock()
+
+    def _confere_geracao(self):
+        geracao = geracao_carga()
+        if geracao != self.geracao:
+            self.entradas.clear()
+            self.geracao = geracao
+
+    def obtem(self, chave):
+        with self.lock:
+            self._confere_geracao()
+            return self.entradas.get(chave, None)
+
+    def guarda(self, chave, fronteiras, geracao):
+        '''
+        Guarda as fronteiras calculadas nos dados da carga geracao, exceto
+        se o marcador da carga tiver mudado desde entao.
+        '''
+        with self.lock:
+            self._confere_geracao()
+            if geracao != self.geracao:
+                return
+            if len(self.entradas) >= self.max_entradas:
+                self.entradas.clear()
+            self.entradas[chave] = fronteiras
+
+    def invalida(self):
+        with self.lock:
+            self.entradas.clear()
+            self.geracao = geracao_carga()
+
+cache_fronteiras = CacheFronteiras()
+
+def le_fronteiras(session, metodo, ordem):
+    '''
+    Le da tabela as fronteiras da listagem sem filtros do metodo na
+    ordenacao informada (ver nome_ordem). Retorna o marcador da carga em
+    cujos dados as fronteiras foram calculadas e a lista das fronteiras.
+    Sem a tabela, nao ha fronteiras.
+    '''
+    conn = session.connection()
+    if not conn.dialect.has_table(conn, fronteiras_offset.name):
+        return None, []
+    tabela = fronteiras_offset.c
+    linhas = conn.execute(select(
+        [tabela.posicao, tabela.cursor, tabela.geracao],
+        and_(tabela.metodo == metodo, tabela.ordem == ordem),
+        order_by=[tabela.posicao])).fetchall()
+    if not linhas:
+        return None, []
+    return linhas[0][2], [(posicao, cursor) for posicao, cursor, g in linhas]
+
+def procura(fronteiras, offset):
+    '''
+    Retorna a fronteira (posicao, cursor) mais proxima que nao ultrapassa
+    o offset, ou None.
+    '''
+    n = bisect_right([posicao for posicao, cursor in fronteiras], offset)
+    return fronteiras[n - 1] if n else None
+
+def fronteira_offset(metodo, plano, session, valores):
+    '''
+    Retorna a fronteira (posicao, cursor) a partir da qual a pagina do
+    offset do metodo pode ser lida por seek, deslocando-se apenas
+    offset - posicao registros, ou None se nao houver.
+
+    As listagens sem filtros usam as fronteiras gravadas na tabela apos a
+    carga, se foram calculadas nos dados da carga atual (o marcador gravado
+    com elas e' o atual); as filtradas, as montadas sob demanda, se o total
+    de registros ja contado for pequeno (MAX_REGISTROS_SOB_DEMANDA).
+    '''
+    if metodo.offset < INTERVALO_FRONTEIRAS:
+        return None
+    ordem = nome_ordem(metodo.ordem)
+    filtros = CacheContagem.chave((metodo.id, plano.expressao), valores)
+    chave = (filtros, ordem)
+    geracao = geracao_carga()
+    fronteiras = cache_fronteiras.obtem(chave)
+    if fronteiras is None:
+        if not plano.criterios:
+            gravada, fronteiras = le_fronteiras(session, metodo.id, ordem)
+            if gravada != geracao:
+                # fronteiras ausentes ou de outra carga (a tabela ainda nao
+                # foi regravada): offset simples, ate que sejam regravadas
+                return None
+        else:
+            total = cache_contagem.obtem(filtros)
+            if total is None or total > MAX_REGISTROS_SOB_DEMANDA:
+                return None
+            fronteiras = monta_fronteiras(plano, session, valores)
+        cache_fronteiras.guarda(chave, fronteiras, geracao)
+    return procura(fronteiras, metodo.offset)
+
+def prepara_tabela(engine):
+    '''
+    Cria a tabela das fronteiras, se nao existir. A tabela de uma versao
+    anterior, sem todas as colunas atuais, e' recriada vazia (so desta vez).
+    '''
+    inspetor = reflection.Inspector.from_engine(engine)
+    if fronteiras_offset.name in inspetor.get_table_names():
+        colunas = set(coluna['name'] for coluna
+            in inspetor.get_columns(fronteiras_offset.name))
+        if colunas.issuperset(fronteiras_offset.c.keys()):
+            return
+        fronteiras_offset.drop(engine)
+    fronteiras_offset.create(engine)
+
+def reconstroi_fronteiras(engine, metodos, intervalo=INTERVALO_FRONTEIRAS):
+    '''
+    Regrava as fronteiras das listagens sem filtros dos metodos, em todas
+    as ordenacoes, com o marcador da carga atual. Deve ser executada apos
+    cada carga, depois do registro do seu termino (contagem.registra_carga).
+
+    Os processos do webservice nao precisam ser avisados: cada um confere
+    o marcador gravado com o atual antes de usar as fronteiras.
+    '''
+    geracao = MarcadorCarga(engine).atual()
+    prepara_tabela(engine)
+    tabela = fronteiras_offset
+    for metodo in metodos:
+        # uma transacao por metodo, sem travar a tabela: as consultas
+        # continuam lendo as fronteiras antigas do metodo ate o commit e
+        # entao passam a ler as novas
+        session = SessaoBase(bind=engine)
+        try:
+            session.execute(tabela.delete(tabela.c.metodo == metodo.id))
+            for ordem in ordens(metodo):
+                plano = PlanoConsulta(metodo, frozenset(), ordem=ordem)
+                fronteiras = monta_fronteiras(plano, session, {}, intervalo)
+                if not fronteiras:
+                    continue
+                session.execute(tabela.insert(), [{
+                    'metodo': metodo.id,
+                    'ordem': nome_ordem(ordem),
+                    'posicao': posicao,
+                    'cursor': cursor,
+                    'geracao': geracao,
+                } for posicao, cursor in fronteiras])
+            session.commit()
+        finally:
+            session.close()
+
+if __name__ == "__main__":
+    # reconstroi as fronteiras no banco informado, apos a carga:
+    # python -m wsdasiconv.fronteiras <url do banco>
+    from sys import argv
+    from wsdasiconv.webservice import consultas
+    from sqlalchemy import create_engine
+    reconstroi_fronteiras(create_engine(argv[1]), consultas)
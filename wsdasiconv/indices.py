@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo indices.py da API de dados abertos do SICONV.
+=======================================================
+
+© 2011-2013 Ministério do Planejamento, Orçamento e Gestão
+
+Este arquivo e parte do webservice de dados abertos do SICONV,
+o Sistema de Cadastro de Convênios e Contratos de Repasse.
+
+A documentacao esta disponível em http://api.convenios.gov.br/siconv/doc/
+
+O webservice de dados abertos do SICONV é um software livre; você pode
+redistribui-lo e/ou modifica-lo dentro dos termos da Licença Pública Geral
+Affero GNU como publicada pela Fundação do Software Livre (FSF); na versão 3
+da Licença, ou (na sua opnião) qualquer versão subsequente.
+
+Este programa é distribuido na esperança que possa ser  util,
+mas SEM NENHUMA GARANTIA; sem uma garantia implicita de ADEQUAÇÂO a qualquer
+MERCADO ou APLICAÇÃO EM PARTICULAR. Veja a
+Licença Pública Geral Affero GNU para maiores detalhes.
+
+http://www.gnu.org/licenses/agpl-3.0.html
+"""
+
+
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine import reflection
+from sqlalchemy.schema import CreateIndex
+
+def ddl_indices(indices, dialeto=None):
+    '''
+    Gera os comandos SQL que criam os indices informados (por padrao, no
+    dialeto do PostgreSQL).
+    '''
+    if dialeto is None:
+        dialeto = postgresql.dialect()
+    return [unicode(CreateIndex(indice).compile(dialect=dialeto)).strip()
+        for indice in indices]
+
+def indices_ausentes(engine, indices):
+    '''
+    Retorna os indices informados que ainda nao existem no banco de dados.
+    '''
+    inspetor = reflection.Inspector.from_engine(engine)
+    existentes = {}
+    ausentes = []
+    for indice in indices:
+        tabela = indice.table.name
+        if tabela not in existentes:
+            existentes[tabela] = set(info['name']
+                for info in inspetor.get_indexes(tabela))
+        if indice.name not in existentes[tabela]:
+            ausentes.append(indice)
+    return ausentes
+
+def cria_indices(engine, indices):
+    '''
+    Cria no banco de dados os indices informados que ainda nao existem.
+    Deve ser executada apos a criacao do esquema, ja que o create_all nao
+    acrescenta indices as tabelas existentes. Retorna os indices criados.
+    '''
+    ausentes = indices_ausentes(engine, indices)
+    for indice in ausentes:
+        indice.create(engine)
+    return ausentes
+
+if __name__ == "__main__":
+    # imprime o DDL dos indices de ordenacao das listagens (parametro
+    # 'ordem'), ou cria os ausentes no banco informado:
+    # python -m wsdasiconv.indices [url do banco]
+    from sys import argv
+    from wsdasiconv.model import indices_ordem
+    if len(argv) > 1:
+        from sqlalchemy import create_engine
+        for indice in cria_indices(create_engine(argv[1]), indices_ordem):
+            print u"criado: %s" % indice.name
+    else:
+        for comando in ddl_indices(indices_ordem):
+            print comando + ";"
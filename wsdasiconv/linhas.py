@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo linhas.py da API de dados abertos do SICONV.
+=======================================================
+
+© 2011-2013 Ministério do Planejamento, Orçamento e Gestão
+
+Este arquivo e parte do webservice de dados abertos do SICONV,
+o Sistema de Cadastro de Convênios e Contratos de Repasse.
+
+A documentacao esta disponível em http://api.convenios.gov.br/siconv/doc/
+
+O webservice de dados abertos do SICONV é um software livre; você pode
+redistribui-lo e/ou modifica-lo dentro dos termos da Licença Pública Geral
+Affero GNU como publicada pela Fundação do Software Livre (FSF); na versão 3
+da Licença, ou (na sua opnião) qualquer versão subsequente.
+
+Este programa é distribuido na esperança que possa ser  util,
+mas SEM NENHUMA GARANTIA; sem uma garantia implicita de ADEQUAÇÂO a qualquer
+MERCADO ou APLICAÇÃO EM PARTICULAR. Veja a
+Licença Pública Geral Affero GNU para maiores detalhes.
+
+http://www.gnu.org/licenses/agpl-3.0.html
+"""
+
+
+from sqlalchemy.orm import Query, aliased, class_mapper
+from sqlalchemy.orm.interfaces import MANYTOONE
+from sqlalchemy.orm.properties import RelationshipProperty
+
+from configuracao import sim
+from paginacao import chaves_primarias
+from carregamento import colunas_carregadas
+
+def relacionamento_juntavel(prop):
+    '''
+    Indica se o relacionamento pode ser lido por um LEFT OUTER JOIN na
+    consulta das linhas: muitos-para-um, sem tabela associativa.
+    '''
+    return isinstance(prop, RelationshipProperty) and \
+        prop.direction is MANYTOONE and not prop.uselist and \
+        prop.secondary is None
+
+def objeto_leve(cls, nomes, valores):
+    '''
+    Cria um objeto da classe mapeada com os valores das colunas, sem
+    passar pelo ORM (sem estado de instancia, sessao ou mapa de
+    identidade). Os atributos mapeados presentes no __dict__ sao lidos
+    diretamente pelos descritores do SQLAlchemy, e as propriedades do
+    modelo funcionam como nos objetos carregados pela sessao.
+    '''
+    obj = cls.__new__(cls)
+    obj.__dict__.update(zip(nomes, valores))
+    return obj
+
+class Relacionado(object):
+    """Um relacionamento muitos-para-um lido na consulta das linhas: as
+    colunas da classe relacionada (as mesmas de um joinedload) e a posicao
+    delas na linha.
+    """
+    __slots__ = ('chave', 'classe', 'nomes', 'inicio', 'fim', 'chaves')
+
+    def __init__(self, chave, classe, inicio):
+        self.chave = chave
+        self.classe = classe
+        self.nomes = tuple(colunas_carregadas(classe))
+        self.inicio = inicio
+        self.fim = inicio + len(self.nomes)
+        # posicoes da chave primaria: sem ela, nao ha objeto relacionado
+        self.chaves = tuple(self.nomes.index(nome)
+            for nome in chaves_primarias(classe))
+
+    def objeto(self, linha):
+        valores = linha[self.inicio:self.fim]
+        if all(valores[n] is None for n in self.chaves):
+            return None
+        return objeto_leve(self.classe, self.nomes, valores)
+
+class PlanoLinhas(object):
+    """Leitura das listagens em linhas (tuplas de colunas), sem a
+    hidratacao dos objetos pelo ORM.
+
+    A consulta traz as mesmas colunas que a consulta de objetos do plano
+    (as necessarias aos campos e as chaves) e, para cada relacionamento
+    muitos-para-um usado, as colunas da classe relacionada, por LEFT OUTER
+    JOIN. Cada linha vira um objeto leve da classe do modelo (ver
+    objeto_leve), com os relacionados tambem leves, de modo que os
+    serializadores e as propriedades do modelo nao mudam.
+    """
+
+    def __init__(self, cls, necessarios, relacionamentos):
+        self.cls = cls
+        self.nomes = tuple(colunas_carregadas(cls, necessarios))
+        entidades = [getattr(cls, nome) for nome in self.nomes]
+        self.juncoes = []
+        self.relacionados = []
+        for chave in relacionamentos:
+            prop = class_mapper(cls).get_property(chave)
+            relacionado = Relacionado(chave, prop.mapper.class_,
+                len(entidades))
+            alvo = aliased(relacionado.classe)
+            entidades.extend(getattr(alvo, nome) for nome in relacionado.nomes)
+            self.juncoes.append((alvo, getattr(cls, chave)))
+            self.relacionados.append(relacionado)
+        self.entidades = entidades
+        self.quantidade = len(self.nomes)
+
+    def consulta(self, criterios, ordenacao):
+        '''
+        Retorna a consulta das linhas com os criterios de filtro e a
+        ordenacao do plano de consulta.
+        '''
+        q = Query(self.entidades)
+        for alvo, relacionamento in self.juncoes:
+            q = q.outerjoin(alvo, relacionamento)
+        for criterio in criterios:
+            q = q.filter(criterio)
+        return q.order_by(*ordenacao)
+
+    def objeto(self, linha):
+        '''
+        Retorna o objeto leve da linha lida pela consulta.
+        '''
+        obj = objeto_leve(self.cls, self.nomes, linha[:self.quantidade])
+        for relacionado in self.relacionados:
+            obj.__dict__[relacionado.chave] = relacionado.objeto(linha)
+        return obj
+
+def plano_linhas(cls, necessarios, carregamento):
+    '''
+    Retorna o plano de leitura em linhas da consulta, ou None se os
+    objetos precisarem do ORM: campos sem dependencias conhecidas
+    (necessarios None), colecoes ou caminhos de mais de um relacionamento
+    no plano de carregamento.
+    '''
+    if usa_orm or necessarios is None:
+        return None
+    mapper = class_mapper(cls)
+    relacionamentos = []
+    for caminho, estrategia in carregamento:
+        if estrategia != 'joined' or '.' in caminho or \
+                not relacionamento_juntavel(mapper.get_property(caminho)):
+            return None
+        relacionamentos.append(caminho)
+    # relacionamentos necessarios fora do plano de carregamento seriam
+    # lidos sob demanda (lazy loading), o que exige o ORM
+    for nome in necessarios:
+        if isinstance(mapper.get_property(nome), RelationshipProperty) and \
+                nome not in relacionamentos:
+            return None
+    return PlanoLinhas(cls, necessarios, relacionamentos)
+
+# formatos servidos pelas linhas; os demais (HTML e RDF), cujos templates
+# e mapeamentos podem usar outros atributos do modelo, usam o ORM
+formatos_linhas = ('json', 'xml', 'csv')
+
+# carrega sempre os objetos pelo ORM nas listagens. Definido na
+# inicializacao da aplicacao por configura_linhas.
+usa_orm = False
+
+def configura_linhas(settings):
+    '''
+    Escolhe a leitura das listagens a partir do .ini: 'consulta.orm = sim'
+    volta a carregar sempre os objetos pelo ORM.
+    '''
+    global usa_orm
+    usa_orm = sim(settings.get('consulta.orm'))
+    return usa_orm
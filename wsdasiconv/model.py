@@ -29,13 +29,14 @@ from serializer import ExposedObject
 
 # sqlalchemy
 from sqlalchemy.orm import sessionmaker, scoped_session
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm import relationship, backref, column_property
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.ext.declarative import declarative_base, synonym_for
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy import MetaData, ForeignKey, ForeignKeyConstraint, or_
 from sqlalchemy import Table, Column, Integer, BigInteger, SmallInteger
-from sqlalchemy import Numeric, Date, Unicode, Boolean
+from sqlalchemy import Numeric, Date, DateTime, Unicode, Boolean
+from sqlalchemy import Index, func
 from geoalchemy import GeometryDDL, GeometryColumn, Point
 from geoalchemy.postgis import PGComparator
 from shapely import wkb
@@ -59,8 +60,20 @@ def limita_tamanho(s, tamanho):
     s = unicode(s)
     return s if (len(s) < tamanho) else s[:(tamanho - 5)].rsplit(u" ", 1)[0] + u" ..."
 
+# tamanho dos textos resumidos das consultas coletivas
+TAMANHO_RESUMO = 140
+
+def inicio_texto(coluna, tamanho=TAMANHO_RESUMO):
+    '''
+    Atributo com os primeiros caracteres do texto da coluna, calculados
+    pelo banco de dados (substr). Bastam para limita_tamanho(texto, tamanho),
+    sem trazer o texto completo do banco.
+    '''
+    return column_property(func.substr(coluna, 1, tamanho, type_=Unicode),
+        deferred=True)
+
 def date(date_str):
-    return _date.fromtimestamp(_datetime.strptime(date_str, "%Y-%m-%d"))
+    return _datetime.strptime(date_str, "%Y-%m-%d").date()
 
 class Municipio(Base):
     u"""Representa um município.
@@ -94,6 +107,14 @@ class Municipio(Base):
     __expostos__ = set(["nome", "uf", "cod_siconv",
         'href_proponentes'])
     __resumidos__ = __expostos__
+    # atributos mapeados usados pelos atributos derivados
+    __dependencias__ = {
+        'cod_siconv': ['id'],
+        'regiao': ['_regiao'],
+        'uf': ['_uf', 'uf_nome', '_regiao'],
+    }
+    # colunas aceitas no parametro 'ordem' (indexadas junto com a chave)
+    __ordenacoes__ = ['nome']
     id = Column(Integer, autoincrement=False, primary_key=True)
     nome = Column(Unicode(60))
     _uf = Column("uf", Unicode(2))
@@ -224,6 +245,15 @@ class Proponente(Base):
         'inscricao_estadual', 'inscricao_municipal',
     ]
     
+    # atributos mapeados usados pelos atributos derivados
+    __dependencias__ = {
+        'cpf_responsavel': ['pessoa_responsavel'],
+        'propostas': ['propostas_como_proponente', 'propostas_como_executor'],
+        'cnpj': ['id'],
+    }
+    
+    # colunas aceitas no parametro 'ordem' (indexadas junto com a chave)
+    __ordenacoes__ = ['nome']
     id = Column(BigInteger, autoincrement=False, primary_key=True)
     nome = Column(Unicode(300))
     id_esfera_administrativa = Column(Integer, ForeignKey('esfera_administrativa.id'))
@@ -410,7 +440,13 @@ class Orgao(Base):
         'href_programas_como_executor',
         'href_habilitacoes',
     ]
+    # atributos mapeados usados pelos atributos derivados
+    __dependencias__ = {
+        'cod_siasg': ['id'],
+    }
     
+    # colunas aceitas no parametro 'ordem' (indexadas junto com a chave)
+    __ordenacoes__ = ['nome']
     id = Column(Integer, autoincrement=False, primary_key=True)
     nome = Column(Unicode(100))
     id_orgao_superior = Column(Integer, ForeignKey('orgao.id'))
@@ -625,6 +661,36 @@ class Proposta(Base):
         #'cpf_pessoa_responsavel_pelo_envio',
     ]
     
+    # atributos mapeados usados pelos atributos derivados
+    __dependencias__ = {
+        'situacao': ['_situacao'],
+        'modalidade': ['_modalidade'],
+        'numero_proposta': ['sequencial', 'ano'],
+        'justificativa_resumida': ['_justificativa_inicio'],
+        'objeto_resumido': ['_objeto_inicio'],
+        'programas': ['_programas.programa'],
+        'cpf_pessoa_responsavel_pelo_concedente': ['pessoa_responsavel_pelo_concedente'],
+        'cpf_pessoa_responsavel_pelo_cadastramento': ['pessoa_responsavel_pelo_cadastramento'],
+        'cpf_pessoa_responsavel_pelo_envio': ['pessoa_responsavel_pelo_envio'],
+    }
+    
+    # colunas aceitas no parametro 'ordem' (indexadas junto com a chave)
+    __ordenacoes__ = [
+        'valor_global',
+        'valor_repasse',
+        'data_envio_proposta',
+        'data_cadastramento_proposta',
+    ]
+    # dimensoes aceitas no parametro 'agrupar_por' das agregacoes
+    __agrupamentos__ = {
+        'uf': 'proponente.municipio._uf',
+        'regiao': 'proponente.municipio._regiao',
+        'id_orgao_concedente': 'id_orgao_concedente',
+        'id_modalidade': 'id_modalidade',
+        'id_situacao': 'id_situacao',
+        'ano': 'ano',
+        'ano_envio': 'data_envio_proposta.ano',
+    }
     id = Column(BigInteger(), autoincrement=False, primary_key=True)
     sequencial = Column(Integer())
     inicio_execucao = Column(Date())
@@ -645,6 +711,10 @@ class Proposta(Base):
     
     capacidade_tecnica = Column(Unicode(5000))
     
+    # inicio dos textos longos, usado nos atributos resumidos
+    _justificativa_inicio = inicio_texto(justificativa)
+    _objeto_inicio = inicio_texto(objeto)
+    
     agencia_bancaria = Column(Unicode(10))
     conta_bancaria = Column(Unicode(20))
     nome_banco = Column(Unicode(50))
@@ -707,10 +777,10 @@ class Proposta(Base):
         return u"%d/%d" % (self.sequencial, self.ano)
     @property
     def justificativa_resumida(self):
-        return limita_tamanho(self.justificativa, 140)
+        return limita_tamanho(self._justificativa_inicio, TAMANHO_RESUMO)
     @property
     def objeto_resumido(self):
-        return limita_tamanho(self.objeto, 140)
+        return limita_tamanho(self._objeto_inicio, TAMANHO_RESUMO)
     @property
     def programas(self):
         programas = []
@@ -781,6 +851,40 @@ class Convenio(Base):
         'proponente',
     ]
     
+    # atributos mapeados usados pelos atributos derivados
+    __dependencias__ = {
+        'numero_convenio': ['id'],
+        'situacao': ['_situacao'],
+        'subsituacao': ['_subsituacao'],
+        'situacao_publicacao': ['_situacao_publicacao'],
+        'modalidade': ['_modalidade'],
+        'justificativa_resumida': ['_justificativa_inicio'],
+        'objeto_resumido': ['_objeto_inicio'],
+        'cpf_pessoa_responsavel_como_concedente': ['pessoa_responsavel_como_concedente'],
+        'programas': ['_programas.programa'],
+    }
+    
+    # colunas aceitas no parametro 'ordem' (indexadas junto com a chave)
+    __ordenacoes__ = [
+        'valor_global',
+        'valor_repasse',
+        'data_assinatura',
+        'data_publicacao',
+        'data_inicio_vigencia',
+        'data_fim_vigencia',
+    ]
+    # dimensoes aceitas no parametro 'agrupar_por' das agregacoes
+    __agrupamentos__ = {
+        'uf': 'proponente.municipio._uf',
+        'regiao': 'proponente.municipio._regiao',
+        'id_municipio': 'proponente.id_municipio',
+        'id_orgao_concedente': 'id_orgao_concedente',
+        'id_modalidade': 'id_modalidade',
+        'id_situacao': 'id_situacao',
+        'ano_assinatura': 'data_assinatura.ano',
+        'mes_assinatura': 'data_assinatura.mes',
+        'ano_publicacao': 'data_publicacao.ano',
+    }
     id = Column(BigInteger(), autoincrement=False, primary_key=True) # numero do convenio
     data_inicio_vigencia = Column(Date()) # = inicio_execucao da classe Proposta
     data_fim_vigencia = Column(Date())    # = fim_execucao da classe Proposta
@@ -801,6 +905,10 @@ class Convenio(Base):
     
     capacidade_tecnica = Column(Unicode(5000))
     
+    # inicio dos textos longos, usado nos atributos resumidos
+    _justificativa_inicio = inicio_texto(justificativa)
+    _objeto_inicio = inicio_texto(objeto)
+    
     agencia_bancaria = Column(Unicode(10))
     conta_bancaria = Column(Unicode(20))
     nome_banco = Column(Unicode(50))
@@ -884,10 +992,10 @@ class Convenio(Base):
         return self._situacao_projeto_basico
     @property
     def justificativa_resumida(self):
-        return limita_tamanho(self.justificativa, 140)
+        return limita_tamanho(self._justificativa_inicio, TAMANHO_RESUMO)
     @property
     def objeto_resumido(self):
-        return limita_tamanho(self.objeto, 140)
+        return limita_tamanho(self._objeto_inicio, TAMANHO_RESUMO)
     @property
     def cpf_pessoa_responsavel_como_concedente(self):
         return self.pessoa_responsavel_como_concedente.cpf
@@ -950,7 +1058,14 @@ class Programa(Base):
         'href_convenios',
     ]
     __resumidos__ = __expostos__
+    # atributos mapeados usados pelos atributos derivados
+    __dependencias__ = {
+        'codigo': ['id'],
+        'ufs_habilitadas': ['estados_habilitados'],
+    }
     
+    # colunas aceitas no parametro 'ordem' (indexadas junto com a chave)
+    __ordenacoes__ = ['nome', 'data_disponibilizacao', 'data_publicacao_dou']
     id = Column(BigInteger(), autoincrement=False, primary_key=True)
     cod_programa_siconv = Column(Unicode(18))
     nome = Column(Unicode(255))
@@ -1037,6 +1152,13 @@ class Emenda(Base):
     ]
     __resumidos__ = __expostos__
     
+    # colunas aceitas no parametro 'ordem' (indexadas junto com a chave)
+    __ordenacoes__ = ['valor']
+    # dimensoes aceitas no parametro 'agrupar_por' das agregacoes
+    __agrupamentos__ = {
+        'id_programa': 'id_programa',
+        'id_orgao_superior': 'programa.id_orgao_superior',
+    }
     id_programa = Column(BigInteger(), ForeignKey('programa.id'),
         primary_key=True)
     numero = Column(BigInteger(), autoincrement=False, primary_key=True)
@@ -1076,6 +1198,17 @@ class OrdemBancaria(Base):
         'justificativa_inadimplencia',
     ]
     
+    # colunas aceitas no parametro 'ordem' (indexadas junto com a chave)
+    __ordenacoes__ = ['data', 'valor']
+    # dimensoes aceitas no parametro 'agrupar_por' das agregacoes
+    __agrupamentos__ = {
+        'id_convenio': 'id_convenio',
+        'uf': 'convenio.proponente.municipio._uf',
+        'situacao': 'situacao',
+        'tipo_documento': 'tipo_documento',
+        'ano': 'data.ano',
+        'mes': 'data.mes',
+    }
     id = Column(BigInteger(), autoincrement=False, primary_key=True)
     numero = Column(Unicode())
     id_unidade_emitente = Column(BigInteger())#, ForeignKey('unidade_emitente.id'))
@@ -1150,6 +1283,18 @@ class Empenho(Base):
     ]
     __resumidos__ = __expostos__
     
+    # colunas aceitas no parametro 'ordem' (indexadas junto com a chave)
+    __ordenacoes__ = ['data_emissao', 'valor']
+    # dimensoes aceitas no parametro 'agrupar_por' das agregacoes
+    __agrupamentos__ = {
+        'id_convenio': 'id_convenio',
+        'id_especie': 'id_especie',
+        'uf': 'proponente_favorecido.municipio._uf',
+        'esfera_orcamentaria': 'esfera_orcamentaria',
+        'situacao': 'situacao',
+        'ano_emissao': 'data_emissao.ano',
+        'mes_emissao': 'data_emissao.mes',
+    }
     id = Column(BigInteger(), autoincrement=False, primary_key=True)
     numero = Column(Unicode()) # contem caracteres qualificadores alfabeticos
     numero_minuta = Column(Unicode())
@@ -1378,6 +1523,10 @@ class HabilitacaoAreaAtuacao(Base):
         'data_vencimento',
     ]
     __resumidos__ = __expostos__
+    # atributos mapeados usados pelos atributos derivados
+    __dependencias__ = {
+        'cpf_responsavel': ['pessoa_responsavel'],
+    }
     
     id = Column(BigInteger(), autoincrement=False, primary_key=True)
     id_subarea = Column(BigInteger(),
@@ -1402,6 +1551,41 @@ class HabilitacaoAreaAtuacao(Base):
     def cpf_responsavel(self):
         return self.pessoa_responsavel.cpf
 
+# indices que atendem a ordenacao das listagens (parametro 'ordem'),
+# seguida da chave primaria como desempate. Nas tabelas ja existentes,
+# sao criados por python -m wsdasiconv.indices (ver indices.py)
+def indices_ordenacao(cls):
+    tabela = cls.__table__
+    indices = []
+    for nome in getattr(cls, '__ordenacoes__', []):
+        coluna = getattr(cls, nome).property.columns[0]
+        indices.append(Index("ix_%s_%s_ordem" % (tabela.name, coluna.name),
+            coluna, *tabela.primary_key.columns))
+    return indices
+
+indices_ordem = []
+for cls in Base.__subclasses__():
+    indices_ordem.extend(indices_ordenacao(cls))
+
+# marcador da carga noturna: o horario de termino da carga mais recente,
+# gravado pela propria carga ao terminar (ver contagem.registra_carga)
+carga_dados = Table('carga_dados', Base.metadata,
+    Column('id', Integer, primary_key=True, autoincrement=False),
+    Column('termino', DateTime, nullable=False),
+)
+
+# fronteiras da paginacao por offset das listagens sem filtros: a cada
+# intervalo de registros, o cursor (chave) do registro na posicao, e o
+# marcador da carga (ver carga_dados) dos dados em que foram calculadas.
+# Reconstruidas apos cada carga (ver fronteiras.py)
+fronteiras_offset = Table('fronteira_offset', Base.metadata,
+    Column('metodo', Unicode(100), primary_key=True),
+    Column('ordem', Unicode(100), primary_key=True),
+    Column('posicao', Integer, primary_key=True, autoincrement=False),
+    Column('cursor', Unicode(1000), nullable=False),
+    Column('geracao', DateTime, nullable=False),
+)
+
 # incializacao do banco
 def initialize_sql(engine):
     Session.configure(bind=engine)
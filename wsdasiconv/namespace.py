@@ -21,6 +21,7 @@ DBONT = Namespace('http://dbpedia.org/ontology/')
 VOID = Namespace('http://rdfs.org/ns/void#')
 FOAF = Namespace('http://xmlns.com/foaf/0.1/')
 VCARD = Namespace('http://www.w3.org/2006/vcard/ns#')
+QB = Namespace('http://purl.org/linked-data/cube#')
 
 # mapeamentos da DBPedia
 dbpedia_estados = {
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo paginacao.py da API de dados abertos do SICONV.
+=======================================================
+
+© 2011-2013 Ministério do Planejamento, Orçamento e Gestão
+
+Este arquivo e parte do webservice de dados abertos do SICONV,
+o Sistema de Cadastro de Convênios e Contratos de Repasse.
+
+A documentacao esta disponível em http://api.convenios.gov.br/siconv/doc/
+
+O webservice de dados abertos do SICONV é um software livre; você pode
+redistribui-lo e/ou modifica-lo dentro dos termos da Licença Pública Geral
+Affero GNU como publicada pela Fundação do Software Livre (FSF); na versão 3
+da Licença, ou (na sua opnião) qualquer versão subsequente.
+
+Este programa é distribuido na esperança que possa ser  util,
+mas SEM NENHUMA GARANTIA; sem uma garantia implicita de ADEQUAÇÂO a qualquer
+MERCADO ou APLICAÇÃO EM PARTICULAR. Veja a
+Licença Pública Geral Affero GNU para maiores detalhes.
+
+http://www.gnu.org/licenses/agpl-3.0.html
+"""
+
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from sqlalchemy import and_, or_, tuple_
+from sqlalchemy import Date, DateTime, Numeric
+from sqlalchemy.orm import class_mapper
+
+def chaves_primarias(cls):
+    '''
+    Retorna os nomes dos atributos mapeados para a chave primaria da classe,
+    na ordem das colunas da chave.
+    '''
+    mapper = class_mapper(cls)
+    return [mapper.get_property_by_column(col).key for col in mapper.primary_key]
+
+def valores_chave(obj, chaves):
+    '''
+    Retorna os valores dos atributos de chave de um objeto.
+    '''
+    return [getattr(obj, chave) for chave in chaves]
+
+def valor_cursor(valor):
+    '''
+    Converte o valor de uma coluna para inclusao no cursor (JSON).
+    '''
+    if isinstance(valor, (date, datetime)):
+        return valor.isoformat()
+    if isinstance(valor, Decimal):
+        return str(valor)
+    return valor
+
+def valor_coluna(atributo, valor):
+    '''
+    Converte um valor lido do cursor de volta para o tipo da coluna do
+    atributo. Levanta ValueError se o valor nao for do tipo esperado.
+    '''
+    if valor is None:
+        return None
+    tipo = atributo.property.columns[0].type
+    try:
+        if isinstance(tipo, DateTime):
+            return datetime.strptime(valor, "%Y-%m-%dT%H:%M:%S")
+        if isinstance(tipo, Date):
+            return datetime.strptime(valor, "%Y-%m-%d").date()
+        if isinstance(tipo, Numeric):
+            return Decimal(valor)
+    except (TypeError, ValueError, InvalidOperation):
+        raise ValueError(u"O cursor informado é inválido: valor '%s'." % valor)
+    return valor
+
+def codifica_cursor(valores, posicao, ordem=None):
+    '''
+    Gera o cursor opaco da proxima pagina.
+
+    valores: valores da chave do ultimo registro da pagina atual
+        (precedidos do valor da coluna de ordenacao, se houver)
+    posicao: quantidade de registros ja percorridos ate esse registro
+    ordem: ordenacao da consulta (parametro 'ordem'), se houver
+    '''
+    dados = {'k': [valor_cursor(valor) for valor in valores], 'p': posicao}
+    if ordem:
+        dados['o'] = ordem
+    texto = json.dumps(dados, separators=(',', ':'))
+    return urlsafe_b64encode(texto).rstrip('=')
+
+def decodifica_cursor(cursor):
+    '''
+    Decodifica um cursor gerado por codifica_cursor.
+
+    Retorna uma tupla (valores, posicao, ordem). Levanta ValueError se o
+    cursor nao for valido.
+    '''
+    try:
+        texto = str(cursor)
+        texto = urlsafe_b64decode(texto + '=' * (-len(texto) % 4))
+        dados = json.loads(texto)
+        valores, posicao = dados['k'], int(dados['p'])
+        ordem = dados.get('o', None)
+    except (TypeError, ValueError, KeyError, UnicodeError, AttributeError):
+        raise ValueError(u"O cursor informado é inválido: '%s'." % cursor)
+    if not isinstance(valores, list) or posicao < 0:
+        raise ValueError(u"O cursor informado é inválido: '%s'." % cursor)
+    return valores, posicao, ordem
+
+def predicado_seek(atributos, valores, decrescente=False):
+    '''
+    Monta o criterio que seleciona os registros posteriores aos valores de
+    chave informados, na ordenacao crescente (ou decrescente) dos atributos.
+
+    Para chaves compostas, a comparacao e' lexicografica, precedida de um
+    limite redundante na primeira coluna, que permite ao banco de dados
+    percorrer o indice a partir do valor (range scan) em vez de filtrar a
+    tabela toda:
+    a >= va AND ((a > va) OR (a = va AND b > vb) OR ...)
+    '''
+    if len(atributos) != len(valores):
+        raise ValueError(u"O cursor informado não corresponde à chave da consulta.")
+    alternativas = []
+    for n, atributo in enumerate(atributos):
+        iguais = [atributos[i] == valores[i] for i in range(n)]
+        posterior = atributo < valores[n] if decrescente else atributo > valores[n]
+        alternativas.append(and_(*(iguais + [posterior])))
+    if len(alternativas) == 1:
+        return alternativas[0]
+    return and_(limite_inicial(atributos[0], valores[0], decrescente),
+        or_(*alternativas))
+
+def limite_inicial(atributo, valor, decrescente=False):
+    '''
+    Limite redundante (atributo >= valor, ou <= na ordem decrescente) que
+    antecede as alternativas de um criterio de seek.
+    '''
+    return atributo <= valor if decrescente else atributo >= valor
+
+def nulos_maiores(dialeto):
+    '''
+    Indica se o banco de dados ordena os valores nulos como maiores que
+    os demais (PostgreSQL e Oracle) ou como menores (SQLite, MySQL e
+    SQL Server).
+    '''
+    return dialeto.name in ('postgresql', 'oracle')
+
+def predicado_seek_ordenado(atributo, decrescente, valor, atributos_chave,
+        valores_chave, nulos_maiores=True):
+    '''
+    Monta o criterio que seleciona os registros posteriores ao ultimo
+    registro visto, numa consulta ordenada pelo atributo e, em caso de
+    empate, pela chave primaria, na mesma direcao.
+
+    Os nulos do atributo ficam no fim ou no inicio da ordenacao conforme o
+    banco de dados (ver nulos_maiores).
+
+    Os valores nao nulos posteriores sao precedidos de um limite redundante
+    no atributo (ver limite_inicial), para que o banco de dados percorra o
+    indice (atributo, chave) a partir do valor. Os nulos ficam numa
+    alternativa separada.
+    '''
+    seek_chave = predicado_seek(atributos_chave, valores_chave, decrescente)
+    # os nulos vem depois dos demais valores nesta direcao de ordenacao?
+    nulos_depois = (nulos_maiores != decrescente)
+    if valor is None:
+        if nulos_depois:
+            return and_(atributo == None, seek_chave)
+        return or_(and_(atributo == None, seek_chave), atributo != None)
+    posterior = atributo < valor if decrescente else atributo > valor
+    nao_nulos = and_(limite_inicial(atributo, valor, decrescente),
+        or_(posterior, and_(atributo == valor, seek_chave)))
+    if nulos_depois:
+        return or_(nao_nulos, atributo == None)
+    return nao_nulos
+
+def predicado_chaves(atributos, chaves, dialeto):
+    '''
+    Monta o criterio que seleciona os registros cujas chaves estao na lista
+    informada (cada chave e' uma tupla com um valor por atributo).
+
+    Chaves simples usam IN; chaves compostas usam IN sobre tuplas nos bancos
+    que o suportam e, nos demais, uma disjuncao de igualdades.
+    '''
+    if len(atributos) == 1:
+        return atributos[0].in_([chave[0] for chave in chaves])
+    if dialeto.name in ('postgresql', 'mysql', 'oracle'):
+        return tuple_(*atributos).in_(chaves)
+    return or_(*[and_(*[atributo == valor
+        for atributo, valor in zip(atributos, chave)]) for chave in chaves])
@@ -0,0 +1,470 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo planos.py da API de dados abertos do SICONV.
+=======================================================
+
+© 2011-2013 Ministério do Planejamento, Orçamento e Gestão
+
+Este arquivo e parte do webservice de dados abertos do SICONV,
+o Sistema de Cadastro de Convênios e Contratos de Repasse.
+
+A documentacao esta disponível em http://api.convenios.gov.br/siconv/doc/
+
+O webservice de dados abertos do SICONV é um software livre; você pode
+redistribui-lo e/ou modifica-lo dentro dos termos da Licença Pública Geral
+Affero GNU como publicada pela Fundação do Software Livre (FSF); na versão 3
+da Licença, ou (na sua opnião) qualquer versão subsequente.
+
+Este programa é distribuido na esperança que possa ser  util,
+mas SEM NENHUMA GARANTIA; sem uma garantia implicita de ADEQUAÇÂO a qualquer
+MERCADO ou APLICAÇÃO EM PARTICULAR. Veja a
+Licença Pública Geral Affero GNU para maiores detalhes.
+
+http://www.gnu.org/licenses/agpl-3.0.html
+"""
+
+
+import operator
+from itertools import count
+from threading import Lock
+
+from sqlalchemy import select, bindparam, and_, or_, not_
+from sqlalchemy import func as sqlfunc
+from sqlalchemy.orm import Query, aliased
+from sqlalchemy.orm.interfaces import MANYTOONE
+from sqlalchemy.orm.properties import RelationshipProperty
+
+from paginacao import chaves_primarias, valores_chave
+from paginacao import predicado_seek, predicado_seek_ordenado, nulos_maiores
+from busca import compara_texto
+from carregamento import atributos_necessarios, opcoes_adiamento
+from carregamento import plano_carregamento, opcoes_carregamento
+from carregamento import carrega_colecoes
+from expressoes import OU, NAO, atomos, forma, quantidade_valores
+from linhas import plano_linhas
+
+# operadores de comparacao aceitos na declaracao dos parametros
+comparacoes = {
+    "=": operator.eq,
+    "ilike": compara_texto,
+    "<=": operator.le,
+    ">=": operator.ge,
+    "<": operator.lt,
+    ">": operator.gt,
+}
+
+# transformacao do valor antes de ser passado ao banco de dados
+formata_valor = {
+    "ilike": lambda valor: u"%%%s%%" % valor,
+}
+
+def nome_bind(param):
+    '''
+    Nome do parametro de ligacao (bind) do filtro no SQL.
+    '''
+    return "p_%s" % param
+
+def nomes_bind(nome, quantidade):
+    '''
+    Nomes dos parametros de ligacao de um filtro: o proprio nome, se o
+    valor for unico, ou um nome para cada valor de uma lista.
+    '''
+    if quantidade is None:
+        return nome
+    return ["%s_%d" % (nome, n) for n in range(quantidade)]
+
+def comparador(comparacao, nomes):
+    '''
+    Retorna a funcao que compara um atributo ao parametro de ligacao (bind)
+    de nome informado. Se for informada uma lista de nomes, a comparacao
+    e' feita com IN.
+    '''
+    def compara(atributo):
+        if isinstance(nomes, list):
+            tipo = atributo.__clause_element__().type
+            return atributo.in_([bindparam(nome, type_=tipo)
+                for nome in nomes])
+        return comparacoes[comparacao](atributo, bindparam(nomes))
+    return compara
+
+def liga_valor(valores, nomes, valor, formato=None):
+    '''
+    Inclui nos valores de ligacao o valor (ou a lista de valores) de um
+    filtro, aplicando a formatacao da comparacao, se houver.
+    '''
+    if not isinstance(nomes, list):
+        nomes, valor = [nomes], [valor]
+    for nome, item in zip(nomes, valor):
+        if formato is not None:
+            item = formato(item)
+        valores[nome] = item
+
+def predicado_caminho(cls, steps, compara):
+    '''
+    Monta o criterio de filtro de um caminho de atributos a partir da
+    classe, como 'proponente.municipio._uf'.
+
+    compara: funcao que recebe o atributo final e retorna a comparacao.
+
+    Cada relacionamento do caminho vira um semi-join, que nao multiplica
+    as linhas da consulta principal:
+
+    * muitos-para-um: IN sobre a chave estrangeira local
+      (id_proponente IN (SELECT id FROM proponente WHERE ...));
+    * colecoes (um-para-muitos e muitos-para-muitos): EXISTS.
+
+    Se o caminho termina na coluna referenciada pela chave estrangeira
+    (ex.: 'proponente.id'), a comparacao e' feita diretamente na chave
+    estrangeira local, sem subconsulta.
+    '''
+    atributo = getattr(cls, steps[0])
+    prop = atributo.property
+    if not isinstance(prop, RelationshipProperty) or len(steps) == 1:
+        return compara(atributo)
+    destino = prop.mapper.class_
+    if prop.direction is MANYTOONE and prop.secondary is None and \
+            len(prop.local_remote_pairs) == 1:
+        local, remota = prop.local_remote_pairs[0]
+        local = getattr(cls, prop.parent.get_property_by_column(local).key)
+        chave_remota = prop.mapper.get_property_by_column(remota).key
+        if len(steps) == 2 and steps[1] == chave_remota:
+            # a chave estrangeira local ja tem o valor procurado
+            return compara(local)
+        # alias evita a correlacao com a consulta externa (autorrelacionamento)
+        alvo = aliased(destino)
+        subconsulta = select([getattr(alvo, chave_remota)],
+            predicado_caminho(alvo, steps[1:], compara)).correlate(None)
+        return local.in_(subconsulta)
+    if prop.uselist:
+        return atributo.any(predicado_caminho(destino, steps[1:], compara))
+    return atributo.has(predicado_caminho(destino, steps[1:], compara))
+
+def predicado_parametro(metodo, cls, param, nomes):
+    '''
+    Monta o criterio de filtro de um parametro declarado no metodo,
+    comparado ao(s) parametro(s) de ligacao informado(s).
+    '''
+    declaracao = metodo.parameters[param]
+    # verifica qual atributo consultar
+    atr = declaracao.get("query_attribute", param)
+    steps = atr.split(".") # cadeia de atributos
+    # os relacionamentos do caminho viram semi-joins (IN/EXISTS),
+    # que nao multiplicam as linhas da consulta principal
+    return predicado_caminho(cls, steps,
+        comparador(declaracao["comparison"], nomes))
+
+def nome_bind_atomo(n):
+    '''
+    Nome do parametro de ligacao do n-esimo atomo da expressao de filtro.
+    '''
+    return "e%d" % n
+
+def predicado_expressao(metodo, cls, no, contador):
+    '''
+    Monta o criterio de filtro da forma de uma expressao do parametro
+    'filtro' (ver expressoes.forma). Os atomos sao numerados em pre-ordem,
+    na mesma sequencia de expressoes.atomos.
+    '''
+    tipo = no[0]
+    if tipo == 'atomo':
+        nomes = nomes_bind(nome_bind_atomo(contador.next()), no[2])
+        return predicado_parametro(metodo, cls, no[1], nomes)
+    if tipo == NAO:
+        return not_(predicado_expressao(metodo, cls, no[1], contador))
+    criterios = [predicado_expressao(metodo, cls, filho, contador)
+        for filho in no[1]]
+    if tipo == OU:
+        return or_(*criterios)
+    return and_(*criterios)
+
+class PlanoFiltros(object):
+    """Filtros de um metodo da API para um conjunto de parametros
+    informados e uma forma de expressao de filtro, com parametros de
+    ligacao (bind) no lugar dos valores.
+
+    E' a parte comum aos planos de consulta e de agregacao.
+    """
+
+    def __init__(self, metodo, params, expressao=None):
+        cls = metodo.model_class
+        self.params = params
+        self.criterios = []
+        
+        # filtra por cada parametro (uma lista de valores vira IN)
+        self.formatos = {}
+        for param, quantidade in sorted(params):
+            self.criterios.append(predicado_parametro(metodo, cls, param,
+                nomes_bind(nome_bind(param), quantidade)))
+            self.formatos[param] = formata_valor.get(
+                metodo.parameters[param]["comparison"], None)
+        # expressao do parametro 'filtro', combinada aos demais com AND
+        self.expressao = expressao
+        self.formatos_atomos = []
+        if expressao is not None:
+            self.criterios.append(predicado_expressao(metodo, cls, expressao,
+                count()))
+            self.formatos_atomos = [formata_valor.get(
+                metodo.parameters[param]["comparison"], None)
+                for param, quantidade in atomos(expressao)]
+    
+    def valores(self, parameters, expressao=None):
+        '''
+        Retorna os valores de ligacao dos filtros a partir dos parametros
+        e da expressao de filtro ja processados pelo metodo.
+        '''
+        valores = {}
+        for param, quantidade in self.params:
+            liga_valor(valores, nomes_bind(nome_bind(param), quantidade),
+                parameters[param]["value"], self.formatos[param])
+        if expressao is not None:
+            for n, (param, valor) in enumerate(atomos(expressao)):
+                liga_valor(valores,
+                    nomes_bind(nome_bind_atomo(n), quantidade_valores(valor)),
+                    valor, self.formatos_atomos[n])
+        return valores
+
+class PlanoConsulta(PlanoFiltros):
+    """Plano de consulta reutilizavel de um metodo da API.
+
+    O plano e' montado uma unica vez para cada combinacao de metodo e
+    conjunto de parametros informados. Contem a consulta ja com os semi-joins,
+    as opcoes de carregamento e os filtros, estes com parametros de ligacao
+    (bind) no lugar dos valores, alem do SQL de contagem, compilado uma
+    unica vez. A cada requisicao, basta associar a consulta a sessao e
+    ligar os valores.
+    """
+
+    def __init__(self, metodo, params, campos=None, ordem=None,
+            expressao=None):
+        super(PlanoConsulta, self).__init__(metodo, params, expressao)
+        cls = metodo.model_class
+        self.ordem = ordem
+        q = Query(cls)
+        
+        # campos a serializar (os solicitados ou, por padrao, os resumidos):
+        # adia as colunas e dispensa os relacionamentos desnecessarios
+        campos_padrao = campos is None
+        if campos_padrao:
+            campos = getattr(cls, metodo.atributos_serializar, None)
+        necessarios = atributos_necessarios(cls, campos)
+        if necessarios is not None and ordem is not None:
+            # o valor da coluna de ordenacao vai para o cursor
+            necessarios.add(ordem[0])
+        q = q.options(*opcoes_adiamento(cls, necessarios))
+        # relacionamentos usados na serializacao, carregados antecipadamente
+        # para que a pagina custe o mesmo numero de consultas, qualquer que
+        # seja o seu tamanho (o plano dos resumidos e' montado na
+        # inicializacao)
+        if campos_padrao and metodo.carregamento is not None:
+            carregamento = metodo.carregamento
+        else:
+            carregamento = plano_carregamento(cls, campos,
+                metodo.preloaded_atrs, metodo.subquery_atrs)
+        q = q.options(*opcoes_carregamento(carregamento))
+        # colecoes carregadas por subconsulta, que abrange todos os
+        # registros lidos, ou por juncao, que repete cada registro por
+        # item da colecao (ver lotes)
+        self.colecoes = carrega_colecoes(cls, carregamento)
+        
+        # filtros dos parametros e da expressao de filtro
+        for criterio in self.criterios:
+            q = q.filter(criterio)
+        self.filtrada = q
+        
+        # contagem: SQL fixo, compilado uma so vez por dialeto
+        self.sql_contagem = select([sqlfunc.count()],
+            from_obj=[q.subquery()])
+        self.cache_compilado = {}
+        
+        # ordena pela coluna solicitada, se houver, e pela chave primaria
+        # (todas as colunas, se composta), na mesma direcao
+        self.chaves = chaves_primarias(cls)
+        self.atributos_chave = [getattr(cls, chave) for chave in self.chaves]
+        self.atributo_ordem = None
+        self.decrescente = False
+        criterios = list(self.atributos_chave)
+        if ordem is not None:
+            self.atributo_ordem = getattr(cls, ordem[0])
+            self.decrescente = ordem[1]
+            criterios.insert(0, self.atributo_ordem)
+        if self.decrescente:
+            criterios = [criterio.desc() for criterio in criterios]
+        self.ordenacao = criterios
+        self.ordenada = q.order_by(*criterios)
+        
+        # leitura em linhas, sem hidratar os objetos pelo ORM, quando os
+        # campos dependem apenas de colunas e de relacionamentos
+        # muitos-para-um (ver linhas.plano_linhas)
+        self.linhas = plano_linhas(cls, necessarios, carregamento)
+        if self.linhas is not None:
+            self.linhas_ordenadas = self.linhas.consulta(self.criterios,
+                criterios)
+    
+    def consulta(self, session, valores, ordenada=True, linhas=False):
+        '''
+        Retorna a consulta do plano associada a sessao, com os valores
+        dos filtros ligados. Com linhas, retorna a consulta ordenada das
+        linhas, cujos resultados sao convertidos em objetos por
+        self.linhas.objeto.
+        '''
+        if linhas:
+            q = self.linhas_ordenadas
+        else:
+            q = self.ordenada if ordenada else self.filtrada
+        return q.with_session(session).params(**valores)
+    
+    def valores_cursor(self, obj):
+        '''
+        Retorna os valores do objeto que identificam sua posicao na
+        ordenacao, para o cursor da proxima pagina.
+        '''
+        valores = valores_chave(obj, self.chaves)
+        if self.atributo_ordem is not None:
+            valores.insert(0, getattr(obj, self.ordem[0]))
+        return valores
+    
+    def continuacao(self, valores, dialeto):
+        '''
+        Retorna o criterio que seleciona os registros posteriores aos
+        valores lidos do cursor (ver valores_cursor), ja convertidos para
+        os tipos das colunas.
+        '''
+        if self.atributo_ordem is None:
+            return predicado_seek(self.atributos_chave, valores)
+        return predicado_seek_ordenado(self.atributo_ordem, self.decrescente,
+            valores[0], self.atributos_chave, valores[1:],
+            nulos_maiores(dialeto))
+    
+    def lotes(self, session, valores, limite, tamanho, ultimos=None,
+            offset=0, linhas=False):
+        '''
+        Itera sobre ate limite registros da consulta ordenada, a partir dos
+        valores do cursor (ultimos) e/ou do offset (contado apos o cursor),
+        lendo-os do banco de dados em lotes de tamanho registros, sem
+        manter todos na memoria.
+        
+        Sem colecoes a carregar, a leitura e' feita numa unica consulta,
+        com cursor no servidor (stream_results). Com colecoes, cuja
+        subconsulta traria de uma vez as de todos os registros (e cuja
+        juncao dividiria um registro entre lotes), cada lote e' uma
+        consulta propria, que continua do ultimo registro do lote anterior
+        (paginacao por seek).
+        
+        Com linhas (so possivel sem colecoes), os registros sao lidos como
+        linhas e convertidos em objetos leves.
+        '''
+        dialeto = session.connection().dialect
+        if not self.colecoes:
+            q = self.consulta(session, valores, linhas=linhas)
+            if ultimos is not None:
+                q = q.filter(self.continuacao(ultimos, dialeto))
+            if offset:
+                q = q.offset(offset)
+            q = q.limit(limite).execution_options(stream_results=True)
+            if linhas:
+                objeto = self.linhas.objeto
+                for linha in q.yield_per(tamanho):
+                    yield objeto(linha)
+                return
+            for obj in q.yield_per(tamanho):
+                yield obj
+            return
+        while limite > 0:
+            q = self.consulta(session, valores)
+            if ultimos is not None:
+                q = q.filter(self.continuacao(ultimos, dialeto))
+            if offset:
+                q = q.offset(offset)
+                offset = 0
+            objetos = q.limit(min(tamanho, limite)).all()
+            for obj in objetos:
+                yield obj
+            if len(objetos) < min(tamanho, limite):
+                return
+            limite -= len(objetos)
+            ultimos = self.valores_cursor(objetos[-1])
+            del objetos
+    
+    def fronteiras(self, session, valores, intervalo):
+        '''
+        Percorre apenas as chaves da consulta ordenada e gera, a cada
+        intervalo registros, a posicao e os valores de cursor (ver
+        valores_cursor) do registro nessa posicao.
+        '''
+        colunas = list(self.atributos_chave)
+        if self.atributo_ordem is not None:
+            colunas.insert(0, self.atributo_ordem)
+        q = Query(colunas)
+        for criterio in self.criterios:
+            q = q.filter(criterio)
+        q = q.order_by(*self.ordenacao).with_session(session).params(**valores)
+        q = q.execution_options(stream_results=True)
+        for posicao, linha in enumerate(q.yield_per(1000), 1):
+            if posicao % intervalo == 0:
+                yield posicao, list(linha)
+    
+    def conta(self, session, valores):
+        '''
+        Conta os registros da consulta, reaproveitando o SQL compilado.
+        '''
+        conn = session.connection().execution_options(
+            compiled_cache=self.cache_compilado)
+        return conn.execute(self.sql_contagem, valores).scalar()
+
+def parametros_informados(metodo):
+    '''
+    Retorna o conjunto dos parametros informados na requisicao, cada um
+    com a quantidade de valores (ou None, se o valor for unico).
+    '''
+    return frozenset((param, quantidade_valores(dic["value"]))
+        for param, dic in metodo.parameters.items()
+        if dic.get("value", None) is not None)
+
+class CachePlanos(object):
+    """Armazena os planos de consulta por metodo, parametros (e quantidade
+    de valores de cada um), campos, ordenacao e forma da expressao de
+    filtro informados.
+
+    Como os campos podem ser combinados livremente, o cache e' esvaziado
+    ao atingir max_planos.
+    """
+
+    max_planos = 1000
+
+    def __init__(self):
+        self.planos = {}
+        self.lock = Lock()
+
+    def obtem(self, metodo):
+        '''
+        Retorna o plano do metodo para os parametros, campos, ordenacao e
+        expressao de filtro informados na requisicao, montando-o se ainda nao existir.
+        '''
+        params = parametros_informados(metodo)
+        campos = metodo.campos
+        if campos is not None:
+            campos = frozenset(campos)
+        expressao = metodo.expressao
+        if expressao is not None:
+            expressao = forma(expressao)
+        chave = (metodo.__class__, params, campos, metodo.ordem, expressao)
+        return self.obtem_ou_monta(chave, lambda: PlanoConsulta(metodo,
+            params, campos, metodo.ordem, expressao))
+    
+    def obtem_ou_monta(self, chave, monta):
+        '''
+        Retorna o plano guardado na chave informada ou, se ainda nao
+        existir, o plano montado pela funcao monta (sem argumentos).
+        '''
+        plano = self.planos.get(chave, None)
+        if plano is None:
+            with self.lock:
+                plano = self.planos.get(chave, None)
+                if plano is None:
+                    plano = monta()
+                    if len(self.planos) >= self.max_planos:
+                        self.planos.clear()
+                    self.planos[chave] = plano
+        return plano
+
+cache_planos = CachePlanos()
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo replicas.py da API de dados abertos do SICONV.
+=======================================================
+
+© 2011-2013 Ministério do Planejamento, Orçamento e Gestão
+
+Este arquivo e parte do webservice de dados abertos do SICONV,
+o Sistema de Cadastro de Convênios e Contratos de Repasse.
+
+A documentacao esta disponível em http://api.convenios.gov.br/siconv/doc/
+
+O webservice de dados abertos do SICONV é um software livre; você pode
+redistribui-lo e/ou modifica-lo dentro dos termos da Licença Pública Geral
+Affero GNU como publicada pela Fundação do Software Livre (FSF); na versão 3
+da Licença, ou (na sua opnião) qualquer versão subsequente.
+
+Este programa é distribuido na esperança que possa ser  util,
+mas SEM NENHUMA GARANTIA; sem uma garantia implicita de ADEQUAÇÂO a qualquer
+MERCADO ou APLICAÇÃO EM PARTICULAR. Veja a
+Licença Pública Geral Affero GNU para maiores detalhes.
+
+http://www.gnu.org/licenses/agpl-3.0.html
+"""
+
+import logging
+from threading import Lock, Thread
+from time import time, sleep
+
+from sqlalchemy import event
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.orm import Session as SessaoBase
+
+from conexoes import cria_engine
+
+log = logging.getLogger(__name__)
+
+# estrategias de escolha da replica (parametro 'replicas.estrategia' do .ini)
+ESTRATEGIAS = ('rodizio', 'menos_carregada')
+
+class Replica(object):
+    """Uma replica de leitura do banco de dados e o seu estado: se esta
+    saudavel, quando foi verificada e quantas sessoes a utilizam.
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        # identificacao da replica nos logs, sem usuario e senha
+        self.nome = "%s/%s" % (engine.url.host or "", engine.url.database)
+        self.saudavel = True
+        self.verificada_em = None
+        self.em_uso = 0
+
+    def __repr__(self):
+        return "<Replica %s%s em_uso=%d>" % (self.nome,
+            "" if self.saudavel else " (fora do ar)", self.em_uso)
+
+class RoteadorReplicas(object):
+    """Distribui as sessoes de leitura da API entre as replicas.
+
+    A escolha segue a estrategia configurada: 'rodizio' alterna entre as
+    replicas e 'menos_carregada' escolhe a que tem menos sessoes abertas.
+    As replicas sao verificadas (uma consulta simples e, opcionalmente, o
+    atraso da replicacao) a cada 'intervalo' segundos, numa thread propria
+    (ver inicia_verificacoes), fora das requisicoes. Entre as verificacoes,
+    a replica que recusa conexoes ou perde a conexao durante uma consulta
+    sai da escolha (ver falhou). Se nenhuma replica estiver saudavel, a
+    leitura recorre ao banco primario, a menos que 'recorre_primario' seja
+    falso.
+    """
+
+    def __init__(self, primario, engines, estrategia='rodizio',
+            intervalo=30, atraso_maximo=None, recorre_primario=True):
+        if estrategia not in ESTRATEGIAS:
+            raise ValueError(u"Estratégia de escolha de réplicas desconhecida: '%s'." % \
+                estrategia)
+        self.primario = primario
+        self.replicas = [Replica(engine) for engine in engines]
+        self.estrategia = estrategia
+        self.intervalo = intervalo
+        self.atraso_maximo = atraso_maximo
+        self.recorre_primario = recorre_primario
+        self.proxima = 0
+        self.trava = Lock()
+        for replica in self.replicas:
+            event.listen(replica.engine, 'dbapi_error',
+                self.erro_consulta(replica))
+
+    def verifica(self, replica):
+        '''
+        Verifica se a replica responde e, se houver limite configurado, se o
+        atraso da replicacao (PostgreSQL) esta dentro dele.
+        '''
+        try:
+            conn = replica.engine.connect()
+            try:
+                conn.execute("SELECT 1").scalar()
+                atraso = None
+                if self.atraso_maximo and conn.dialect.name == 'postgresql':
+                    atraso = conn.execute("SELECT extract(epoch FROM "
+                        "now() - pg_last_xact_replay_timestamp())").scalar()
+            finally:
+                conn.close()
+        except Exception, e:
+            if replica.saudavel:
+                log.warning("replica %s fora do ar: %s", replica.nome, e)
+            return False
+        if atraso is not None and atraso > self.atraso_maximo:
+            if replica.saudavel:
+                log.warning("replica %s atrasada em %d segundos",
+                    replica.nome, atraso)
+            return False
+        if not replica.saudavel:
+            log.warning("replica %s de volta ao ar", replica.nome)
+        return True
+
+    def verifica_todas(self):
+        '''
+        Verifica todas as replicas e atualiza o seu estado.
+        '''
+        for replica in self.replicas:
+            saudavel = self.verifica(replica)
+            replica.verificada_em = time()
+            replica.saudavel = saudavel
+
+    def verificacoes(self):
+        '''
+        Laco da thread de verificacao: verifica as replicas a cada
+        intervalo.
+        '''
+        while True:
+            sleep(self.intervalo)
+            try:
+                self.verifica_todas()
+            except Exception:
+                log.exception("falha na verificacao das replicas")
+
+    def inicia_verificacoes(self):
+        '''
+        Verifica as replicas uma primeira vez e inicia a thread que as
+        verifica periodicamente, de modo que uma replica fora do ar nao
+        atrase as requisicoes ate o tempo limite de conexao.
+        '''
+        self.verifica_todas()
+        thread = Thread(target=self.verificacoes,
+            name="verificacao-replicas")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def falhou(self, replica, erro):
+        '''
+        Tira da escolha a replica que falhou por erro de conexao, ate que a
+        proxima verificacao a encontre de volta ao ar.
+        '''
+        if replica.saudavel:
+            log.warning("replica %s fora do ar: %s", replica.nome, erro)
+        replica.saudavel = False
+
+    def erro_consulta(self, replica):
+        '''
+        Retorna o tratador do evento dbapi_error do engine da replica, que a
+        tira da escolha se o erro for a perda da conexao.
+        '''
+        def trata(conn, cursor, statement, parameters, context, exception):
+            if conn.dialect.is_disconnect(exception, conn.connection, cursor):
+                self.falhou(replica, exception)
+        return trata
+
+    def saudaveis(self):
+        '''
+        Retorna as replicas saudaveis, conforme a ultima verificacao.
+        '''
+        return [replica for replica in self.replicas if replica.saudavel]
+
+    def escolhe(self):
+        '''
+        Escolhe a replica para uma nova sessao de leitura e a marca como em
+        uso. Retorna None se a leitura deve recorrer ao banco primario.
+        '''
+        candidatas = self.saudaveis()
+        if not candidatas:
+            if not self.recorre_primario:
+                raise ReplicasIndisponiveis(
+                    u"Nenhuma réplica do banco de dados está disponível.")
+            return None
+        with self.trava:
+            # o rodizio tambem desempata a escolha da menos carregada
+            n = self.proxima % len(candidatas)
+            self.proxima += 1
+            ordem = candidatas[n:] + candidatas[:n]
+            if self.estrategia == 'menos_carregada':
+                replica = min(ordem, key=lambda r: r.em_uso)
+            else:
+                replica = ordem[0]
+            replica.em_uso += 1
+        return replica
+
+    def libera(self, replica):
+        '''
+        Indica que uma sessao deixou de usar a replica.
+        '''
+        with self.trava:
+            replica.em_uso -= 1
+
+class ReplicasIndisponiveis(Exception):
+    """Nenhuma replica esta disponivel e a leitura nao pode recorrer ao
+    banco primario.
+    """
+
+# roteador das sessoes de leitura. Definido na inicializacao da aplicacao
+# por configura_replicas; sem replicas, as leituras usam o banco primario.
+roteador = None
+
+def erro_conexao(engine, erro):
+    '''
+    Indica se o erro, levantado ao abrir uma conexao com o engine, e' do
+    banco de dados (e nao da aplicacao).
+    '''
+    return isinstance(erro, (DBAPIError, engine.dialect.dbapi.Error))
+
+class SessaoLeitura(SessaoBase):
+    """Sessao das consultas somente-leitura da API.
+
+    Usa uma replica escolhida pelo roteador, mantida ate o fechamento da
+    sessao para que todas as consultas de uma requisicao (pagina, contagem
+    e carregamentos tardios) vejam o mesmo banco de dados. Se a replica
+    recusar a primeira conexao da sessao, ela sai da escolha e a sessao
+    passa a outra replica (ou ao banco primario).
+    """
+    replica = None
+    escolhida = False
+
+    def get_bind(self, mapper=None, clause=None):
+        if roteador is None:
+            return super(SessaoLeitura, self).get_bind(mapper, clause)
+        if not self.escolhida:
+            self.replica = roteador.escolhe()
+            self.escolhida = True
+        return self.engine_replica()
+
+    def engine_replica(self):
+        if self.replica is None:
+            return roteador.primario
+        return self.replica.engine
+
+    def _connection_for_bind(self, engine, **kwargs):
+        try:
+            return super(SessaoLeitura, self)._connection_for_bind(engine,
+                **kwargs)
+        except Exception, e:
+            replica = self.replica
+            if replica is None or engine is not replica.engine or \
+                    not erro_conexao(engine, e):
+                raise
+        # nenhuma consulta foi feita na replica: a sessao pode trocar de
+        # banco de dados sem perder a consistencia
+        roteador.falhou(replica, e)
+        roteador.libera(replica)
+        self.replica = None
+        self.replica = roteador.escolhe()
+        return super(SessaoLeitura, self)._connection_for_bind(
+            self.engine_replica(), **kwargs)
+
+    def close(self):
+        super(SessaoLeitura, self).close()
+        if self.replica is not None:
+            roteador.libera(self.replica)
+        self.replica = None
+        self.escolhida = False
+
+# sessao de leitura
+SessionLeitura = scoped_session(sessionmaker(class_=SessaoLeitura))
+
+def urls_replicas(valor):
+    '''
+    Separa as urls das replicas informadas no .ini, uma por linha ou
+    separadas por espacos.
+    '''
+    return (valor or "").split()
+
+def configura_replicas(engine, settings):
+    '''
+    Configura as sessoes de leitura a partir do .ini. As replicas
+    ('replicas.urls') herdam as demais opcoes 'sqlalchemy.' e 'pool.' do
+    banco primario (engine), que continua reservado a carga e a manutencao.
+    '''
+    global roteador
+    SessionLeitura.configure(bind=engine)
+    urls = urls_replicas(settings.get('replicas.urls'))
+    if not urls:
+        roteador = None
+        return roteador
+    engines = []
+    for n, url in enumerate(urls):
+        engines.append(cria_engine(settings, "replica_%d" % (n + 1), url))
+    atraso_maximo = settings.get('replicas.atraso_maximo')
+    roteador = RoteadorReplicas(engine, engines,
+        estrategia=settings.get('replicas.estrategia', 'rodizio'),
+        intervalo=int(settings.get('replicas.intervalo_verificacao', 30)),
+        atraso_maximo=int(atraso_maximo) if atraso_maximo else None,
+        recorre_primario=settings.get('replicas.recorre_primario', 'sim') \
+            == 'sim')
+    roteador.inicia_verificacoes()
+    return roteador
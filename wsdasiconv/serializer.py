@@ -59,9 +59,17 @@ json.encoder.FLOAT_REPR = lambda f: ("%.6f" % f)
 from rdflib.graph import ConjunctiveGraph
 from rdflib.term import URIRef, Literal, BNode
 from rdflib.namespace import Namespace, RDF, RDFS, OWL
+import triplas as triplas_rdf
 
-# XML (amara)
-from amara.writers.struct import structwriter, ROOT, E, E_CURSOR
+# planos dos campos serializados e especies dos valores
+from acessos import plano_campos, especie
+from acessos import TEXTO, NUMERO, LOGICO, NULO, DECIMAL, DATA, HORA, URI
+from acessos import OBJETO, LISTA, DICIONARIO, OUTRO
+
+# XML
+from amara.writers.struct import E
+from escritorxml import EscritorXML, texto_atributo, serializa_atributo
+from escritorxml import serializa_atributos, ordem_atributos
 from StringIO import StringIO as sio
 
 # HTML
@@ -78,10 +86,13 @@ locale.setlocale(locale.LC_ALL, '')
 locale.setlocale(locale.LC_ALL,('pt_BR', 'UTF8'))
 
 class Aggregator(object):
+    # parametros de consulta que nao filtram os dados
+    parametros_gerais = ('offset', 'cursor', 'limite', 'contagem', 'campos',
+        'ordem', 'filtro', 'agrupar_por', 'medidas')
     def __init__(self, format, name, atributo_serializar="__expostos__",
             total_registros=None, dataset_split=None,
             template='templates/lista.pt',
-            parameters=None, request=None):
+            parameters=None, request=None, campos=None):
         self.format = format
         self.name = name
         self.aggregator = []
@@ -93,13 +104,15 @@ class Aggregator(object):
         self.template = template
         self.opened = True
         self.atributo_serializar = atributo_serializar
+        self.campos = campos
         if parameters is None:
             parameters = {}
         self.parameters = parameters
         self.filters_used = dict(getattr(request,'params', {}))
-        if self.filters_used and self.filters_used.get('offset', False):
-            # 'offset' nao e um filtro, entao o retiramos
-            del self.filters_used['offset']
+        for param in self.parametros_gerais:
+            if self.filters_used and self.filters_used.get(param, False):
+                # os parametros gerais nao sao filtros, entao os retiramos
+                del self.filters_used[param]
     def __len__(self):
         return self._qt_items
     def __repr__(self):
@@ -125,6 +138,15 @@ class Aggregator(object):
             self._first_obj(obj)
         self.aggregator.append(obj)
         self._qt_items += 1
+    def atributos(self, obj):
+        """
+        Retorna os nomes dos atributos do objeto a serializar. Se foram
+        solicitados campos especificos, apenas eles sao retornados.
+        """
+        atributos = getattr(obj, self.atributo_serializar)
+        if self.campos is None:
+            return atributos
+        return [atr for atr in atributos if atr in self.campos]
     def formata(self, obj):
         if isinstance(obj, unicode):
             return obj.encode("utf-8")
@@ -134,14 +156,45 @@ class Aggregator(object):
             return ",\n".join(repr(item) for item in obj)
         else:
             return repr(obj)
+    def metadados_contagem(self):
+        """
+        Retorna os metadados sobre o total de registros, conforme o modo de
+        contagem utilizado na consulta.
+        """
+        metadados = {}
+        if self.total_registros:
+            metadados['total_registros'] = self.total_registros
+        contagem = self.dataset_split.get('contagem', None)
+        if contagem == 'estimada':
+            # o total e' uma estimativa do banco de dados
+            metadados['contagem'] = contagem
+        elif contagem == 'nenhuma':
+            # nao ha total: informa apenas se ha mais registros
+            metadados['ha_mais'] = bool(self.dataset_split.get('ha_mais', False))
+        return metadados
     def close(self):
         self.opened = False
     def serialize(self, format=None):
         return repr(self.aggregator)
+    def serialize_iter(self, objetos, format=None):
+        """
+        Serializa os objetos do iteravel gerando a representacao em partes
+        (str ou unicode), para o envio da resposta a medida que e' gerada.
+        Os formatos que nao sao gerados em partes agregam todos os objetos
+        e retornam a serializacao completa, feita de imediato (os templates
+        precisam do contexto da requisicao), numa lista de uma so parte.
+        """
+        for obj in objetos:
+            self.add(obj)
+        return [self.serialize(format=format)]
 
 class XMLAggregator(Aggregator):
     def __init__(self, *args, **kw):
         super(XMLAggregator, self).__init__('xml', *args, **kw)
+        # planos de serializacao por classe (ver plano)
+        self._planos = {}
+        self._escritores = dict((chave, getattr(self, metodo))
+            for chave, metodo in self.escritores_especies.items())
     def formata(self, obj, nome=""):
         if nome:
             obj = getattr(obj, nome)
@@ -203,33 +256,148 @@ class XMLAggregator(Aggregator):
         if nome.startswith('href_'):
             nome = nome[5:]
         return E(nome, self.formata(obj, atr))
+    def atributos_raiz(self):
+        """Retorna os atributos do elemento raiz: total de registros."""
+        return dict((k, (unicode(v).lower() if isinstance(v, bool) else v))
+            for k, v in self.metadados_contagem().items())
+    # metodos de escrita dos valores de cada especie (ver escreve_valor)
+    escritores_especies = {
+        TEXTO: 'escreve_texto',
+        NUMERO: 'escreve_numero',
+        LOGICO: 'escreve_numero',
+        DECIMAL: 'escreve_decimal',
+        DATA: 'escreve_data',
+        HORA: 'escreve_data',
+        URI: 'escreve_uri',
+        OBJETO: 'escreve_objeto',
+        LISTA: 'escreve_lista',
+        DICIONARIO: 'escreve_dicionario',
+    }
+    def plano(self, obj):
+        """
+        Retorna o plano da classe do objeto para esta serializacao: o nome
+        do elemento, a ordem dos atributos id e href e os campos (ver
+        acessos.plano_campos), calculados no primeiro objeto de cada classe.
+        """
+        plano_classe = plano_campos(obj, self.atributo_serializar)
+        plano = self._planos.get(plano_classe)
+        if plano is None:
+            plano = self._planos[plano_classe] = (
+                texto_atributo(self.element_name(obj)).encode('utf-8'),
+                ordem_atributos(tuple(dict.fromkeys(('id', 'href')))),
+                plano_classe.seleciona(self.campos))
+        return plano
+    def escreve(self, escritor, obj):
+        """
+        Escreve o elemento XML do objeto, com os seus atributos, segundo o
+        plano da sua classe.
+        """
+        nome, ordem, campos = self.plano(obj)
+        valores = {'id': getattr(obj, 'id', None), 'href': getattr(obj, 'uri', None)}
+        escritor.abre(nome, ''.join(serializa_atributo(unicode(atr),
+            texto_atributo(valores[atr])) for atr in ordem if valores[atr]))
+        escreve_valor = self.escreve_valor
+        for campo in campos:
+            valor = getattr(obj, campo.atr)
+            if valor or isinstance(valor, int):
+                escreve_valor(escritor, campo.nome_xml, valor)
+        escritor.fecha(nome)
+    def escreve_valor(self, escritor, nome, valor):
+        """
+        Escreve o elemento nome (str, utf-8) com o valor, com o mesmo
+        resultado de E(nome, self.formata(valor)), pelo metodo de escrita
+        da especie do valor.
+        """
+        self._escritores.get(especie(valor), self.escreve_geral)(escritor,
+            nome, valor)
+    def escreve_texto(self, escritor, nome, valor):
+        escritor.abre(nome)
+        if valor:
+            escritor.texto(texto_atributo(valor))
+        escritor.fecha(nome)
+    def escreve_numero(self, escritor, nome, valor):
+        escritor.abre(nome)
+        escritor.texto(unicode(str(valor)))
+        escritor.fecha(nome)
+    def escreve_decimal(self, escritor, nome, valor):
+        escritor.abre(nome)
+        escritor.texto(u"%0.2f" % valor)
+        escritor.fecha(nome)
+    def escreve_data(self, escritor, nome, valor):
+        escritor.abre(nome)
+        if valor:
+            escritor.texto(unicode(valor))
+        escritor.fecha(nome)
+    def escreve_uri(self, escritor, nome, valor):
+        escritor.abre(nome, serializa_atributo(u'href', valor))
+        escritor.fecha(nome)
+    def escreve_objeto(self, escritor, nome, valor):
+        tipo = type(valor)
+        if getattr(getattr(tipo, 'repr_xml', None), 'im_func', None) is not \
+                ExposedObject.repr_xml.im_func:
+            escritor.alimenta(E(nome, valor.repr_xml()))
+            return
+        # representacao curta dos objetos (ExposedObject.repr_xml)
+        escritor.abre(nome)
+        en = texto_atributo(getattr(valor, '__element_name__',
+            tipo.__name__)).encode('utf-8')
+        uri = valor.uri
+        escritor.abre(en, '' if uri is None else
+            serializa_atributo(u'href', texto_atributo(uri)))
+        if getattr(valor, 'nome', None):
+            escritor.alimenta(valor.nome)
+        escritor.fecha(en)
+        escritor.fecha(nome)
+    def escreve_lista(self, escritor, nome, valor):
+        escritor.abre(nome)
+        for item in valor:
+            self.escreve_valor(escritor, texto_atributo(
+                item.__element_name__ if getattr(item, '__element_name__', None)
+                else item.__class__.__name__).encode('utf-8'), item)
+        escritor.fecha(nome)
+    def escreve_dicionario(self, escritor, nome, valor):
+        escritor.abre(nome)
+        for k, v in valor.items():
+            self.escreve_valor(escritor, texto_atributo(k).encode('utf-8'), v)
+        escritor.fecha(nome)
+    def escreve_geral(self, escritor, nome, valor):
+        # subclasses dos tipos acima e demais valores
+        escritor.alimenta(E(nome, self.formata(valor)))
+    def partes(self, objetos):
+        """
+        Gera o documento XML dos objetos em partes (str, utf-8), uma por
+        objeto, escritas diretamente pelo EscritorXML.
+        """
+        escritor = EscritorXML()
+        escritor.inicia()
+        nome = texto_atributo(self.name).encode('utf-8')
+        escritor.abre(nome, serializa_atributos(self.atributos_raiz()))
+        for obj in objetos:
+            self.escreve(escritor, obj)
+            yield escritor.esvazia()
+        next_url = self.dataset_split.get('next_url', '')
+        if next_url:
+            escritor.elemento('proximos', {'href':next_url}, ())
+        escritor.fecha(nome)
+        yield escritor.esvazia()
     def close(self):
         super(XMLAggregator, self).close()
-        str_buffer = sio()
-        next_url = self.dataset_split.get('next_url', '')
-        # estrutura agregadora
-        writer = structwriter(stream=str_buffer, indent=True)
-        feed = writer.feed(
-            ROOT(
-                E(self.name,
-                    ({'total_registros': self.total_registros}
-                        if self.total_registros else {}),
-                    ( E( self.element_name(obj),
-                        self.element_atrs(obj),
-                        ( self.element(obj, atr)
-                        for atr in getattr(obj,self.atributo_serializar) if (getattr(obj, atr) or isinstance(getattr(obj,atr),int)) ) )
-                    for obj in self.aggregator ),
-                    E('proximos', {'href':next_url})
-                        if next_url else tuple(),
-                )
-            )
-        )
-        r = str_buffer.getvalue()
-        str_buffer.close()
-        self.serialization = r
+        self.serialization = "".join(self.partes(self.aggregator))
     def serialize(self, format='xml'):
-        self.close() # Amara XML structwriter precisa fechar
+        self.close()
         return self.serialization
+    def serialize_iter(self, objetos, format='xml'):
+        """
+        Serializa em XML os objetos a medida que sao lidos do iteravel,
+        gerando a representacao em partes (str), sem manter a agregacao na
+        memoria, com o mesmo resultado de serialize. Os atributos do
+        elemento raiz sao os conhecidos no inicio da leitura.
+        """
+        def contados():
+            for obj in objetos:
+                self._qt_items += 1
+                yield obj
+        return self.partes(contados())
 
 class JSONAggregator(Aggregator):
     def __init__(self, *args, **kw):
@@ -251,53 +419,164 @@ class JSONAggregator(Aggregator):
             return float(obj)
         else:
             return repr(obj)
-    def serialize(self, format='json'):
-        metadados = {}
-        if self.total_registros:
-            metadados['total_registros'] = self.total_registros
+    def metadados(self):
+        """
+        Retorna os metadados da pagina: contagem e proxima pagina.
+        """
+        metadados = self.metadados_contagem()
         next_url = self.dataset_split.get('next_url', '')
         if next_url:
             metadados['proximos'] = next_url
+        return metadados
+    def serialize(self, format='json'):
         return json.dumps(
             {
-                'metadados': metadados,
-                self.name: [item.item_json(atributo_serializar=self.atributo_serializar) for item in self.aggregator],
+                'metadados': self.metadados(),
+                self.name: [item.item_json(atributo_serializar=self.atributo_serializar,
+                    campos=self.campos) for item in self.aggregator],
             },
             default=self.serialize_json)
+    def serialize_iter(self, objetos, format='json'):
+        """
+        Serializa em JSON os objetos a medida que sao lidos do iteravel,
+        gerando a representacao em partes (str), sem manter a agregacao na
+        memoria. Os metadados vem depois dos itens, pois a proxima pagina
+        so e' conhecida ao final da leitura. Se os objetos ja estao numa
+        lista (pagina lida por inteiro), as chaves seguem a ordem de
+        serialize.
+        """
+        metadados = lambda: '"metadados": %s' % json.dumps(self.metadados(),
+            default=self.serialize_json)
+        antes = isinstance(objetos, (list, tuple)) and \
+            {'metadados': None, self.name: None}.keys()[0] == 'metadados'
+        if antes:
+            yield '{%s, %s: [' % (metadados(), json.dumps(self.name))
+        else:
+            yield '{%s: [' % json.dumps(self.name)
+        separador = ''
+        for item in objetos:
+            yield separador + json.dumps(
+                item.item_json(atributo_serializar=self.atributo_serializar,
+                    campos=self.campos),
+                default=self.serialize_json)
+            separador = ', '
+            self._qt_items += 1
+        if antes:
+            yield ']}'
+        else:
+            yield '], %s}' % metadados()
+
+def formata_json(valor):
+    """
+    Formata o valor de um atributo para a serializacao em JSON: URIs como
+    links e datas e decimais como texto. Os demais valores sao mantidos.
+    """
+    if isinstance(valor, URIRef):
+        return {'href': str(valor)}
+    elif isinstance(valor, date) or \
+            isinstance(valor, time) or \
+            isinstance(valor, datetime):
+        return valor.isoformat()
+    elif isinstance(valor, Decimal):
+        return "%0.2f" % valor
+    else:
+        return valor
+
+# formatacao em JSON dos valores de cada especie; as especies que nao
+# estao aqui sao mantidas
+formatadores_json = {
+    URI: lambda valor: {'href': str(valor)},
+    DATA: lambda valor: valor.isoformat(),
+    HORA: lambda valor: valor.isoformat(),
+    DECIMAL: lambda valor: "%0.2f" % valor,
+    OUTRO: formata_json,
+}
 
 class HTMLAggregator(Aggregator):
     def __init__(self, *args, **kw):
         super(HTMLAggregator, self).__init__('html', *args, **kw)
+    # formatacao dos valores de cada especie (ver tidy_value); as especies
+    # que nao estao aqui usam a formatacao geral
+    tidy_especies = {
+        OBJETO: 'tidy_objeto',
+        LISTA: 'tidy_lista',
+        DICIONARIO: 'tidy_dicionario',
+        DATA: 'tidy_data',
+        DECIMAL: 'tidy_decimal',
+        LOGICO: 'tidy_logico',
+        TEXTO: 'tidy_texto',
+        NUMERO: 'tidy_simples',
+        NULO: 'tidy_simples',
+        HORA: 'tidy_simples',
+    }
     @classmethod
     def tidy_value(cls, value):
+        return getattr(cls, cls.tidy_especies.get(especie(value),
+            'tidy_geral'))(value)
+    # objeto exposto
+    @classmethod
+    def tidy_objeto(cls, value):
+        name = getattr(value, 'nome', getattr(value, 'descricao', False))
+        ref = cls.tidy_label(value.__class__.__name__) + \
+            (" %s" % unicode(value.id)) + \
+            (u"" if not name else (u": %s" % name))
+        uri = getattr(value, 'uri', False)
+        return link_to_if(uri, ref, uri)
+    # listas
+    @classmethod
+    def tidy_lista(cls, value):
+        return ul(cls.tidy_value(item) for item in value)
+    # dicionarios
+    @classmethod
+    def tidy_dicionario(cls, value):
+        return HTML.dl(HTML(*[
+            HTML(*[HTML.dt(cls.tidy_label(k)), HTML.dd(cls.tidy_value(v))])
+                for k, v in value.items()]
+        ))
+    # datas
+    @staticmethod
+    def tidy_data(value):
+        return value.strftime(u"%d/%m/%Y")
+    # decimais (em geral, valores moeda)
+    @staticmethod
+    def tidy_decimal(value):
+        return u"R$ "+locale.format(u"%.02f",value, grouping=True, monetary=True)
+    # booleanos
+    @staticmethod
+    def tidy_logico(value):
+        return u"Verdadeiro" if value else u"Falso"
+    # textos (os longos em paragrafos)
+    @staticmethod
+    def tidy_texto(value):
+        if isinstance(value, unicode) and len(value) > 140:
+            return format_paragraphs(value, preserve_lines=True)
+        return link_to_if(False, value, False)
+    # valores sem uri
+    @staticmethod
+    def tidy_simples(value):
+        return link_to_if(False, value, False)
+    @classmethod
+    def tidy_geral(cls, value):
         # objeto exposto
         if isinstance(value, ExposedObject):
-            name = getattr(value, 'nome', getattr(value, 'descricao', False))
-            ref = cls.tidy_label(value.__class__.__name__) + \
-                (" %s" % unicode(value.id)) + \
-                (u"" if not name else (u": %s" % name))
-            uri = getattr(value, 'uri', False)
-            return link_to_if(uri, ref, uri)
+            return cls.tidy_objeto(value)
         # listas
         elif isinstance(value, Iterable) and \
                 not isinstance(value, basestring) and \
                 not isinstance(value, dict):
-            return ul(cls.tidy_value(item) for item in value)
+            return cls.tidy_lista(value)
         # dicionarios
         elif isinstance(value, dict):
-            return HTML.dl(HTML(*[
-                HTML(*[HTML.dt(cls.tidy_label(k)), HTML.dd(cls.tidy_value(v))])
-                    for k, v in value.items()]
-            ))
+            return cls.tidy_dicionario(value)
         # datas
         elif isinstance(value, date):
-            return value.strftime(u"%d/%m/%Y")
+            return cls.tidy_data(value)
         # decimais (em geral, valores moeda)
         elif isinstance(value, Decimal):
-            return u"R$ "+locale.format(u"%.02f",value, grouping=True, monetary=True)
+            return cls.tidy_decimal(value)
         # booleanos
         elif isinstance(value, bool):
-            return u"Verdadeiro" if value else u"Falso"
+            return cls.tidy_logico(value)
         # strings longas
         elif isinstance(value, unicode) and len(value) > 140:
             return format_paragraphs(value, preserve_lines=True)
@@ -317,6 +596,8 @@ class HTMLAggregator(Aggregator):
         # prepara metadados
         metadados = {}
         metadados['total_registros'] = getattr(self,'total_registros',0)
+        metadados['contagem'] = self.dataset_split.get('contagem', 'exata')
+        metadados['ha_mais'] = bool(self.dataset_split.get('next_url', ''))
         next_url = self.dataset_split.get('next_url', '')
         if next_url:
             metadados['proximos'] = next_url
@@ -342,6 +623,7 @@ class HTMLAggregator(Aggregator):
                 'dataset_split': self.dataset_split,
                 'filters_used': self.filters_used,
                 'filters': self.parameters,
+                'atributos': self.atributos,
                 'd':self.aggregator,
             },
         )
@@ -352,46 +634,103 @@ class CSVAggregator(Aggregator):
         self.cols = set()
     def add(self, obj):
         super(CSVAggregator, self).add(obj)
+        self.cols.update(self.colunas(obj))
+    def colunas(self, obj):
+        """
+        Retorna as colunas do objeto: uma por atributo, ou uma por chave
+        dos atributos que sao dicionarios (atributo/chave).
+        """
         atrs = set()
-        for atr in getattr(obj, self.atributo_serializar):
-            prop = getattr(obj, atr, None)
-            if isinstance(prop, dict):
+        for campo in plano_campos(obj, self.atributo_serializar).seleciona(self.campos):
+            prop = getattr(obj, campo.atr, None)
+            tipo = especie(prop)
+            if tipo is DICIONARIO or (tipo is OUTRO and isinstance(prop, dict)):
                 for key in prop.keys():
-                    atrs.add(atr + '/' + key)
+                    atrs.add(campo.atr + '/' + key)
             else:
-                atrs.add(atr)
-        self.cols.update(atrs)
+                atrs.add(campo.atr)
+        return atrs
+    @staticmethod
+    def identificacao(obj):
+        """
+        Retorna as colunas de identificacao que precedem os atributos do
+        objeto: por padrao, id e uri.
+        """
+        return list(getattr(obj, '__colunas_identificacao__', ('id', 'uri')))
+    @staticmethod
+    def acessos(cols):
+        """
+        Retorna os acessos aos valores das colunas: o atributo e, nas
+        colunas atributo/chave, a chave do dicionario.
+        """
+        return [tuple(atr.split('/')) if '/' in atr else (atr, None)
+            for atr in cols]
+    @staticmethod
+    def linha(obj, acessos):
+        """
+        Retorna os valores das colunas do objeto, codificados em utf-8
+        (csv_writer nao escreve unicode).
+        """
+        valores = []
+        for atr, chave in acessos:
+            valor = getattr(obj, atr, None)
+            if chave is not None:
+                valor = valor.get(chave, None) if valor else None
+            if isinstance(valor, unicode):
+                valor = valor.encode('utf-8')
+            valores.append(valor)
+        return valores
     def serialize(self, format='csv'):
         """
         Retorna a representação em CSV de toda a agregação.
         """
-        utf8_recoder = lambda s: s.encode('utf-8') if isinstance(s, unicode) \
-            else s # funcao auxiliar de codificacao em utf-8
-        def getter(obj, atr):
-            if '/' in atr:
-                d, k = atr.split('/')
-                if getattr(obj, d, None):
-                    return getattr(obj, d, {}).get(k, None)
-                else:
-                    return None
-            else:
-                return getattr(obj, atr, None)
         s = sio() # buffer string IO
         w = csv_writer(s)
         # cabecalhos das colunas
-        cols = ['id', 'uri']
+        cols = self.identificacao(self.aggregator[0] if self.aggregator
+            else None)
         cols.extend(sorted(self.cols))
         w.writerow(cols)
         # valores das colunas
+        acessos = self.acessos(cols)
         for obj in self.aggregator:
-            w.writerow(map(
-                utf8_recoder, # csv_writer nao escreve unicode
-                (getter(obj, atr) for atr in cols)
-                ))
+            w.writerow(self.linha(obj, acessos))
         r = s.getvalue()
         s.close()
         return r
-        return self.aggregator
+    def serialize_iter(self, objetos, format='csv'):
+        """
+        Serializa em CSV os objetos a medida que sao lidos do iteravel,
+        gerando a representacao em partes (str), sem manter a agregacao na
+        memoria. As colunas sao as do primeiro objeto ou, se os objetos ja
+        estao numa lista (pagina lida por inteiro), as de todos eles, como
+        em serialize.
+        """
+        s = sio() # buffer string IO, esvaziado a cada linha
+        w = csv_writer(s)
+        cols = None
+        if isinstance(objetos, (list, tuple)):
+            todas = set()
+            for obj in objetos:
+                todas.update(self.colunas(obj))
+            cols = self.identificacao(objetos[0] if objetos else None)
+            cols.extend(sorted(todas))
+            w.writerow(cols)
+            acessos = self.acessos(cols)
+        for obj in objetos:
+            if cols is None:
+                # cabecalhos das colunas
+                cols = self.identificacao(obj)
+                cols.extend(sorted(self.colunas(obj)))
+                w.writerow(cols)
+                acessos = self.acessos(cols)
+            w.writerow(self.linha(obj, acessos))
+            self._qt_items += 1
+            yield s.getvalue()
+            s.seek(0)
+            s.truncate()
+        yield s.getvalue()
+        s.close()
 
 class RDFAggregator(Aggregator):
     def __init__(self, *args, **kw):
@@ -413,11 +752,16 @@ class RDFAggregator(Aggregator):
     def add(self, obj):
         """Acrescenta as triplas do objeto ao grafo agregador.
         """
+        for t in self.triplas(obj):
+            self.aggregator.add(t)
+    def triplas(self, obj):
+        """Gera as triplas do objeto: as do seu metodo de representacao
+        propria em rdf ou, se nao houver, as obtidas por heuristicas.
+        """
         if getattr(obj, 'repr_rdf', None):
             # objeto tem um metodo para representacao propria em rdf
-            triplas = obj.repr_rdf()
-            for t in triplas:
-                self.aggregator.add(t)
+            for t in obj.repr_rdf():
+                yield t
         else:
             # o objeto nao tem o metodo, tenta criar triplas por heuristicas
             subject = obj.uri
@@ -425,28 +769,29 @@ class RDFAggregator(Aggregator):
             if doc == subject:
                 doc = None
             class_uri = getattr(obj.__class__, '__class_uri__', None)
-            expostos = getattr(obj.__class__,self.atributo_serializar, set())
+            expostos = self.atributos(obj.__class__) \
+                if getattr(obj.__class__, self.atributo_serializar, None) else set()
             prop_map = getattr(obj.__class__, '__rdf_prop__', {})
-            g = self.aggregator
             #  classe
             if class_uri:
-                g.add((URIRef(subject), RDF['type'], URIRef(class_uri)))
+                yield (URIRef(subject), RDF['type'], URIRef(class_uri))
             # documento
             if doc:
-                g.add((URIRef(doc), RDF['type'], FOAF['Document']))
-                g.add((URIRef(subject), FOAF['isPrimaryTopicOf'], URIRef(doc)))
-                g.add((URIRef(doc), FOAF['primaryTopic'], URIRef(subject)))
+                yield (URIRef(doc), RDF['type'], FOAF['Document'])
+                yield (URIRef(subject), FOAF['isPrimaryTopicOf'], URIRef(doc))
+                yield (URIRef(doc), FOAF['primaryTopic'], URIRef(subject))
             #  nome
-            if getattr(obj, 'nome', None):
+            if getattr(obj, 'nome', None) and \
+                    (self.campos is None or 'nome' in self.campos):
                 if getattr(obj, '__rdf_prop__', None) is None or \
                         obj.__rdf_prop__.get('nome', None) is None:
-                    g.add((URIRef(subject), RDFS['label'], Literal(obj.nome)))
+                    yield (URIRef(subject), RDFS['label'], Literal(obj.nome))
             #  localizacao geo
-            if getattr(obj, 'geo_ponto', None):
+            if self.campos is None and getattr(obj, 'geo_ponto', None):
                 ponto = obj.geo_ponto
                 if ponto:
-                    g.add((URIRef(subject), GEO['lat'], Literal(ponto['lat'])))
-                    g.add((URIRef(subject), GEO['long'], Literal(ponto['lon'])))
+                    yield (URIRef(subject), GEO['lat'], Literal(ponto['lat']))
+                    yield (URIRef(subject), GEO['long'], Literal(ponto['lon']))
             #  propriedades
             for atr in expostos:
                 if atr in prop_map.keys():
@@ -455,14 +800,14 @@ class RDFAggregator(Aggregator):
                         triplas = prop_map[atr](obj)
                         if triplas:
                             for t in triplas:
-                                g.add(t)
+                                yield t
                     elif prop_map[atr].get('metodo', None):
                         # as triplas da propriedade sao dadas por um metodo
                         m = getattr(obj, prop_map[atr]['metodo'])
                         triplas = m(atr)
                         if triplas:
                             for t in triplas:
-                                g.add(t)
+                                yield t
                     elif prop_map[atr].get('pred_uri', None):
                         # a propriedade corresponde a uma unica tripla
                         pred_uri = prop_map[atr]['pred_uri']
@@ -472,17 +817,43 @@ class RDFAggregator(Aggregator):
                             obj_cls_uri = getattr(object, '__class_uri__', None)
                             # o objeto tem uri definida?
                             if obj_uri:
-                                g.add((URIRef(subject), URIRef(pred_uri), URIRef(obj_uri)))
+                                yield (URIRef(subject), URIRef(pred_uri), URIRef(obj_uri))
                             elif obj_cls_uri:
                                 # se o objeto nao tem uri mas tem uri da classe,
                                 # tenta criar blank node
                                 bn = BNode()
-                                g.add((URIRef(subject), URIRef(pred_uri), bn))
-                                g.add((bn, RDF['type'], URIRef(obj_cls_uri)))
-                                g.add((bn, RDFS['comment'], Literal(unicode(obj))))
+                                yield (URIRef(subject), URIRef(pred_uri), bn)
+                                yield (bn, RDF['type'], URIRef(obj_cls_uri))
+                                yield (bn, RDFS['comment'], Literal(unicode(obj)))
                             else:
                                 # caso contrario, tratar a propriedade como um literal
-                                g.add((URIRef(subject), URIRef(pred_uri), Literal(unicode(object))))
+                                yield (URIRef(subject), URIRef(pred_uri), Literal(unicode(object)))
+    def triplas_conjunto(self):
+        """Gera as triplas de descricao (void) do conjunto de dados: a
+        pagina atual, a proxima e o dataset geral.
+        """
+        current_url = self.dataset_split.get('current_url', '') # url do documento atual
+        dataset_url = self.dataset_split.get('dataset_url', '') # url geral do dataset
+        next_url = self.dataset_split.get('next_url', '') # url da proxima pagina
+        # a uri do dataset: url do documento acrescida de #dataset
+        if current_url:
+            yield (URIRef(current_url+"#dataset"),RDF['type'],VOID['Dataset'])
+            yield (URIRef(current_url),RDF['type'],VOID['DatasetDescription'])
+            yield (URIRef(current_url),FOAF['primaryTopic'],URIRef(current_url+"#dataset"))
+            if next_url:
+                yield (URIRef(current_url+"#dataset"),RDFS['seeAlso'],URIRef(next_url+"#dataset"))
+        if next_url:
+            yield (URIRef(next_url+"#dataset"),RDF['type'], VOID['Dataset'])
+            yield (URIRef(next_url),RDF['type'],VOID['DatasetDescription'])
+            yield (URIRef(next_url),FOAF['primaryTopic'],URIRef(next_url+"#dataset"))
+        if dataset_url:
+            yield (URIRef(dataset_url+"#dataset"),RDF['type'], VOID['Dataset'])
+            yield (URIRef(dataset_url),RDF['type'],VOID['DatasetDescription'])
+            yield (URIRef(dataset_url),FOAF['primaryTopic'],URIRef(dataset_url+"#dataset"))
+            if current_url:
+                yield (URIRef(dataset_url+"#dataset"),VOID['subset'],URIRef(current_url+"#dataset"))
+            if next_url:
+                yield (URIRef(dataset_url+"#dataset"),VOID['subset'],URIRef(next_url+"#dataset"))
     def serialize(self, format="n3"):
         """Retorna a serializacao do agregador RDF (uniao dos grafos).
         """
@@ -495,29 +866,40 @@ class RDFAggregator(Aggregator):
             'nt': 'nt',
         }
         f = format_map.get(format, 'n3')
-        current_url = self.dataset_split.get('current_url', '') # url do documento atual
-        dataset_url = self.dataset_split.get('dataset_url', '') # url geral do dataset
-        next_url = self.dataset_split.get('next_url', '') # url da proxima pagina
-        # a uri do dataset: url do documento acrescida de #dataset
-        if current_url:
-            self.aggregator.add((URIRef(current_url+"#dataset"),RDF['type'],VOID['Dataset']))
-            self.aggregator.add((URIRef(current_url),RDF['type'],VOID['DatasetDescription']))
-            self.aggregator.add((URIRef(current_url),FOAF['primaryTopic'],URIRef(current_url+"#dataset")))
-            if next_url:
-                self.aggregator.add((URIRef(current_url+"#dataset"),RDFS['seeAlso'],URIRef(next_url+"#dataset")))
-        if next_url:
-            self.aggregator.add((URIRef(next_url+"#dataset"),RDF['type'], VOID['Dataset']))
-            self.aggregator.add((URIRef(next_url),RDF['type'],VOID['DatasetDescription']))
-            self.aggregator.add((URIRef(next_url),FOAF['primaryTopic'],URIRef(next_url+"#dataset")))
-        if dataset_url:
-            self.aggregator.add((URIRef(dataset_url+"#dataset"),RDF['type'], VOID['Dataset']))
-            self.aggregator.add((URIRef(dataset_url),RDF['type'],VOID['DatasetDescription']))
-            self.aggregator.add((URIRef(dataset_url),FOAF['primaryTopic'],URIRef(dataset_url+"#dataset")))
-            if current_url:
-                self.aggregator.add((URIRef(dataset_url+"#dataset"),VOID['subset'],URIRef(current_url+"#dataset")))
-            if next_url:
-                self.aggregator.add((URIRef(dataset_url+"#dataset"),VOID['subset'],URIRef(next_url+"#dataset")))
+        for t in self.triplas_conjunto():
+            self.aggregator.add(t)
         return self.aggregator.serialize(format=f)
+    def serialize_iter(self, objetos, format="n3"):
+        """Serializa os objetos em rdf a medida que sao lidos do iteravel,
+        escrevendo as triplas de cada objeto diretamente (N-Triples, Turtle
+        ou RDF/XML), sem montar o grafo. Os demais formatos, ou todos se
+        configurado 'rdf.rdflib', sao serializados pelo rdflib.
+
+        Sem o grafo, as triplas repetidas nao sao eliminadas; apenas as de
+        sujeitos compartilhados entre os objetos (como os estados da
+        DBPedia, nos municipios) sao escritas uma so vez.
+        """
+        escritor = triplas_rdf.escritor(format)
+        if escritor is None:
+            return super(RDFAggregator, self).serialize_iter(objetos, format)
+        return self._serialize_iter(escritor, objetos)
+    def _serialize_iter(self, escritor, objetos):
+        compartilhadas = set()
+        def novas(obj):
+            proprios = set(URIRef(uri) for uri in (getattr(obj, 'uri', None),
+                getattr(obj, 'doc_uri', None)) if uri)
+            for t in self.triplas(obj):
+                if isinstance(t[0], BNode) or t[0] in proprios:
+                    yield t
+                elif t not in compartilhadas:
+                    compartilhadas.add(t)
+                    yield t
+        yield escritor.cabecalho()
+        for obj in objetos:
+            yield escritor.escreve(novas(obj))
+            self._qt_items += 1
+        yield escritor.escreve(self.triplas_conjunto())
+        yield escritor.rodape()
 
 class ExposedObject(object):
     """Classe base para um objeto exposto no webservice.
@@ -569,8 +951,7 @@ class ExposedObject(object):
         """
         name = self.uri
         ag = RDFAggregator(name, atributo_serializar)
-        ag.add(self)
-        return ag.serialize(format=format)
+        return "".join(ag.serialize_iter([self], format=format))
     def to_xml(self, atributo_serializar="__expostos__"):
         """Expoe o conteudo do objeto em formato XML.
         """
@@ -589,25 +970,15 @@ class ExposedObject(object):
         ag.add(self)
         ag.dataset_split['current_url'] = self.doc_uri+".html"
         return ag.serialize()
-    def item_json(self, atributo_serializar="__expostos__"):
+    def item_json(self, atributo_serializar="__expostos__", campos=None):
         """Representacao completa em JSON do objeto.
+        Se campos for informado, apenas esses atributos sao representados.
         """
-        formata_nome = lambda nome: \
-            nome[5:] if nome.startswith('href_') else nome
-        def formata_valor(valor):
-            if isinstance(valor, URIRef):
-                return {'href': str(valor)}
-            elif isinstance(valor, date) or \
-                    isinstance(valor, time) or \
-                    isinstance(valor, datetime):
-                return valor.isoformat()
-            elif isinstance(valor, Decimal):
-                return "%0.2f" % valor
-            else:
-                return valor
-        chaves = (formata_nome(n) for n in getattr(self,atributo_serializar))
-        valores = (formata_valor(getattr(self, atr, None)) for atr in getattr(self,atributo_serializar))
-        dados = dict(zip(chaves, valores))
+        dados = {}
+        for campo in plano_campos(self, atributo_serializar).seleciona(campos):
+            valor = getattr(self, campo.atr, None)
+            formata = formatadores_json.get(especie(valor))
+            dados[campo.nome] = valor if formata is None else formata(valor)
         id = getattr(self, "id", None)
         if id:
             dados["id"] = id
@@ -1,14 +1,68 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import sqlite3
+from itertools import product
+from StringIO import StringIO
+from datetime import date, datetime
+from decimal import Decimal
 from unittest import TestCase
-from model import Session, engine
-from model import Fornecedor, FornecedorPF, FornecedorPJ
+
+from amara.writers import struct
+from rdflib import Graph, URIRef, Literal, BNode
+from rdflib.compare import isomorphic
+from rdflib.namespace import RDF, RDFS, XSD
+
+from sqlalchemy import create_engine, MetaData, Table, Column, Integer
+from sqlalchemy import select, types, event
+from sqlalchemy.orm import Session as SessaoBase
+from pyramid.request import Request
+from pyramid.testing import DummyRequest
+from webob.multidict import MultiDict
+
+from paginacao import codifica_cursor, decodifica_cursor
+from paginacao import predicado_seek, predicado_seek_ordenado
+from paginacao import chaves_primarias
+from expressoes import analisa_expressao, atomos, forma
+from expressoes import OU, E, NAO, MAX_ATOMOS, MAX_PROFUNDIDADE
+from contagem import cache_contagem, contagem_sem_consulta
+from contagem import MarcadorCarga, registra_carga, geracao_relogio
+from contagem import carga_atrasada, expiracao_cache
+from custo import LimitesCusto
+import contagem
+from model import Base, fronteiras_offset
+from model import Programa, NaturezaJuridica, programa_atende_a
+from model import HabilitacaoAreaAtuacao, PessoaResponsavel
+from model import Municipio, Proponente, Convenio, ConvenioPrograma, Emenda
+from carregamento import atributos_necessarios, plano_carregamento
+from carregamento import opcoes_carregamento
+from linhas import plano_linhas
+from planos import PlanoConsulta
+from agregacao import PlanoAgregacao
+from webservice import Resource, ConsultaConvenios
+import replicas
+from replicas import RoteadorReplicas, SessaoLeitura
+from webservice import LinkedDataResource, LinkedDataCollection
+from webservice import classes_suportadas, carregamento_detalhe
+from replicas import SessionLeitura
+from namespace import LIC
+from triplas import escritores
+from serializer import XMLAggregator
+from fronteiras import procura, le_fronteiras, fronteira_offset
+from fronteiras import cache_fronteiras, INTERVALO_FRONTEIRAS
+from fronteiras import prepara_tabela
+
+try:
+    from model import Session, engine
+    from model import Fornecedor, FornecedorPF, FornecedorPJ
+except ImportError:
+    # classes do modelo antigo, ainda nao portadas para o modelo atual
+    Session = engine = Fornecedor = FornecedorPF = FornecedorPJ = None
 
 def popula():
     session = Session()
     session.add_all( # TODO: fazer construtores
-        FornecedorPJ(cpf="00000000000134", nome="Banco do Brasil S/A"), 
+        FornecedorPJ(cpf="00000000000134", nome="Banco do Brasil S/A"),
         FornecedorPF(cpf="00000000000", nome="Fulano de tal"),
     )
 
@@ -23,3 +77,930 @@ class TesteFornecedorPorCPF(TestCase):
 class TesteFornecedorPorUF(TestCase):
     def setUp(self):
         popula()
+
+class TesteCursor(TestCase):
+    """Codificacao e decodificacao do cursor opaco da paginacao."""
+
+    def test_ida_e_volta(self):
+        cursor = codifica_cursor([date(2012, 3, 1), Decimal("10.50"), 7],
+            40, "-data_assinatura")
+        self.assertEqual(decodifica_cursor(cursor),
+            ([u"2012-03-01", u"10.50", 7], 40, u"-data_assinatura"))
+
+    def test_sem_ordem(self):
+        self.assertEqual(decodifica_cursor(codifica_cursor([1, 2], 0)),
+            ([1, 2], 0, None))
+
+    def test_cursor_opaco_sem_preenchimento(self):
+        cursor = codifica_cursor([123456], 500)
+        self.assertFalse(cursor.endswith("="))
+        self.assertFalse("/" in cursor or "+" in cursor)
+
+    def test_cursores_invalidos(self):
+        for cursor in ("", "abc", "!!!", codifica_cursor({}, 0)[:-2],
+                "eyJrIjo1LCJwIjoxfQ",   # {"k":5,"p":1}: valores nao sao lista
+                "eyJrIjpbMV0sInAiOi0xfQ"):  # {"k":[1],"p":-1}
+            self.assertRaises(ValueError, decodifica_cursor, cursor)
+
+class TesteSeek(TestCase):
+    """Criterios de seek (paginacao por cursor) avaliados no banco de
+    dados, comparados a ordenacao calculada em Python.
+    """
+
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+        metadata = MetaData()
+        self.tabela = Table("t", metadata,
+            Column("a", Integer, primary_key=True, autoincrement=False),
+            Column("b", Integer, primary_key=True, autoincrement=False),
+            Column("c", Integer))
+        metadata.create_all(self.engine)
+        self.linhas = [(a, b, c) for a, b in product(range(4), range(4))
+            for c in [None if (a + b) % 5 == 0 else (a * b) % 3]]
+        self.engine.execute(self.tabela.insert(), [dict(zip("abc", linha))
+            for linha in self.linhas])
+
+    def seleciona(self, criterio):
+        t = self.tabela
+        return set(tuple(linha) for linha in self.engine.execute(
+            select([t.c.a, t.c.b, t.c.c], criterio)))
+
+    def test_chave_simples(self):
+        t = self.tabela
+        for valor in range(-1, 5):
+            self.assertEqual(self.seleciona(predicado_seek([t.c.a], [valor])),
+                set(l for l in self.linhas if l[0] > valor))
+            self.assertEqual(self.seleciona(predicado_seek([t.c.a], [valor],
+                True)), set(l for l in self.linhas if l[0] < valor))
+
+    def test_chave_composta(self):
+        t = self.tabela
+        for chave in product(range(-1, 5), repeat=2):
+            self.assertEqual(
+                self.seleciona(predicado_seek([t.c.a, t.c.b], list(chave))),
+                set(l for l in self.linhas if l[:2] > chave))
+            self.assertEqual(
+                self.seleciona(predicado_seek([t.c.a, t.c.b], list(chave),
+                    True)),
+                set(l for l in self.linhas if l[:2] < chave))
+
+    def test_chave_composta_com_limite_inicial(self):
+        # o limite na primeira coluna permite percorrer o indice da chave
+        t = self.tabela
+        sql = str(predicado_seek([t.c.a, t.c.b], [1, 2]))
+        self.assertTrue(sql.startswith("t.a >= :a_1 AND "), sql)
+        sql = str(predicado_seek([t.c.a, t.c.b], [1, 2], True))
+        self.assertTrue(sql.startswith("t.a <= :a_1 AND "), sql)
+
+    def test_ordenado_com_nulos(self):
+        # todas as posicoes de cursor, nas duas direcoes e nas duas
+        # posicoes dos nulos (fim ou inicio da ordem crescente)
+        t = self.tabela
+        for nulos_maiores, decrescente in product((True, False), repeat=2):
+            def ordem(linha):
+                c = linha[2]
+                return ((1 if nulos_maiores else -1, 0) if c is None
+                    else (0, c), linha[0], linha[1])
+            for ultimo in self.linhas:
+                criterio = predicado_seek_ordenado(t.c.c, decrescente,
+                    ultimo[2], [t.c.a, t.c.b], list(ultimo[:2]),
+                    nulos_maiores)
+                if decrescente:
+                    esperadas = set(l for l in self.linhas
+                        if ordem(l) < ordem(ultimo))
+                else:
+                    esperadas = set(l for l in self.linhas
+                        if ordem(l) > ordem(ultimo))
+                self.assertEqual(self.seleciona(criterio), esperadas,
+                    (nulos_maiores, decrescente, ultimo))
+
+    def test_ordenado_com_limite_inicial(self):
+        # os nao nulos sao limitados pela coluna de ordenacao; os nulos
+        # ficam numa alternativa separada
+        t = self.tabela
+        sql = str(predicado_seek_ordenado(t.c.c, False, 1, [t.c.a, t.c.b],
+            [1, 2], True))
+        self.assertTrue(sql.startswith("t.c >= :c_1 AND "), sql)
+        self.assertTrue(sql.endswith(" OR t.c IS NULL"), sql)
+        sql = str(predicado_seek_ordenado(t.c.c, True, 1, [t.c.a, t.c.b],
+            [1, 2], True))
+        self.assertTrue(sql.startswith("t.c <= :c_1 AND "), sql)
+
+    def test_cursor_nao_corresponde_a_chave(self):
+        t = self.tabela
+        self.assertRaises(ValueError, predicado_seek, [t.c.a, t.c.b], [1])
+
+class TesteMarcadorCarga(TestCase):
+    """Marcador da carga noturna, gravado no banco de dados pela carga."""
+
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+        self.anterior = contagem.marcador_carga
+        cache_contagem.invalida()
+
+    def tearDown(self):
+        contagem.marcador_carga = self.anterior
+        cache_contagem.invalida()
+
+    def test_sem_carga_registrada(self):
+        # sem a tabela ou sem carga registrada, vale o horario previsto
+        marcador = MarcadorCarga(self.engine, 0)
+        self.assertEqual(marcador.le(), None)
+        self.assertEqual(marcador.atual(), geracao_relogio())
+
+    def test_carga_registrada(self):
+        marcador = MarcadorCarga(self.engine, 0)
+        termino = registra_carga(self.engine, datetime(2013, 5, 2, 4, 15))
+        self.assertEqual(marcador.atual(), termino)
+        termino = registra_carga(self.engine, datetime(2013, 5, 3, 5, 40))
+        self.assertEqual(marcador.atual(), termino)
+
+    def test_intervalo_entre_leituras(self):
+        marcador = MarcadorCarga(self.engine, 3600)
+        termino = registra_carga(self.engine, datetime(2013, 5, 2, 4, 15))
+        self.assertEqual(marcador.atual(), termino)
+        registra_carga(self.engine, datetime(2013, 5, 3, 5, 40))
+        self.assertEqual(marcador.atual(), termino)
+
+    def test_carga_descarta_contagens(self):
+        # a carga terminada apos as 3:00 tambem descarta as contagens
+        contagem.marcador_carga = MarcadorCarga(self.engine, 0)
+        registra_carga(self.engine, datetime(2013, 5, 2, 4, 15))
+        chave = ("metodo", ())
+        cache_contagem.guarda(chave, 42)
+        self.assertEqual(cache_contagem.obtem(chave), 42)
+        registra_carga(self.engine, datetime(2013, 5, 3, 5, 40))
+        self.assertEqual(cache_contagem.obtem(chave), None)
+
+    def test_expiracao_cache(self):
+        contagem.marcador_carga = MarcadorCarga(self.engine, 0)
+        registra_carga(self.engine, datetime(2013, 5, 2, 2, 40))
+        agora = datetime(2013, 5, 2, 10, 0)
+        self.assertFalse(carga_atrasada(agora))
+        self.assertEqual(expiracao_cache(agora), datetime(2013, 5, 3, 3, 0))
+        # a carga da noite seguinte atrasou: revalida a cada leitura do
+        # marcador, ate que ela termine
+        agora = datetime(2013, 5, 3, 4, 0)
+        self.assertTrue(carga_atrasada(agora))
+        self.assertEqual(expiracao_cache(agora), agora)
+        registra_carga(self.engine, datetime(2013, 5, 3, 4, 30))
+        self.assertEqual(expiracao_cache(datetime(2013, 5, 3, 4, 31)),
+            datetime(2013, 5, 4, 3, 0))
+
+    def test_etag(self):
+        # a e-tag so muda quando a carga e' registrada, a qualquer hora
+        contagem.marcador_carga = MarcadorCarga(self.engine, 0)
+        class Requisicao(object):
+            url = "http://localhost/v1/consulta/convenios.json"
+        class Recurso(object):
+            request = Requisicao()
+        etag = Resource.etag.im_func
+        registra_carga(self.engine, datetime(2013, 5, 2, 2, 40))
+        anterior = etag(Recurso())
+        self.assertEqual(etag(Recurso()), anterior)
+        registra_carga(self.engine, datetime(2013, 5, 3, 9, 50))
+        self.assertNotEqual(etag(Recurso()), anterior)
+
+class TesteContagemSemConsulta(TestCase):
+    """Contagens resolvidas sem consultar o banco de dados."""
+
+    def setUp(self):
+        cache_contagem.invalida()
+
+    def tearDown(self):
+        cache_contagem.invalida()
+
+    def test_nenhuma(self):
+        self.assertEqual(contagem_sem_consulta('nenhuma'), (None, 'nenhuma'))
+
+    def test_cache(self):
+        chave = ("metodo", ())
+        self.assertEqual(contagem_sem_consulta('cache', chave), None)
+        cache_contagem.guarda(chave, 42)
+        self.assertEqual(contagem_sem_consulta('cache', chave), (42, 'cache'))
+        self.assertEqual(contagem_sem_consulta('exata', chave), None)
+
+    def test_demais_modos_consultam(self):
+        for modo in ('exata', 'estimada', 'cache'):
+            self.assertEqual(contagem_sem_consulta(modo), None)
+
+class MetodoFalso(object):
+    id = "consulta_teste"
+    ordem = None
+
+    def __init__(self, offset):
+        self.offset = offset
+
+class PlanoFalso(object):
+    expressao = None
+    criterios = []
+
+class TesteFronteiras(TestCase):
+    """Procura das fronteiras da paginacao por offset."""
+
+    def setUp(self):
+        self.anterior = contagem.marcador_carga
+        engine = create_engine("sqlite://")
+        contagem.marcador_carga = MarcadorCarga(engine, 0)
+        self.geracao = registra_carga(engine, datetime(2013, 5, 2, 4, 15))
+        cache_fronteiras.invalida()
+        fronteiras_offset.create(engine)
+        self.fronteiras = [(INTERVALO_FRONTEIRAS * n, u"cursor%d" % n)
+            for n in range(1, 4)]
+        engine.execute(fronteiras_offset.insert(), [{'metodo': MetodoFalso.id,
+            'ordem': u"", 'posicao': posicao, 'cursor': cursor,
+            'geracao': self.geracao} for posicao, cursor in self.fronteiras])
+        self.engine = engine
+        self.session = SessaoBase(bind=engine)
+
+    def tearDown(self):
+        self.session.close()
+        contagem.marcador_carga = self.anterior
+        cache_fronteiras.invalida()
+
+    def test_procura(self):
+        self.assertEqual(procura([], 700), None)
+        self.assertEqual(procura(self.fronteiras, 499), None)
+        self.assertEqual(procura(self.fronteiras, 500), self.fronteiras[0])
+        self.assertEqual(procura(self.fronteiras, 1499), self.fronteiras[1])
+        self.assertEqual(procura(self.fronteiras, 9999), self.fronteiras[2])
+
+    def test_le_fronteiras(self):
+        self.assertEqual(le_fronteiras(self.session, MetodoFalso.id, u""),
+            (self.geracao, self.fronteiras))
+        self.assertEqual(le_fronteiras(self.session, MetodoFalso.id, u"-a"),
+            (None, []))
+
+    def test_sem_tabela(self):
+        session = SessaoBase(bind=create_engine("sqlite://"))
+        self.assertEqual(le_fronteiras(session, MetodoFalso.id, u""),
+            (None, []))
+        self.assertEqual(fronteira_offset(MetodoFalso(700), PlanoFalso(),
+            session, {}), None)
+
+    def test_carga_atual(self):
+        self.assertEqual(fronteira_offset(MetodoFalso(1200), PlanoFalso(),
+            self.session, {}), self.fronteiras[1])
+
+    def test_carga_anterior(self):
+        # fronteiras gravadas antes da ultima carga: offset simples, e as
+        # fronteiras nao sao guardadas ate que a tabela seja regravada
+        registra_carga(self.engine, datetime(2013, 5, 3, 5, 40))
+        self.assertEqual(fronteira_offset(MetodoFalso(1200), PlanoFalso(),
+            self.session, {}), None)
+        self.assertEqual(cache_fronteiras.entradas, {})
+
+    def test_nova_carga_descarta_guardadas(self):
+        self.assertEqual(fronteira_offset(MetodoFalso(1200), PlanoFalso(),
+            self.session, {}), self.fronteiras[1])
+        registra_carga(self.engine, datetime(2013, 5, 3, 5, 40))
+        self.assertEqual(fronteira_offset(MetodoFalso(1200), PlanoFalso(),
+            self.session, {}), None)
+
+    def test_nao_guarda_fronteiras_de_outra_carga(self):
+        registra_carga(self.engine, datetime(2013, 5, 3, 5, 40))
+        cache_fronteiras.guarda("chave", self.fronteiras, self.geracao)
+        self.assertEqual(cache_fronteiras.obtem("chave"), None)
+
+    def test_offset_pequeno(self):
+        self.assertEqual(fronteira_offset(MetodoFalso(499), PlanoFalso(),
+            self.session, {}), None)
+
+    def test_prepara_tabela(self):
+        # a tabela atual e' mantida; a de versao anterior, recriada
+        prepara_tabela(self.engine)
+        self.assertEqual(le_fronteiras(self.session, MetodoFalso.id, u""),
+            (self.geracao, self.fronteiras))
+        engine = create_engine("sqlite://")
+        Table(fronteiras_offset.name, MetaData(),
+            Column("metodo", Integer, primary_key=True)).create(engine)
+        prepara_tabela(engine)
+        session = SessaoBase(bind=engine)
+        self.assertEqual(le_fronteiras(session, MetodoFalso.id, u""),
+            (None, []))
+        session.close()
+
+def valor_coluna(tipo):
+    '''
+    Valor de teste para uma coluna do tipo informado. Chaves primarias e
+    estrangeiras recebem o mesmo valor, de modo que todos os
+    relacionamentos encontram o registro relacionado.
+    '''
+    if isinstance(tipo, types.Boolean):
+        return True
+    elif isinstance(tipo, types.Integer):
+        return 1
+    elif isinstance(tipo, types.Numeric):
+        return Decimal("1.5")
+    elif isinstance(tipo, types.DateTime):
+        return datetime(2012, 3, 1, 10, 30)
+    elif isinstance(tipo, types.Date):
+        return date(2012, 3, 1)
+    return u"1"
+
+def insere(engine, tabela, **valores):
+    '''
+    Insere um registro na tabela com os valores informados e, nas demais
+    colunas, os valores de teste (ver valor_coluna).
+    '''
+    registro = dict((coluna.name, valor_coluna(coluna.type))
+        for coluna in tabela.columns)
+    desconhecidas = set(valores) - set(registro)
+    if desconhecidas:
+        raise ValueError(u"Colunas desconhecidas em %s: %s" % (tabela.name,
+            u", ".join(sorted(desconhecidas))))
+    registro.update(valores)
+    engine.execute(tabela.insert(), registro)
+
+class ContadorConsultas(object):
+    """Conta os comandos SQL executados no engine enquanto ativo (with)."""
+
+    def __init__(self, engine):
+        self.consultas = []
+        self.ativo = False
+        # o SQLAlchemy 0.7 nao remove ouvintes: o contador so e' desativado
+        event.listen(engine, 'before_cursor_execute', self.registra)
+
+    def registra(self, conn, cursor, sql, parametros, contexto, varios):
+        if self.ativo:
+            self.consultas.append(sql)
+
+    def __enter__(self):
+        self.ativo = True
+        return self
+
+    def __exit__(self, *excecao):
+        self.ativo = False
+
+def identidade(valor):
+    '''
+    Objetos do modelo (carregados pelo ORM ou leves) sao comparados pela
+    classe e pela chave primaria; os demais valores, diretamente.
+    '''
+    if not isinstance(valor, Base):
+        return valor
+    return (type(valor), tuple(getattr(valor, chave)
+        for chave in chaves_primarias(type(valor))))
+
+class TesteLinhas(TestCase):
+    """Leitura das listagens em linhas comparada a leitura pelo ORM: cada
+    campo exposto de cada classe deve ter o mesmo valor nos dois modos.
+    Um atributo ausente do objeto leve (dependencia nao declarada) levanta
+    AttributeError, em vez de virar nulo na resposta.
+    """
+
+    def setUp(self):
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(engine)
+        for tabela in Base.metadata.sorted_tables:
+            engine.execute(tabela.insert(), dict((coluna.name,
+                valor_coluna(coluna.type)) for coluna in tabela.columns))
+        self.session = SessaoBase(bind=engine)
+
+    def tearDown(self):
+        self.session.close()
+
+    def compara(self, cls, campos):
+        plano = plano_linhas(cls, atributos_necessarios(cls, campos),
+            plano_carregamento(cls, campos))
+        if plano is None:
+            return False
+        ordenacao = [getattr(cls, chave) for chave in chaves_primarias(cls)]
+        linha = plano.consulta([], ordenacao).with_session(self.session) \
+            .first()
+        leve = plano.objeto(linha)
+        completo = self.session.query(cls).order_by(*ordenacao).first()
+        for campo in campos:
+            self.assertEqual(identidade(getattr(leve, campo)),
+                identidade(getattr(completo, campo)), (cls.__name__, campo))
+        return True
+
+    def test_campos_expostos(self):
+        comparadas = 0
+        for cls in Base.__subclasses__():
+            expostos = sorted(getattr(cls, '__expostos__', []))
+            if not expostos:
+                continue
+            # todos os campos e cada campo isolado (o plano de um campo
+            # le apenas as colunas de que ele depende)
+            if self.compara(cls, expostos):
+                comparadas += 1
+            for campo in expostos:
+                self.compara(cls, [campo])
+        self.assertTrue(comparadas > 0)
+
+class TesteDependencias(TestCase):
+    """Atributos derivados que dependem de relacionamentos sao carregados
+    antecipadamente, sem uma consulta por registro.
+    """
+
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+        Base.metadata.create_all(self.engine)
+        insere(self.engine, PessoaResponsavel.__table__, id=u"p1",
+            cpf=u"***456789**")
+        for n in range(1, 4):
+            insere(self.engine, HabilitacaoAreaAtuacao.__table__, id=n,
+                id_pessoa_responsavel=u"p1")
+        self.session = SessaoBase(bind=self.engine)
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_cpf_responsavel_da_habilitacao(self):
+        cls = HabilitacaoAreaAtuacao
+        carregamento = plano_carregamento(cls, ['cpf_responsavel'])
+        self.assertEqual(carregamento, [('pessoa_responsavel', 'joined')])
+        with ContadorConsultas(self.engine) as contador:
+            objetos = self.session.query(cls).options(
+                *opcoes_carregamento(carregamento)).all()
+            self.assertEqual([obj.cpf_responsavel for obj in objetos],
+                [u"***456789**"] * 3)
+        self.assertEqual(len(contador.consultas), 1)
+
+def metodo_api(classe):
+    '''
+    Instancia o metodo da API sem requisicao, apenas com os atributos da
+    classe (parametros, modelo e carregamento), para montar os seus planos.
+    '''
+    return classe.__new__(classe)
+
+def popula_convenios(engine):
+    '''
+    Convenios 1 a 4, dos proponentes 1 (Recife, PE; convenios impares) e 2
+    (Santos, SP; convenios pares), cada um com os programas 100 e 101.
+    '''
+    insere(engine, Municipio.__table__, id=1, nome=u"Recife", uf=u"PE")
+    insere(engine, Municipio.__table__, id=2, nome=u"Santos", uf=u"SP")
+    insere(engine, PessoaResponsavel.__table__, id=u"p1")
+    for n in (1, 2):
+        insere(engine, Proponente.__table__, id=n, id_municipio=n,
+            id_responsavel=u"p1")
+    for programa in (100, 101):
+        insere(engine, Programa.__table__, id=programa)
+    for n in range(1, 5):
+        insere(engine, Convenio.__table__, id=n, id_proponente=2 - n % 2,
+            valor_global=Decimal(1000 * n))
+        for programa in (100, 101):
+            insere(engine, ConvenioPrograma.__table__, id_convenio=n,
+                id_programa=programa, valor_global=Decimal(1))
+
+class TesteFiltrosSemiJoin(TestCase):
+    """Filtros por caminhos de relacionamentos (IN e EXISTS, sem juncoes
+    que multiplicariam os registros).
+    """
+
+    def setUp(self):
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(engine)
+        popula_convenios(engine)
+        self.session = SessaoBase(bind=engine)
+
+    def tearDown(self):
+        self.session.close()
+
+    def consulta(self, **filtros):
+        params = frozenset((param, len(valor) if isinstance(valor, list)
+            else None) for param, valor in filtros.items())
+        plano = PlanoConsulta(metodo_api(ConsultaConvenios), params)
+        valores = plano.valores(dict((param, {'value': valor})
+            for param, valor in filtros.items()))
+        # os criterios sao subconsultas, sem juncoes na consulta principal
+        self.assertFalse("JOIN" in str(plano.filtrada.statement)
+            .split("\nWHERE ", 1)[1])
+        return ([obj.id for obj in plano.consulta(self.session,
+            valores).all()], plano.conta(self.session, valores))
+
+    def test_muitos_para_um(self):
+        self.assertEqual(self.consulta(uf=u"PE"), ([1, 3], 2))
+        self.assertEqual(self.consulta(uf=u"PE", id_proponente=2), ([], 0))
+
+    def test_colecao(self):
+        # cada convenio tem os dois programas, mas aparece uma so vez
+        self.assertEqual(self.consulta(id_programa=[100, 101]),
+            ([1, 2, 3, 4], 4))
+        self.assertEqual(self.consulta(id_programa=[100], uf=u"SP"),
+            ([2, 4], 2))
+
+class MetodoProgramas(object):
+    """Metodo de consulta a programas, com a colecao atende_a carregada por
+    juncao (preloaded_atrs), como em webservice.ConsultaProgramas.
+    """
+    model_class = Programa
+    parameters = {}
+    atributos_serializar = '__resumidos__'
+    carregamento = None
+    preloaded_atrs = ['atende_a']
+    subquery_atrs = []
+
+class TesteLotes(TestCase):
+    """Leitura em lotes (modo em lote das listagens) com colecoes."""
+
+    def setUp(self):
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(engine)
+        for n in range(1, 5):
+            insere(engine, NaturezaJuridica.__table__, id=n)
+        for programa in range(1, 5):
+            insere(engine, Programa.__table__, id=programa)
+            for n in range(1, 5):
+                insere(engine, programa_atende_a, id_programa=programa,
+                    id_natureza_juridica=n)
+        self.session = SessaoBase(bind=engine)
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_colecao_juntada(self):
+        # a juncao repete cada programa por item da colecao: os lotes nao
+        # podem dividir um programa (registros repetidos, colecoes parciais)
+        plano = PlanoConsulta(MetodoProgramas(), frozenset(),
+            campos=['atende_a'])
+        self.assertTrue(plano.colecoes)
+        objetos = list(plano.lotes(self.session, {}, 10, 2))
+        self.assertEqual([obj.id for obj in objetos], [1, 2, 3, 4])
+        self.assertEqual([len(obj.atende_a) for obj in objetos], [4] * 4)
+
+    def test_limite_e_continuacao(self):
+        plano = PlanoConsulta(MetodoProgramas(), frozenset(),
+            campos=['atende_a'])
+        objetos = list(plano.lotes(self.session, {}, 3, 2, ultimos=[1]))
+        self.assertEqual([obj.id for obj in objetos], [2, 3, 4])
+        self.assertEqual([len(obj.atende_a) for obj in objetos], [4] * 3)
+
+class TesteConsultaIds(TestCase):
+    """Consulta de varios recursos pelo parametro 'ids' (numa so consulta,
+    na ordem solicitada).
+    """
+
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+        Base.metadata.create_all(self.engine)
+        popula_convenios(self.engine)
+        for programa, numero in ((100, 1), (100, 2), (101, 1)):
+            insere(self.engine, Emenda.__table__, id_programa=programa,
+                numero=numero, id_programa_qualificacao=5)
+        SessionLeitura.configure(bind=self.engine)
+
+    def tearDown(self):
+        SessionLeitura.remove()
+        SessionLeitura.configure(bind=None)
+
+    def colecao(self, cls, *ids):
+        request = DummyRequest(params=MultiDict(('ids', valor)
+            for valor in ids))
+        request.matchdict = {'classe': cls.__slug_item__, 'formato': 'json'}
+        colecao = LinkedDataCollection(cls, request)
+        if colecao.response is None:
+            colecao.session.close()
+        return colecao
+
+    def test_ordem_solicitada(self):
+        with ContadorConsultas(self.engine) as um:
+            self.colecao(Convenio, u"1")
+        with ContadorConsultas(self.engine) as varios:
+            colecao = self.colecao(Convenio, u"3,1,2,99,1")
+        # repetidos e inexistentes sao ignorados
+        self.assertEqual([obj.id for obj in colecao.result], [3, 1, 2])
+        # as mesmas consultas para um ou varios recursos
+        self.assertEqual(len(varios.consultas), len(um.consultas))
+
+    def test_limite(self):
+        ids = u",".join(str(n) for n in range(1, 501))
+        self.assertEqual([obj.id for obj in self.colecao(Convenio,
+            ids).result], [1, 2, 3, 4])
+        colecao = self.colecao(Convenio, ids + u",501")
+        self.assertEqual(colecao.response.status_int, 400)
+        self.assertEqual(colecao.result, None)
+
+    def test_chave_composta(self):
+        colecao = self.colecao(Emenda, u"101,1,5", u"100,9,5", u"100,1,5")
+        self.assertEqual([(obj.id_programa, obj.numero)
+            for obj in colecao.result], [(101, 1), (100, 1)])
+        # cada identificador deve ter todas as partes da chave
+        self.assertEqual(self.colecao(Emenda, u"100,1").response.status_int,
+            400)
+
+class TesteCarregamentoDetalhe(TestCase):
+    """Paginas de detalhe: os relacionamentos expostos sao carregados pelo
+    plano da classe, com um numero fixo de consultas.
+    """
+
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+        Base.metadata.create_all(self.engine)
+        for tabela in Base.metadata.sorted_tables:
+            insere(self.engine, tabela)
+        SessionLeitura.configure(bind=self.engine)
+
+    def tearDown(self):
+        SessionLeitura.remove()
+        SessionLeitura.configure(bind=None)
+
+    def consultas_detalhe(self, slug):
+        cls = classes_suportadas[slug]
+        ids = u",".join(u"1" for chave in chaves_primarias(cls))
+        request = Request.blank("/dados/%s/%s.json" % (slug, ids))
+        request.matchdict = {'classe': slug, 'id': ids, 'formato': 'json'}
+        with ContadorConsultas(self.engine) as contador:
+            response = LinkedDataResource(cls, request).output()
+            response.body
+        self.assertEqual(response.status_int, 200, slug)
+        return len(contador.consultas)
+
+    def test_convenio(self):
+        # o convenio e os relacionamentos muitos-para-um numa consulta, mais
+        # uma por colecao (programas e composicao do repasse)
+        self.assertEqual(self.consultas_detalhe('convenio'), 3)
+
+    def test_todas_as_classes(self):
+        for slug, cls in classes_suportadas.items():
+            colecoes = len([passo for passo in carregamento_detalhe[cls]
+                if passo[1] == 'subquery'])
+            self.assertEqual(self.consultas_detalhe(slug), 1 + colecoes,
+                slug)
+
+class TesteAgregacao(TestCase):
+    """Agregacoes (GROUP BY no banco de dados) com os filtros da consulta."""
+
+    def setUp(self):
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(engine)
+        popula_convenios(engine)
+        # convenio sem proponente: grupo nulo
+        insere(engine, Convenio.__table__, id=5, id_proponente=None,
+            valor_global=Decimal(500), data_assinatura=date(2011, 5, 2))
+        self.session = SessaoBase(bind=engine)
+
+    def tearDown(self):
+        self.session.close()
+
+    def agrega(self, agrupar_por, medidas, **filtros):
+        params = frozenset((param, len(valor) if isinstance(valor, list)
+            else None) for param, valor in filtros.items())
+        plano = PlanoAgregacao(metodo_api(ConsultaConvenios), params, None,
+            agrupar_por, medidas)
+        valores = plano.valores(dict((param, {'value': valor})
+            for param, valor in filtros.items()))
+        return [tuple(grupo) for grupo in plano.consulta(self.session,
+            valores)]
+
+    def test_soma_por_uf(self):
+        self.assertEqual(self.agrega(['uf'],
+            ['contagem', 'soma_valor_global']), [(None, 1, Decimal(500)),
+            (u"PE", 2, Decimal(4000)), (u"SP", 2, Decimal(6000))])
+
+    def test_filtros(self):
+        self.assertEqual(self.agrega(['ano_assinatura', 'uf'],
+            ['contagem', 'media_valor_global'], uf=u"SP"),
+            [(2012, u"SP", 2, Decimal(3000))])
+        # o filtro por colecao nao multiplica os registros agregados
+        self.assertEqual(self.agrega(['uf'], ['contagem'],
+            id_programa=[100, 101]), [(u"PE", 2), (u"SP", 2)])
+
+def recusa_conexao():
+    raise sqlite3.OperationalError("unable to open database file")
+
+class TesteReplicas(TestCase):
+    """Troca de replica quando a escolhida recusa a primeira conexao da
+    sessao de leitura.
+    """
+
+    def setUp(self):
+        self.roteador_original = replicas.roteador
+
+    def tearDown(self):
+        replicas.roteador = self.roteador_original
+
+    def banco(self, nome):
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(engine)
+        insere(engine, Municipio.__table__, nome=nome)
+        return engine
+
+    def le(self):
+        session = SessaoLeitura()
+        try:
+            return session.query(Municipio.nome).scalar()
+        finally:
+            session.close()
+
+    def test_replica_fora_do_ar(self):
+        fora = create_engine("sqlite://", creator=recusa_conexao)
+        roteador = replicas.roteador = RoteadorReplicas(
+            self.banco(u"primario"), [fora, self.banco(u"replica")])
+        # o rodizio escolhe primeiro a replica fora do ar
+        self.assertEqual(self.le(), u"replica")
+        self.assertEqual([replica.saudavel for replica in roteador.replicas],
+            [False, True])
+        self.assertEqual([replica.em_uso for replica in roteador.replicas],
+            [0, 0])
+        self.assertEqual(self.le(), u"replica")
+
+    def test_recorre_ao_primario(self):
+        fora = create_engine("sqlite://", creator=recusa_conexao)
+        roteador = replicas.roteador = RoteadorReplicas(
+            self.banco(u"primario"), [fora])
+        self.assertEqual(self.le(), u"primario")
+        self.assertFalse(roteador.replicas[0].saudavel)
+        roteador.recorre_primario = False
+        self.assertRaises(replicas.ReplicasIndisponiveis, self.le)
+
+class TesteLimitesCusto(TestCase):
+    """Precedencia dos limites de custo e de tempo configurados no .ini."""
+
+    def setUp(self):
+        self.limites = LimitesCusto({
+            'custo.tempo_limite': '30000',
+            'custo.tempo_limite.csv': '60000',
+            'custo.tempo_limite.propostas': '10000',
+            'custo.tempo_limite.convenios': '20000',
+            'custo.tempo_limite.propostas.csv': '90000',
+            'custo.maximo': '1000000',
+            'custo.maximo.convenios': '0',
+            'custo.contagem_exata': ' ',
+            'sqlalchemy.url': 'sqlite://',
+        })
+
+    def test_precedencia(self):
+        tempo = self.limites.tempo_limite
+        self.assertEqual(tempo('propostas', 'csv'), 90000)
+        self.assertEqual(tempo('propostas', 'json'), 10000)
+        # o limite do metodo prevalece sobre o do formato
+        self.assertEqual(tempo('convenios', 'csv'), 20000)
+        self.assertEqual(tempo('emendas', 'csv'), 60000)
+        self.assertEqual(tempo('emendas', 'json'), 30000)
+
+    def test_sem_limite(self):
+        # zero desativa o limite geral para o metodo; vazio nao define
+        self.assertEqual(self.limites.custo_maximo('convenios', 'json'), None)
+        self.assertEqual(self.limites.custo_maximo('propostas', 'json'),
+            1000000)
+        self.assertEqual(self.limites.custo_contagem('propostas', 'json'),
+            None)
+        self.assertEqual(LimitesCusto().tempo_limite('propostas', 'csv'),
+            None)
+
+class TesteEscritoresTriplas(TestCase):
+    """Escrita direta das triplas (N-Triples, Turtle e RDF/XML), lida de
+    volta pelo rdflib e comparada ao grafo (serializacao pelo rdflib).
+    """
+
+    def setUp(self):
+        sujeito = URIRef("http://api.convenios.gov.br/siconv/id/convenio/1")
+        anonimo = BNode()
+        self.triplas = [
+            (sujeito, RDF['type'], LIC['Convenio']),
+            (sujeito, RDFS['label'], Literal(u"Convênio nº 1")),
+            (sujeito, LIC['objeto'], Literal(u"linha 1\r\nlinha 2\rfim\n")),
+            (sujeito, LIC['justificativa'], Literal(u"&<>\"' \t]]>")),
+            (sujeito, RDFS['comment'], Literal(u"texto\r\n", lang="pt")),
+            (sujeito, LIC['valor'], Literal("10.50", datatype=XSD['decimal'])),
+            (sujeito, URIRef("http://example.org/vocab#extra"), Literal(3)),
+            (sujeito, LIC['proponente'], anonimo),
+            (anonimo, RDF['type'], LIC['Proponente']),
+            (anonimo, RDFS['comment'], Literal(u"sem uri\r\n")),
+        ]
+        self.grafo = Graph()
+        for tripla in self.triplas:
+            self.grafo.add(tripla)
+
+    def relido(self, formato, formato_rdflib):
+        escritor = escritores[formato]()
+        texto = escritor.cabecalho() + escritor.escreve(self.triplas) + \
+            escritor.rodape()
+        grafo = Graph()
+        grafo.parse(data=texto, format=formato_rdflib)
+        return grafo
+
+    def test_isomorfos_ao_grafo(self):
+        for formato, formato_rdflib in (('nt', 'nt'), ('ttl', 'turtle'),
+                ('rdf', 'xml')):
+            self.assertTrue(isomorphic(self.relido(formato, formato_rdflib),
+                self.grafo), formato)
+
+# texto com os caracteres que o xml precisa escapar
+TEXTO_XML = u"a & b <c> \"d\" 'e'\r\nf\tg ]]> ç"
+
+def xml_amara(agregador, objetos):
+    '''
+    Documento XML dos objetos escrito pelo structwriter do amara, como o
+    XMLAggregator o escrevia antes do EscritorXML.
+    '''
+    def elemento(obj):
+        return struct.E(agregador.element_name(obj),
+            agregador.element_atrs(obj),
+            (agregador.element(obj, atr) for atr in agregador.atributos(obj)
+            if getattr(obj, atr) or isinstance(getattr(obj, atr), int)))
+    buffer = StringIO()
+    escritor = struct.structwriter(stream=buffer, indent=True)
+    proximos = agregador.dataset_split.get('next_url', '')
+    escritor.feed(struct.ROOT(struct.E(agregador.name,
+        agregador.atributos_raiz(), (elemento(obj) for obj in objetos),
+        struct.E('proximos', {'href': proximos}) if proximos else tuple())))
+    return buffer.getvalue()
+
+class TesteEscritorXML(TestCase):
+    """O EscritorXML (XMLAggregator.partes) escreve os mesmos bytes que o
+    structwriter do amara, em todas as classes e conjuntos de campos.
+    """
+
+    def setUp(self):
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(engine)
+        for tabela in Base.metadata.sorted_tables:
+            engine.execute(tabela.insert(), dict((coluna.name,
+                TEXTO_XML if isinstance(coluna.type, types.String) and
+                    not coluna.primary_key and not coluna.foreign_keys
+                else valor_coluna(coluna.type))
+                for coluna in tabela.columns))
+        self.session = SessaoBase(bind=engine)
+
+    def tearDown(self):
+        self.session.close()
+
+    def agregador(self, campos=None):
+        return XMLAggregator("lista", "__expostos__", total_registros=1,
+            dataset_split={'next_url': u"http://localhost/x?a=1&b=2"},
+            campos=campos)
+
+    def test_mesmos_bytes_que_o_amara(self):
+        comparadas = 0
+        for cls in Base.__subclasses__():
+            expostos = sorted(getattr(cls, '__expostos__', []))
+            if not expostos:
+                continue
+            objetos = self.session.query(cls).all()
+            for campos in [None] + [[campo] for campo in expostos]:
+                agregador = self.agregador(campos)
+                self.assertEqual("".join(agregador.partes(objetos)),
+                    xml_amara(agregador, objetos), (cls.__name__, campos))
+                comparadas += 1
+        self.assertTrue(comparadas > 0)
+
+class TesteExpressaoFiltro(TestCase):
+    """Analise da expressao do parametro 'filtro'."""
+
+    def test_atomo(self):
+        self.assertEqual(analisa_expressao(u"uf:SP,RJ"),
+            ('atomo', u"uf", u"SP,RJ"))
+
+    def test_valor_entre_aspas(self):
+        self.assertEqual(analisa_expressao(u'nome:"sao (paulo)"'),
+            ('atomo', u"nome", u"sao (paulo)"))
+
+    def test_precedencia(self):
+        # 'e' precede 'ou', e 'nao' precede 'e'
+        self.assertEqual(analisa_expressao(u"a:1 ou b:2 e nao c:3"),
+            (OU, (('atomo', u"a", u"1"),
+                (E, (('atomo', u"b", u"2"), (NAO, ('atomo', u"c", u"3")))))))
+
+    def test_parenteses(self):
+        self.assertEqual(analisa_expressao(u"(a:1 ou b:2) e c:3"),
+            (E, ((OU, (('atomo', u"a", u"1"), ('atomo', u"b", u"2"))),
+                ('atomo', u"c", u"3"))))
+
+    def test_sequencias_achatadas(self):
+        self.assertEqual(analisa_expressao(u"a:1 e b:2 e c:3"),
+            (E, (('atomo', u"a", u"1"), ('atomo', u"b", u"2"),
+                ('atomo', u"c", u"3"))))
+
+    def test_operadores_sem_distincao_de_caixa_e_acentos(self):
+        self.assertEqual(analisa_expressao(u"NÃO a:1 OU Nao b:2"),
+            analisa_expressao(u"nao a:1 ou nao b:2"))
+
+    def test_atomos_e_forma(self):
+        arvore = analisa_expressao(u"a:1 ou (b:2 e nao c:3)")
+        self.assertEqual(list(atomos(arvore)),
+            [(u"a", u"1"), (u"b", u"2"), (u"c", u"3")])
+        self.assertEqual(forma(arvore),
+            (OU, (('atomo', u"a", None),
+                (E, (('atomo', u"b", None), (NAO, ('atomo', u"c", None)))))))
+
+    def test_expressoes_mal_formadas(self):
+        for texto in (u"", u"   ", u"a:1 ou", u"(a:1", u"a:1)", u"a:1 b:2",
+                u"e a:1", u"a:1 xor b:2", u"()", u"nao", u'a:"aberta'):
+            self.assertRaises(ValueError, analisa_expressao, texto)
+
+    def test_maximo_de_atomos(self):
+        analisa_expressao(u" ou ".join([u"a:1"] * MAX_ATOMOS))
+        self.assertRaises(ValueError, analisa_expressao,
+            u" ou ".join([u"a:1"] * (MAX_ATOMOS + 1)))
+
+    def test_maxima_profundidade(self):
+        def aninhada(niveis):
+            return u"(" * niveis + u"a:1" + u")" * niveis
+        analisa_expressao(aninhada(MAX_PROFUNDIDADE))
+        self.assertRaises(ValueError, analisa_expressao,
+            aninhada(MAX_PROFUNDIDADE + 1))
+        analisa_expressao(u"nao " * MAX_PROFUNDIDADE + u"a:1")
+        self.assertRaises(ValueError, analisa_expressao,
+            u"nao " * (MAX_PROFUNDIDADE + 1) + u"a:1")
+
+    def test_mensagem_de_erro(self):
+        try:
+            analisa_expressao(u"a:1 xor b:2")
+        except ValueError, e:
+            self.assertTrue(u"'xor'" in unicode(e))
+        else:
+            self.fail(u"expressao aceita")
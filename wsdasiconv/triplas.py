@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo triplas.py da API de dados abertos do SICONV.
+=======================================================
+
+© 2011-2013 Ministério do Planejamento, Orçamento e Gestão
+
+Este arquivo e parte do webservice de dados abertos do SICONV,
+o Sistema de Cadastro de Convênios e Contratos de Repasse.
+
+A documentacao esta disponível em http://api.convenios.gov.br/siconv/doc/
+
+O webservice de dados abertos do SICONV é um software livre; você pode
+redistribui-lo e/ou modifica-lo dentro dos termos da Licença Pública Geral
+Affero GNU como publicada pela Fundação do Software Livre (FSF); na versão 3
+da Licença, ou (na sua opnião) qualquer versão subsequente.
+
+Este programa é distribuido na esperança que possa ser  util,
+mas SEM NENHUMA GARANTIA; sem uma garantia implicita de ADEQUAÇÂO a qualquer
+MERCADO ou APLICAÇÃO EM PARTICULAR. Veja a
+Licença Pública Geral Affero GNU para maiores detalhes.
+
+http://www.gnu.org/licenses/agpl-3.0.html
+"""
+
+import re
+from collections import OrderedDict
+from xml.sax.saxutils import escape
+
+from rdflib.term import URIRef, Literal, BNode, Node
+from rdflib.namespace import RDF, RDFS, OWL, XSD
+
+from namespace import LIC, SIORG, SIAFI
+from namespace import GEO
+from namespace import DBPEDIA, DBONT, DBPROP
+from namespace import VOID, FOAF, VCARD, QB
+
+from configuracao import sim
+
+# prefixos fixos das serializacoes em Turtle e RDF/XML
+PREFIXOS = (
+    ('rdf', RDF),
+    ('rdfs', RDFS),
+    ('owl', OWL),
+    ('xsd', XSD),
+    ('lic', LIC),
+    ('siorg', SIORG),
+    ('siafi', SIAFI),
+    ('geo', GEO),
+    ('dbpedia', DBPEDIA),
+    ('dbprop', DBPROP),
+    ('dbo', DBONT),
+    ('void', VOID),
+    ('foaf', FOAF),
+    ('vcard', VCARD),
+    ('qb', QB),
+)
+# uris dos namespaces (os do rdflib, como RDF, nao sao strings)
+PREFIXOS = tuple((prefixo, unicode(namespace)) for prefixo, namespace
+    in PREFIXOS)
+
+# nomes locais aceitos nos nomes prefixados (subconjunto comum ao Turtle e
+# aos nomes de elementos XML)
+re_nome_local = re.compile(r"^[A-Za-z_][A-Za-z0-9_\-]*$")
+
+# caracteres escapados nos literais em N-Triples e Turtle
+ESCAPES = {
+    u'\\': u'\\\\',
+    u'"': u'\\"',
+    u'\n': u'\\n',
+    u'\r': u'\\r',
+    u'\t': u'\\t',
+}
+re_escapes = re.compile(u'[\\\\"\\n\\r\\t]')
+re_nao_ascii = re.compile(u'[^\\x00-\\x7f]')
+
+def escapa_literal(texto):
+    return re_escapes.sub(lambda m: ESCAPES[m.group(0)], texto)
+
+def escapa_ascii(texto):
+    '''
+    Escapa os caracteres nao-ASCII (\\uXXXX), como exige o N-Triples.
+    '''
+    def codigo(m):
+        n = ord(m.group(0))
+        return u'\\u%04X' % n if n <= 0xFFFF else u'\\U%08X' % n
+    return re_nao_ascii.sub(codigo, texto)
+
+def como_termo(valor):
+    '''
+    Os objetos das triplas que nao sao termos rdf sao tratados como
+    literais.
+    '''
+    if isinstance(valor, Node):
+        return valor
+    return Literal(valor)
+
+def prefixado(uri):
+    '''
+    Retorna o prefixo e o nome local da uri num dos namespaces fixos, ou
+    None se ela nao estiver em nenhum deles.
+    '''
+    for prefixo, namespace in PREFIXOS:
+        if uri.startswith(namespace):
+            local = uri[len(namespace):]
+            if re_nome_local.match(local):
+                return prefixo, local
+    return None
+
+class EscritorTriplas(object):
+    """Serializa triplas rdf diretamente em texto, sem montar um grafo, em
+    N-Triples (uma tripla por linha). As subclasses escrevem os demais
+    formatos, redefinindo sujeito, cabecalho e rodape.
+
+    Cada chamada de escreve retorna a serializacao (str, utf-8) das triplas
+    recebidas (em geral, as de um objeto), sem repeticoes e agrupadas por
+    sujeito, para o envio da resposta em partes entre cabecalho e rodape.
+    """
+
+    def cabecalho(self):
+        return ""
+
+    def rodape(self):
+        return ""
+
+    def escreve(self, triplas):
+        sujeitos = OrderedDict()
+        for s, p, o in triplas:
+            pares = sujeitos.setdefault(s, [])
+            par = (p, como_termo(o))
+            if par not in pares:
+                pares.append(par)
+        return u"".join(self.sujeito(s, pares)
+            for s, pares in sujeitos.items()).encode('utf-8')
+
+    @staticmethod
+    def termo(termo):
+        if isinstance(termo, BNode):
+            return u"_:%s" % termo
+        elif isinstance(termo, URIRef):
+            return u"<%s>" % escapa_ascii(termo)
+        texto = u'"%s"' % escapa_ascii(escapa_literal(termo))
+        if termo.language:
+            return texto + u"@" + termo.language
+        elif termo.datatype:
+            return texto + u"^^<%s>" % termo.datatype
+        return texto
+
+    def sujeito(self, sujeito, pares):
+        '''
+        Retorna a serializacao (unicode) das triplas do sujeito, dadas como
+        pares de predicado e objeto.
+        '''
+        s = self.termo(sujeito)
+        return u"".join(u"%s %s %s .\n" % (s, self.termo(p), self.termo(o))
+            for p, o in pares)
+
+class EscritorTurtle(EscritorTriplas):
+    """Escreve as triplas em Turtle, com os prefixos fixos e as triplas de
+    cada sujeito agrupadas com ';'.
+    """
+
+    def cabecalho(self):
+        return u"".join(u"@prefix %s: <%s> .\n" % (prefixo, namespace)
+            for prefixo, namespace in PREFIXOS).encode('utf-8') + "\n"
+
+    @staticmethod
+    def termo(termo):
+        if isinstance(termo, BNode):
+            return u"_:%s" % termo
+        elif isinstance(termo, URIRef):
+            nome = prefixado(termo)
+            if nome is not None:
+                return u"%s:%s" % nome
+            return u"<%s>" % termo
+        texto = u'"%s"' % escapa_literal(termo)
+        if termo.language:
+            return texto + u"@" + termo.language
+        elif termo.datatype:
+            return texto + u"^^" + EscritorTurtle.termo(termo.datatype)
+        return texto
+
+    def sujeito(self, sujeito, pares):
+        predicados = [u"%s %s" % (u"a" if p == RDF['type'] else self.termo(p),
+            self.termo(o)) for p, o in pares]
+        return u"%s %s .\n\n" % (self.termo(sujeito),
+            u" ;\n    ".join(predicados))
+
+# caracteres que os parsers xml normalizam (CR e CRLF viram LF no texto; CR,
+# LF e TAB viram espaco nos atributos), escritos como referencias, como em
+# escritorxml.escapa_texto
+ENTIDADES_TEXTO = {u'\r': u'&#13;'}
+ENTIDADES_ATRIBUTO = {u'"': u'&quot;', u'\r': u'&#13;', u'\n': u'&#10;',
+    u'\t': u'&#9;'}
+
+class EscritorRDFXML(EscritorTriplas):
+    """Escreve as triplas em RDF/XML simples: um rdf:Description por
+    sujeito, com uma propriedade por tripla.
+    """
+
+    def cabecalho(self):
+        return (u'<?xml version="1.0" encoding="utf-8"?>\n<rdf:RDF\n' +
+            u"".join(u'   xmlns:%s=%s\n' % (prefixo,
+                self.atributo(namespace)) for prefixo, namespace in PREFIXOS) +
+            u'>\n').encode('utf-8')
+
+    def rodape(self):
+        return "</rdf:RDF>\n"
+
+    @staticmethod
+    def atributo(valor):
+        return u'"%s"' % escape(valor, ENTIDADES_ATRIBUTO)
+
+    def propriedade(self, predicado, objeto):
+        nome = prefixado(predicado)
+        declaracao = u""
+        if nome is None:
+            # namespace fora dos fixos: declarado no proprio elemento
+            corte = max(predicado.rfind('#'), predicado.rfind('/')) + 1
+            if not re_nome_local.match(predicado[corte:]):
+                raise ValueError(u"O predicado <%s> não pode ser representado em RDF/XML." % \
+                    predicado)
+            nome = ('ns', predicado[corte:])
+            declaracao = u' xmlns:ns=%s' % self.atributo(predicado[:corte])
+        elemento = u"%s:%s" % nome
+        if isinstance(objeto, BNode):
+            return u'    <%s%s rdf:nodeID="%s"/>\n' % (elemento, declaracao,
+                objeto)
+        elif isinstance(objeto, URIRef):
+            return u'    <%s%s rdf:resource=%s/>\n' % (elemento, declaracao,
+                self.atributo(objeto))
+        if objeto.language:
+            declaracao += u' xml:lang=%s' % self.atributo(objeto.language)
+        elif objeto.datatype:
+            declaracao += u' rdf:datatype=%s' % self.atributo(objeto.datatype)
+        return u'    <%s%s>%s</%s>\n' % (elemento, declaracao,
+            escape(objeto, ENTIDADES_TEXTO), elemento)
+
+    def sujeito(self, sujeito, pares):
+        if isinstance(sujeito, BNode):
+            abertura = u'  <rdf:Description rdf:nodeID="%s">\n' % sujeito
+        else:
+            abertura = u'  <rdf:Description rdf:about=%s>\n' % \
+                self.atributo(sujeito)
+        return abertura + u"".join(self.propriedade(p, o) for p, o in pares) + \
+            u'  </rdf:Description>\n'
+
+# escritores diretos por formato; os demais formatos usam o rdflib
+escritores = {
+    'nt': EscritorTriplas,
+    'ttl': EscritorTurtle,
+    'n3': EscritorTurtle,
+    'rdf': EscritorRDFXML,
+    'rdf/xml': EscritorRDFXML,
+}
+
+# usa o rdflib (grafo e serializadores) em todos os formatos. Definido na
+# inicializacao da aplicacao por configura_rdf.
+usa_rdflib = False
+
+def escritor(formato):
+    '''
+    Retorna o escritor direto do formato, ou None se o formato deve ser
+    serializado pelo rdflib.
+    '''
+    if usa_rdflib or formato not in escritores:
+        return None
+    return escritores[formato]()
+
+def configura_rdf(settings):
+    '''
+    Escolhe a serializacao rdf a partir do .ini: 'rdf.rdflib = sim' volta a
+    usar o rdflib em todos os formatos.
+    '''
+    global usa_rdflib
+    usa_rdflib = sim(settings.get('rdf.rdflib'))
+    return usa_rdflib
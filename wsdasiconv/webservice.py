@@ -24,12 +24,20 @@ http://www.gnu.org/licenses/agpl-3.0.html
 '''
 
 import copy
+import zlib
+from hashlib import md5
 
-from decimal import Decimal
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from decimal import Decimal, InvalidOperation
 
 from webob import Response
 from webob.exc import HTTPOk, HTTPBadRequest, HTTPNotFound
 from webob.exc import HTTPFound, HTTPSeeOther, HTTPMovedPermanently
+from webob.exc import HTTPServiceUnavailable
 
 # XML (amara)
 from amara.writers.struct import structwriter, ROOT, E, E_CURSOR
@@ -43,7 +51,11 @@ from rdflib.namespace import Namespace, RDF
 # sqlalchemy
 from sqlalchemy import func as sqlfunc
 from sqlalchemy.orm import joinedload, joinedload_all, subqueryload, aliased
-from sqlalchemy.orm.properties import RelationshipProperty
+from sqlalchemy.orm import class_mapper
+from sqlalchemy.orm import Session as SessaoBase
+from sqlalchemy.pool import SingletonThreadPool
+from sqlalchemy.orm.properties import RelationshipProperty, ColumnProperty
+from sqlalchemy import Date, DateTime, Numeric, Integer
 from sqlalchemy import and_, or_
 from sqlalchemy.engine import reflection
 
@@ -56,18 +68,58 @@ from namespace import URI_BASE
 from model import RegistroWS
 from model import Base
 
+# paginacao
+from paginacao import chaves_primarias, valores_chave, valor_coluna
+from paginacao import predicado_chaves
+from paginacao import codifica_cursor, decodifica_cursor
+
+# contagem de registros
+from contagem import MODOS_CONTAGEM, MODO_PADRAO
+from contagem import CacheContagem, conta_registros, conta_em_paralelo
+from contagem import contagem_sem_consulta, ContagemPronta
+from contagem import geracao_carga, expiracao_cache
+
+# planos de consulta
+from planos import cache_planos
+# leitura das listagens em linhas, sem hidratar os objetos pelo ORM
+from linhas import formatos_linhas
+
+# fronteiras da paginacao por offset
+from fronteiras import fronteira_offset
+
+# limites de custo e de tempo das consultas
+import custo
+from custo import ConsultaCara, define_tempo_limite, admite, tempo_esgotado
+
+# carregamento antecipado de relacionamentos
+from carregamento import plano_carregamento, opcoes_carregamento
+from acessos import compila_planos
+
+# expressoes de filtro (parametro 'filtro')
+from expressoes import analisa_expressao, mapeia_atomos, forma
+
+# agregacoes (parametro 'agrupar_por')
+from planos import parametros_informados
+from agregacao import PlanoAgregacao, ResultadoAgregado
+from agregacao import medidas_disponiveis, CONTAGEM
+
 # serializadores
 from serializer import Aggregator, HTMLAggregator, XMLAggregator
 from serializer import JSONAggregator, CSVAggregator
 from serializer import RDFAggregator
 
-# sessao db
+# sessao db (leituras roteadas para as replicas, se configuradas)
 from model import Session
+from replicas import SessionLeitura
+
+# pools de conexoes
+from conexoes import pools, verifica_sessoes
 
 from model import date
 
 # excecoes
 from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
+from sqlalchemy.exc import DBAPIError
 
 # mapeia o codigo do formato para o content-type
 format_contenttype = {
@@ -125,6 +177,36 @@ def not_found(mensagem=u"O endereço solicitado não foi encontrado.</p>"):
     response.content_type = "text/html;charset=utf-8"
     return response
 
+def replicas_indisponiveis(exc, request):
+    '''
+    Responde 503 quando nenhuma replica do banco de dados esta disponivel
+    para as leituras.
+    '''
+    texto = u"<h1>503 - Serviço indisponível</h1>\n<p>%s</p>" % exc.args[0]
+    response = HTTPServiceUnavailable(body=texto)
+    response.content_type = "text/html;charset=utf-8"
+    response.retry_after = 30
+    return response
+
+def verifica_conexoes(event):
+    '''
+    No inicio de cada requisicao, fecha as sessoes que a requisicao
+    anterior da mesma thread deixou abertas, registrando o vazamento.
+    '''
+    verifica_sessoes((Session, SessionLeitura), event.request.path_qs)
+
+def estado_conexoes(request):
+    '''
+    Retorna o estado dos pools de conexoes: conexoes em uso e disponiveis,
+    histograma da espera pelas conexoes e sessoes nao fechadas.
+    '''
+    response = prepare_response('json')
+    response.cache_control.public = False
+    response.cache_control.no_cache = True
+    response.expires = None
+    response.text = json.dumps(pools.estado(), sort_keys=True).decode('utf-8')
+    return response
+
 def prepare_response(format):
     '''
     Prepara um objeto resposta no formato especificado.
@@ -141,11 +223,8 @@ def prepare_response(format):
     # Cache
     response.cache_control.public = True
     # as atualizacoes sao feitas na madrugada, entao o cache deve
-    # expirar as 2:00 do dia seguinte
-    from datetime import datetime, timedelta, time
-    dia_a_mais = int(bool(datetime.now().hour >= 3))
-    d = datetime.combine(datetime.today()+timedelta(dia_a_mais), time(3,0))
-    response.expires = d
+    # expirar ao fim da proxima carga (ver contagem.expiracao_cache)
+    response.expires = expiracao_cache()
     return response
 
 def finalize_response(req, res):
@@ -189,6 +268,15 @@ def classes_modelo():
 
 classes_suportadas = dict((cls.__slug_item__, cls) for cls in classes_modelo())
 
+# planos de carregamento antecipado dos relacionamentos usados na
+# serializacao dos atributos expostos de cada classe (consulta individual)
+carregamento_detalhe = dict((cls, plano_carregamento(cls, cls.__expostos__))
+    for cls in classes_suportadas.values())
+
+# planos dos campos serializados de cada classe (atributos expostos e
+# resumidos), usados por todos os agregadores
+compila_planos(classes_suportadas.values())
+
 def redir_resource(request):
     '''
     Redireciona a requisicao para um documento que contenha informacoes sobre
@@ -235,6 +323,61 @@ def conneg_dados(request):
 
 # classes do webservice
 
+class CorpoLote(object):
+    """Corpo de resposta gerado em partes (app_iter), enviado em blocos de
+    ate tamanho_bloco bytes. As partes unicode sao codificadas em utf-8.
+    
+    Se comprime for verdadeiro, os blocos sao compactados (gzip) a medida
+    que sao gerados; cada bloco compactado e' enviado sem esperar pelos
+    seguintes.
+    
+    Ao final do envio, ou se o servidor o interromper, chama ao_fechar (em
+    geral, para fechar a sessao do banco de dados).
+    """
+    
+    tamanho_bloco = 64 * 1024
+    nivel_compressao = 6
+    
+    def __init__(self, partes, ao_fechar=None, comprime=False):
+        self.partes = partes
+        self.ao_fechar = ao_fechar
+        self.comprime = comprime
+    
+    def blocos(self):
+        bloco = []
+        tamanho = 0
+        for parte in self.partes:
+            if isinstance(parte, unicode):
+                parte = parte.encode('utf-8')
+            bloco.append(parte)
+            tamanho += len(parte)
+            if tamanho >= self.tamanho_bloco:
+                yield "".join(bloco)
+                bloco = []
+                tamanho = 0
+        if bloco:
+            yield "".join(bloco)
+    
+    def __iter__(self):
+        if not self.comprime:
+            for bloco in self.blocos():
+                yield bloco
+            return
+        # formato gzip (cabecalho e verificacao) com o zlib
+        compressor = zlib.compressobj(self.nivel_compressao, zlib.DEFLATED,
+            16 + zlib.MAX_WBITS)
+        for bloco in self.blocos():
+            yield compressor.compress(bloco) + \
+                compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+    
+    def close(self):
+        getattr(self.partes, 'close', lambda: None)()
+        if self.ao_fechar is not None:
+            self.ao_fechar()
+            self.ao_fechar = None
+
+
 class Resource(object):
     """Representa um recurso da web.
     """
@@ -281,27 +424,56 @@ class Resource(object):
         # Cache
         response.cache_control.public = True
         # as atualizacoes sao feitas na madrugada, entao o cache deve
-        # expirar as 2:00 do dia seguinte
-        from datetime import datetime, timedelta, time
-        dia_a_mais = int(bool(datetime.now().hour >= 3))
-        d = datetime.combine(datetime.today()+timedelta(dia_a_mais), time(3,0))
-        response.expires = d
+        # expirar ao fim da proxima carga (ver contagem.expiracao_cache)
+        response.expires = expiracao_cache()
         self.response = response
         return self.response
     
+    def etag(self):
+        '''
+        Retorna a e-tag (fraca) da resposta: os dados so mudam na carga
+        noturna, entao a e-tag e' dada pela url, pela versao da API e pelo
+        marcador da carga mais recente, gravado no banco de dados ao fim da
+        carga (ver contagem.geracao_carga), sem depender do corpo da
+        resposta, que e' gerado durante o envio.
+        '''
+        chave = "%s|%s|%s" % (self.request.url, versao_api,
+            geracao_carga().isoformat())
+        if isinstance(chave, unicode):
+            chave = chave.encode('utf-8')
+        return md5(chave).hexdigest()
+    
+    def nao_modificado(self):
+        '''
+        Retorna verdadeiro se o cliente ja tem a versao atual da resposta
+        (cabecalho If-None-Match).
+        '''
+        if_none_match = getattr(self.request, 'if_none_match', None)
+        return bool(if_none_match) and self.etag() in if_none_match
+    
     def finalize_response(self):
         '''
-        Finaliza o objeto de resposta http antes de envia-la.
+        Finaliza o objeto de resposta http antes de envia-la: e-tag,
+        resposta 304 e compactacao do corpo, feita durante o envio.
         '''
         req, res = self.request, self.response
-        # Calcula o hash para o cache com e-tag
-        res.md5_etag()
-        if getattr(req, 'if_none_match', None) and res.etag == req.if_none_match:
-            res.body = None
-            # retornar 304
+        if res.status_int != 200:
+            # erros e respostas ja finalizadas
+            return self.response
+        corpo = res.app_iter
+        if not isinstance(corpo, CorpoLote):
+            corpo = CorpoLote(corpo)
+        res.etag = (self.etag(), False)
+        if self.nao_modificado():
+            # retornar 304 sem gerar o corpo
+            corpo.close()
+            res.app_iter = []
             res.status = "304 Not modified"
-        elif 'gzip' in req.accept_encoding:
-            res.encode_content(lazy=False)
+        else:
+            if 'gzip' in req.accept_encoding:
+                corpo.comprime = True
+                res.content_encoding = 'gzip'
+            res.app_iter = corpo
         return self.response
     
     @staticmethod
@@ -372,10 +544,11 @@ class LinkedDataResource(Resource):
         # consulta o objeto
         if self.model_class is None:
             raise ValueError("A classe do modelo representada no recurso nao esta definida.")
-        session = Session()
+        session = SessionLeitura()
         try:
             primary_keys = [key.name for key in self.model_class.__table__.primary_key]
-            query = session.query(self.model_class)
+            query = session.query(self.model_class).options(
+                *opcoes_carregamento(carregamento_detalhe[self.model_class]))
             ids = self.id.split(",")
             if len(ids) != len(primary_keys):
                 # quantidade de chaves passadas no id difere do esquema
@@ -441,6 +614,113 @@ class LinkedDataResource(Resource):
             response.headers['Vary'] = 'Accept'
             return self.response
 
+class LinkedDataCollection(LinkedDataResource):
+    """Representa um conjunto de recursos linked data do mesmo tipo,
+    consultados de uma so vez pelos identificadores informados no parametro
+    'ids', como em /dados/convenio.json?ids=1,2,3.
+    
+    Se a chave for simples, os identificadores sao separados por ','. Se for
+    composta, cada identificador vai num parametro 'ids' repetido, com as
+    partes da chave separadas por ',', como na consulta individual
+    (ex.: /dados/emenda.json?ids=1,2,3&ids=1,4,3).
+    """
+    
+    # quantidade maxima de identificadores por requisicao
+    max_ids = 500
+    
+    def read_parameters(self):
+        # prepara os parametros
+        request = self.request
+        self.formato = request.matchdict['formato']
+        self.result = None
+        if self.formato not in format_contenttype.keys():
+            self.response = self.not_found(u"Formato não suportado: %s." % self.formato)
+            return self.response
+        try:
+            self.ids = self.read_ids(request.params.getall('ids'))
+        except ValueError, e:
+            self.response = HTTPBadRequest(
+                body=u"<h1>Solicitação mal formatada</h1><p><strong>Erro:</strong> %s</p>." % \
+                    e,
+                content_type="text/html")
+        return self.response
+    
+    def read_ids(self, valores):
+        '''
+        Processa os valores do parametro 'ids', retornando a lista (sem repeticoes) de
+        chaves solicitadas, cada uma uma tupla com os valores das colunas
+        da chave primaria.
+        '''
+        mapper = class_mapper(self.model_class)
+        colunas = list(mapper.primary_key)
+        if len(colunas) == 1:
+            itens = [[item] for valor in valores for item in valor.split(",")]
+        else:
+            itens = [valor.split(",") for valor in valores]
+        ids = []
+        for item in itens:
+            item = [parte.strip() for parte in item]
+            if not any(item):
+                continue
+            if len(item) != len(colunas):
+                raise ValueError(u"O identificador '%s' não corresponde à chave de %s, que tem %d partes." % \
+                    (u",".join(item), self.model_class.__slug_item__, len(colunas)))
+            try:
+                chave = tuple(int(parte) if isinstance(coluna.type, Integer)
+                    else parte for parte, coluna in zip(item, colunas))
+            except ValueError:
+                raise ValueError(u"Identificador inválido: '%s'." % u",".join(item))
+            if chave not in ids:
+                ids.append(chave)
+        if not ids:
+            raise ValueError(u"Informe os identificadores no parâmetro 'ids'.")
+        if len(ids) > self.max_ids:
+            raise ValueError(u"O parâmetro 'ids' aceita até %d identificadores." % \
+                self.max_ids)
+        return ids
+    
+    def query(self):
+        if self.response is not None:
+            return None
+        # consulta todos os objetos numa unica consulta (IN)
+        session = SessionLeitura()
+        chaves = chaves_primarias(self.model_class)
+        atributos = [getattr(self.model_class, chave) for chave in chaves]
+        query = session.query(self.model_class).options(
+            *opcoes_carregamento(carregamento_detalhe[self.model_class]))
+        query = query.filter(
+            predicado_chaves(atributos, self.ids, session.connection().dialect))
+        encontrados = dict((tuple(valores_chave(obj, chaves)), obj)
+            for obj in query)
+        # mantem a ordem dos identificadores solicitados
+        self.result = [encontrados[chave] for chave in self.ids
+            if chave in encontrados]
+        # nao fechar a sessao para permitr lazy loading
+        self.session = session
+        return self.result
+    
+    def output(self):
+        if self.response is None:
+            ag = format_ag[self.formato](self.model_class.__slug_lista__,
+                atributo_serializar=self.atributos_serializar,
+                total_registros=len(self.result),
+                dataset_split={
+                    'current_url': self.request.url,
+                    'current_offset': 0,
+                    'split_size': len(self.result),
+                },
+                parameters={'ids': {'name': u"Identificadores"}},
+                request=self.request)
+            self.response = self.prepare_response(self.formato)
+            self.response.charset = 'utf-8'
+            # o corpo e' gerado durante o envio; a sessao e' fechada ao
+            # final, apos a serializacao, para permitir o lazy loading
+            self.response.app_iter = CorpoLote(
+                ag.serialize_iter(self.result, format=self.formato),
+                self.session.close)
+        self.response = self.finalize_response()
+        return self.response
+
 class APIMethod(Resource):
     """Representa um metodo de uma API.
     
@@ -487,6 +767,22 @@ class APIMethod(Resource):
     }
     
     max_results = 500
+    # quantidade maxima de valores de um parametro separados por virgula
+    max_valores = 100
+    
+    # modo lote: o parametro 'limite' acima de max_results (ate
+    # max_limite_lote) le os registros do banco de dados em lotes de
+    # tamanho_lote, enviando-os a medida que sao serializados
+    max_limite_lote = 1000000
+    tamanho_lote = 1000
+    formatos_lote = ('json', 'csv')
+    
+    # rota das urls do metodo (consulta atual e proxima pagina)
+    rota = 'consulta/metodo.formato'
+    # parametros gerais que nao se aplicam ao metodo
+    parametros_nao_aceitos = ('agrupar_por', 'medidas')
+    # sugestao da resposta as consultas recusadas pelo custo estimado
+    dica_consulta_cara = u"Restrinja os filtros ou, em vez do parâmetro 'offset', use a paginação por cursor (link 'próximos')."
     
     # template para a visualizacao em html
     html_template = 'templates/lista.pt'
@@ -498,19 +794,56 @@ class APIMethod(Resource):
     #  (em geral, relacionamentos com outras classes no sqlalchemy)
     preloaded_atrs = []
     subquery_atrs = []
+    # plano de carregamento dos atributos resumidos, montado na
+    # inicializacao (ver carregamento.plano_carregamento)
+    carregamento = None
     
     def __init__(self, *args, **kw):
         super(APIMethod, self).__init__(*args, **kw)
         self.parameters = copy.deepcopy(self.__class__.parameters)
         self.offset = 0
+        self.cursor = None
+        self.limite = self.max_results
+        self.lote = False
+        self.contagem = MODO_PADRAO
+        self.campos = None
+        self.ordem = None
+        self.expressao = None
+        self.tempo_limite = None
         self.initialize()
-        if self.response is None:
+        if self.response is None and self.nao_modificado():
+            # o cliente ja tem a versao atual da resposta (os dados so
+            # mudam na carga noturna): responde 304 sem consultar o banco
+            self.result = None
+            self.prepare_response(self.formato)
+            self.response = self.finalize_response()
+        elif self.response is None:
             # se ha resposta (self.response is not None), e' porque foi
             # levantada uma excecao e a resposta contem o codigo HTTP e
             # menagem apropriada.
             # Caso contrario (self.response is None), nada foi colocado
             # na resposta e pode ser realizada a consulta.
-            self.query()
+            try:
+                self.query()
+            except ConsultaCara, e:
+                SessionLeitura.remove()
+                self.result = None
+                self.response = HTTPBadRequest(
+                    body=u"<h1>Consulta muito custosa</h1><p><strong>Erro:</strong> O custo estimado da consulta (%d) ultrapassa o máximo permitido para este método (%d). %s</p>" % \
+                        (e.args + (self.dica_consulta_cara,)),
+                    content_type="text/html")
+            except DBAPIError, e:
+                SessionLeitura.remove()
+                if not tempo_esgotado(e):
+                    raise
+                self.result = None
+                self.response = HTTPServiceUnavailable(
+                    body=u"<h1>Tempo limite excedido</h1><p><strong>Erro:</strong> A consulta excedeu o tempo limite deste método. Restrinja os filtros ou reduza o parâmetro 'limite'.</p>",
+                    content_type="text/html")
+            except Exception:
+                # a sessao so e' fechada em output(), que nao sera chamado
+                SessionLeitura.remove()
+                raise
         else:
             self.result = None
     
@@ -527,49 +860,49 @@ class APIMethod(Resource):
         "Processa parametros de consulta"
         # parametros gerais
         self.formato = self.request.matchdict['formato']
+        for param in self.parametros_nao_aceitos:
+            if self.request.params.get(param, None):
+                raise ValueError(u"O parâmetro '%s' não se aplica a este método." % param)
         try:
             self.offset = int(self.request.params.get('offset', 0))
         except ValueError:
             self.offset = 0
+        # paginacao por cursor (seek): dispensa o 'offset'
+        if self.request.params.get('cursor', None):
+            if self.offset:
+                raise ValueError(u"Os parâmetros 'offset' e 'cursor' não podem ser usados juntos.")
+            self.cursor = decodifica_cursor(self.request.params['cursor'])
+        # tamanho da pagina (acima de max_results, ativa o modo lote)
+        if self.request.params.get('limite', None):
+            self.limite = self.read_limite(self.request.params['limite'])
+            self.lote = self.limite > self.max_results
+        # modo de contagem do total de registros
+        self.contagem = self.request.params.get('contagem', MODO_PADRAO)
+        if self.contagem not in MODOS_CONTAGEM:
+            raise ValueError(u"Modo de contagem desconhecido: '%s'. Os modos disponíveis são: %s." % \
+                (self.contagem, u", ".join(sorted(MODOS_CONTAGEM))))
+        # campos a serializar (por padrao, os resumidos)
+        if self.request.params.get('campos', None):
+            self.campos = self.read_campos(self.request.params['campos'])
+        # ordenacao dos resultados (por padrao, pela chave primaria)
+        if self.request.params.get('ordem', None):
+            self.ordem = self.read_ordem(self.request.params['ordem'])
+        if self.cursor is not None:
+            self.cursor = self.read_cursor(*self.cursor)
+        # expressao de filtro com 'ou' e 'nao' sobre os parametros especificos
+        if self.request.params.get('filtro', None):
+            self.expressao = self.read_expressao(self.request.params['filtro'])
         # verifica se os parametros especificados existem
         for param in self.request.params.keys():
-            if param not in self.parameters.keys() and param != 'offset':
+            if param not in self.parameters.keys() and param not in Aggregator.parametros_gerais:
                 raise ValueError(u"O parâmetro especificado '%s' é desconhecido." % param)
         # parametros especificos
         for param in self.parameters.keys():
             value = self.request.params.get(param, None)
             # se o valor foi passado na consulta
             if value is not None:
-                # faz alguma transformacao previa
-                if "pre_transform" in self.parameters[param]:
-                    value = self.parameters[param]["pre_transform"](self, value)
-                # verifica o tipo do parametro
-                if "tipo" in self.parameters[param]:
-                    try:
-                        # cast que passa a string recebida como parametro 
-                        # para o construtor da classe especificada em ["tipo"]
-                        value = self.parameters["tipo"](value)
-                    except ValueError:
-                        raise ValueError(u"O valor passado ao parâmetro '%s' não é do tipo '%s': '%s'" % \
-                            (param, self.parameters[param]["tipo"], value))
-                # valida o valor do parametro, se houver validador
-                if "validator" in self.parameters[param] and not self.parameters[param]["validator"](self, value):
-                    raise ValueError (u"Valor inválido passado ao parâmetro '%s': %s" % \
-                        (param, value))
-                # verifica o contra-dominio (minimo e maximo), se houver
-                if "range" in self.parameters[param]:
-                    min = self.parameters[param]["range"].get("min", None)
-                    max = self.parameters[param]["range"].get("max", None)
-                    if min is not None:
-                        if value < min:
-                            raise ValueError(u"O valor passado como parâmetro '%s' é menor que o mínimo aceitável (%s): %s." % \
-                                (param, str(min), str(value)))
-                        if value > max:
-                            raise ValueError(u"O valor passado como parâmetro '%s' é maior que o máximo aceitável (%s): %s." % \
-                                (param, str(max), str(value)))
-                # faz a transformacao necessaria
-                if "transform" in self.parameters[param]:
-                    value = self.parameters[param]["transform"](self, value)
+                # uma lista de valores separados por virgula vira IN
+                value = self.read_valores(param, value)
                 # todo o processamento do parametro foi feito
             else:
                 # nao foi passado o valor para esse parametro na consulta
@@ -579,95 +912,330 @@ class APIMethod(Resource):
             self.parameters[param]["value"] = value
         # registra url da consulta
         params = dict(self.request.params)
-        self.url = self.request.route_url('consulta/metodo.formato',
+        self.url = self.request.route_url(self.rota,
             metodo=self.slug,
             formato=self.formato, _query=params)
     
+    def read_valor(self, param, value):
+        "Processa e valida um valor de um parametro especifico"
+        # faz alguma transformacao previa
+        if "pre_transform" in self.parameters[param]:
+            value = self.parameters[param]["pre_transform"](self, value)
+        # verifica o tipo do parametro
+        if "type" in self.parameters[param]:
+            tipo = self.parameters[param]["type"]
+            try:
+                # cast que passa a string recebida como parametro 
+                # para o construtor da classe especificada em ["type"]
+                value = tipo(value)
+            except (ValueError, InvalidOperation):
+                raise ValueError(u"O valor passado ao parâmetro '%s' não é do tipo '%s': '%s'" % \
+                    (param, getattr(tipo, '__name__', tipo), value))
+        # valida o valor do parametro, se houver validador
+        if "validator" in self.parameters[param] and not self.parameters[param]["validator"](self, value):
+            raise ValueError (u"Valor inválido passado ao parâmetro '%s': %s" % \
+                (param, value))
+        # verifica o contra-dominio (minimo e maximo), se houver
+        if "range" in self.parameters[param]:
+            min = self.parameters[param]["range"].get("min", None)
+            max = self.parameters[param]["range"].get("max", None)
+            if min is not None and value < min:
+                raise ValueError(u"O valor passado como parâmetro '%s' é menor que o mínimo aceitável (%s): %s." % \
+                    (param, str(min), str(value)))
+            if max is not None and value > max:
+                raise ValueError(u"O valor passado como parâmetro '%s' é maior que o máximo aceitável (%s): %s." % \
+                    (param, str(max), str(value)))
+        # faz a transformacao necessaria
+        if "transform" in self.parameters[param]:
+            value = self.parameters[param]["transform"](self, value)
+        return value
+    
+    def read_valores(self, param, value):
+        '''
+        Processa o valor de um parametro especifico. Nas comparacoes de
+        igualdade, aceita varios valores separados por virgula, que sao
+        processados um a um e retornados numa lista.
+        '''
+        if self.parameters[param].get("comparison", None) != "=" or \
+                "," not in value:
+            return self.read_valor(param, value)
+        valores = [item for item in value.split(",") if item.strip()]
+        if not valores:
+            raise ValueError(u"Valor inválido passado ao parâmetro '%s': %s" % \
+                (param, value))
+        if len(valores) > self.max_valores:
+            raise ValueError(u"O parâmetro '%s' aceita até %d valores." % \
+                (param, self.max_valores))
+        return [self.read_valor(param, item) for item in valores]
+    
+    def read_expressao(self, texto):
+        '''
+        Processa o parametro 'filtro': expressao com condicoes
+        parametro:valor combinadas por 'e', 'ou', 'nao' e parenteses. Os
+        valores passam pelo mesmo processamento dos parametros especificos.
+        '''
+        def processa(param, value):
+            if param not in self.parameters:
+                raise ValueError(u"O parâmetro especificado '%s' é desconhecido." % param)
+            return self.read_valores(param, value)
+        return mapeia_atomos(analisa_expressao(texto), processa)
+    
+    def read_limite(self, valor):
+        '''
+        Processa o parametro 'limite': quantidade de registros da pagina.
+        Acima de max_results, so e' aceito nos formatos do modo lote
+        (formatos_lote).
+        '''
+        try:
+            limite = int(valor)
+        except ValueError:
+            raise ValueError(u"O valor passado ao parâmetro 'limite' não é um número inteiro: '%s'" % valor)
+        if self.formato in self.formatos_lote:
+            maximo = self.max_limite_lote
+        else:
+            maximo = self.max_results
+        if limite < 1 or limite > maximo:
+            mensagem = u"O parâmetro 'limite' deve estar entre 1 e %d: %d." % \
+                (maximo, limite)
+            if maximo < self.max_limite_lote and self.formatos_lote:
+                mensagem += u" Páginas com até %d registros estão disponíveis nos formatos %s." % \
+                    (self.max_limite_lote, u", ".join(self.formatos_lote))
+            raise ValueError(mensagem)
+        return limite
+    
+    def read_campos(self, valor):
+        "Processa o parametro 'campos', validando-o com os atributos expostos"
+        expostos = getattr(self.model_class, '__expostos__', [])
+        campos = [campo.strip() for campo in valor.split(",") if campo.strip()]
+        for campo in campos:
+            if campo not in expostos:
+                raise ValueError(u"O campo especificado '%s' é desconhecido. Os campos disponíveis são: %s." % \
+                    (campo, u", ".join(sorted(expostos))))
+        return campos
+    
+    def read_cursor(self, valores, posicao, ordem):
+        '''
+        Confere se o cursor corresponde a chave e a ordenacao da consulta e
+        converte o valor da coluna de ordenacao para o tipo da coluna.
+        '''
+        if ordem != self.request.params.get('ordem', None):
+            raise ValueError(u"O cursor informado não corresponde à ordenação solicitada.")
+        quantidade = len(chaves_primarias(self.model_class))
+        if self.ordem is not None:
+            quantidade += 1
+        if len(valores) != quantidade:
+            raise ValueError(u"O cursor informado não corresponde à chave da consulta.")
+        return self.converte_cursor(valores), posicao, ordem
+    
+    def converte_cursor(self, valores):
+        '''
+        Converte o valor da coluna de ordenacao lido de um cursor para o
+        tipo da coluna.
+        '''
+        if self.ordem is not None:
+            atributo = getattr(self.model_class, self.ordem[0])
+            valores = [valor_coluna(atributo, valores[0])] + valores[1:]
+        return valores
+    
+    def read_ordem(self, valor):
+        '''
+        Processa o parametro 'ordem': nome de uma coluna de ordenacao do
+        modelo (__ordenacoes__), precedido de '-' para a ordem decrescente.
+        '''
+        nome = valor.strip()
+        decrescente = nome.startswith('-')
+        if decrescente:
+            nome = nome[1:]
+        ordenacoes = getattr(self.model_class, '__ordenacoes__', [])
+        if nome not in ordenacoes:
+            raise ValueError(u"Não é possível ordenar por '%s'. As ordenações disponíveis são: %s." % \
+                (nome, u", ".join(ordenacoes) if ordenacoes else u"nenhuma"))
+        return (nome, decrescente)
+    
+    def prepara_sessao(self):
+        '''
+        Abre a sessao de leitura com o tempo limite (statement_timeout) do
+        metodo e do formato.
+        '''
+        session = SessionLeitura()
+        self.tempo_limite = custo.limites.tempo_limite(self.slug, self.formato)
+        define_tempo_limite(session, self.tempo_limite)
+        return session
+    
     def query(self):
         # prepara a sessao
-        session = Session()
+        session = self.prepara_sessao()
         
-        q = session.query(self.model_class)
+        # plano de consulta para os parametros informados: joins, opcoes
+        # de carregamento, filtros e ordenacao ja montados
+        plano = cache_planos.obtem(self)
+        valores = plano.valores(self.parameters, self.expressao)
         
-        # atributos que deverao ser precarregados
-        for atr in self.preloaded_atrs:
-            q = q.options(joinedload(getattr(self.model_class, atr)))
-        # atributos que deverao ser carregados como subqueries
-        for atr in self.subquery_atrs:
-            q = q.options(subqueryload(getattr(self.model_class, atr)))
+        # paginacao dos resultados: a partir do offset ou, na paginacao
+        # por cursor, dos valores do ultimo registro visto
+        posicao = self.offset
+        ultimos = None
+        deslocamento = self.offset
+        if self.cursor is not None:
+            ultimos, posicao, ordem = self.cursor
+        elif self.offset:
+            # paginacao por offset: parte da fronteira pre-calculada mais
+            # proxima, se houver, e desloca-se apenas o restante
+            fronteira = fronteira_offset(self, plano, session, valores)
+            if fronteira is not None:
+                ultimos = self.converte_cursor(
+                    decodifica_cursor(fronteira[1])[0])
+                deslocamento = self.offset - fronteira[0]
         
-        # filtra por cada parametro
-        for param in (key for key, dic in self.parameters.items() if dic.get("value", None) is not None):
-            # verifica qual atributo consultar
-            atr = self.parameters[param].get("query_attribute", param)
-            steps = atr.split(".") # cadeia de atributos
-            next_class = self.model_class
-            alias = next_class # duck typing a ser usado nos filtros abaixo
-            for step in steps:
-                if not isinstance(getattr(next_class,step).property, RelationshipProperty):
-                    break
-                next_class = getattr(next_class, step).property.mapper.class_
-                # gera um alias para a tabela na consulta
-                alias = aliased(next_class, name="__".join(
-                    (next_class.__tablename__,param)
-                ))
-                q = q.join(alias)
-            value = self.parameters[param]["value"]
-            # Se o parametro foi especificado, ele participa da consulta.
-            # A variavel alias pode ser o alias da ultima tabela que entrou
-            # no join, ou a tabela original caso não tenha sido feito join.
-            if self.parameters[param]["comparison"] == "=":
-                q = q.filter(getattr(alias,steps[-1])==value)
-            elif self.parameters[param]["comparison"] == "ilike":
-                q = q.filter(getattr(alias,steps[-1]).ilike("%%%s%%" % value))
-            elif self.parameters[param]["comparison"] == "<=":
-                q = q.filter(getattr(alias,steps[-1]) <= value)
-            elif self.parameters[param]["comparison"] == ">=":
-                q = q.filter(getattr(alias,steps[-1]) >= value)
-            elif self.parameters[param]["comparison"] == "<":
-                q = q.filter(getattr(alias,steps[-1]) < value)
-            elif self.parameters[param]["comparison"] == ">":
-                q = q.filter(getattr(alias,steps[-1]) > value)
+        # resultados ordenados pela coluna solicitada e pela chave primaria,
+        # lidos em linhas, sem hidratar os objetos pelo ORM, se o plano e o
+        # formato permitirem
+        linhas = plano.linhas is not None and \
+            self.formato in formatos_linhas
+        q = plano.consulta(session, valores, linhas=linhas)
+        if ultimos is not None:
+            # paginacao por cursor: busca os registros seguintes ao ultimo
+            # visto, na ordenacao da consulta, sem percorrer os anteriores
+            q = q.filter(plano.continuacao(ultimos,
+                session.connection().dialect))
+        if deslocamento:
+            q = q.offset(deslocamento)
         
-        # ordenacao dos resultados
-        # ordena pela chave primaria
-        primary_key = (key.name for key in self.model_class.__table__.primary_key).next()
-        q = q.order_by(getattr(self.model_class,primary_key))
+        # traz um registro a mais para saber se ha proxima pagina
+        q = q.limit(self.limite + 1)
         
-        # paginacao dos resultados
-        self.total_registros = q.count()
-        q = q.limit(self.max_results)
-        if self.offset:
-            q = q.offset(self.offset)
+        # recusa as consultas cujo custo estimado ultrapassa o maximo,
+        # antes de executa-las
+        admite(session, q, custo.limites.custo_maximo(self.slug, self.formato))
+        
+        # contagem do total de registros, conforme o modo solicitado
+        contagem = self.inicia_contagem(session, plano, valores)
+        
+        self.session = session
+        self.ha_mais = False
+        self.dataset_split = {
+            'dataset_url': self.url,
+            'current_url': self.url,
+            'current_offset': posicao,
+            'split_size': self.limite,
+            'next_url': "",
+            'contagem': self.contagem,
+            'ha_mais': False,
+        }
+        
+        if self.lote:
+            # modo lote: os registros sao lidos durante a serializacao;
+            # a proxima pagina so e' conhecida ao final
+            self.total_registros, self.contagem = contagem.get()
+            self.dataset_split['contagem'] = self.contagem
+            self.result = self.itera_lote(plano, valores, ultimos,
+                deslocamento, posicao, linhas)
+            return
         
         try:
             things = q.all()
         except NoResultFound:
-            things = None
-        self.session = session
+            things = []
+        self.total_registros, self.contagem = contagem.get()
+        self.dataset_split['contagem'] = self.contagem
+        self.ha_mais = len(things) > self.limite
+        things = things[:self.limite]
+        if linhas:
+            things = [plano.linhas.objeto(linha) for linha in things]
         
-        # links para paginacao
-        geral_url = self.url
-        atual_url = ""
-        prox_url = ""
-        params = dict(self.request.params)
-        params['offset'] = "%d" % (self.offset)
-        atual_url = self.url
-        if self.offset + self.max_results < self.total_registros:
-            params['offset'] = "%d" % (self.offset + self.max_results)
-            prox_url = self.request.route_url('consulta/metodo.formato',
-                metodo=self.slug,
-                formato=self.formato, _query=params)
-        self.dataset_split = {
-            'dataset_url': geral_url,
-            'current_url': atual_url,
-            'current_offset': self.offset,
-            'split_size': self.max_results,
-            'next_url': prox_url,
-        }
+        # link para a proxima pagina
+        if self.ha_mais:
+            self.dataset_split['next_url'] = self.proxima_url(plano,
+                things[-1], posicao + len(things))
+            self.dataset_split['ha_mais'] = True
         
         self.result = things
     
+    def inicia_contagem(self, session, plano, valores):
+        '''
+        Inicia a contagem dos registros da consulta e retorna um objeto cujo
+        metodo get() devolve o resultado (ver contagem.conta_em_paralelo).
+
+        O modo 'nenhuma' e as contagens em cache sao resolvidos na propria
+        requisicao, sem ocupar outra conexao. As demais contagens (COUNT ou
+        EXPLAIN) sao feitas em paralelo com a consulta da pagina, exceto no
+        SQLite em memoria, em que cada thread teria o seu proprio banco de
+        dados.
+        '''
+        chave = CacheContagem.chave((self.id, plano.expressao), valores)
+        pronta = contagem_sem_consulta(self.contagem, chave)
+        if pronta is not None:
+            return ContagemPronta(pronta)
+        paralela = not isinstance(session.get_bind().pool, SingletonThreadPool)
+        return conta_em_paralelo(self.contagem_registros(session, plano,
+            valores, chave, paralela), paralela)
+    
+    def contagem_registros(self, session, plano, valores, chave, paralela):
+        '''
+        Retorna a funcao que conta os registros da consulta. Se a contagem
+        for paralela, a funcao usa uma sessao propria, no mesmo banco de
+        dados da sessao informada, para que possa ser executada em outra
+        thread e conexao enquanto a pagina e' consultada. A conexao dessa
+        sessao so e' aberta quando a funcao e' executada.
+        '''
+        # o banco de dados da conexao da requisicao (a replica escolhida
+        # pode ter sido trocada ao conectar, ver replicas.SessaoLeitura)
+        bind = session.connection().engine
+        modo = self.contagem
+        custo_contagem = custo.limites.custo_contagem(self.slug, self.formato)
+        tempo_limite = self.tempo_limite
+        def conta():
+            sessao = SessaoBase(bind=bind) if paralela else session
+            try:
+                if paralela:
+                    define_tempo_limite(sessao, tempo_limite)
+                filtrada = plano.consulta(sessao, valores, ordenada=False)
+                return conta_registros(sessao, filtrada, modo, chave,
+                    lambda: plano.conta(sessao, valores), custo_contagem)
+            finally:
+                if paralela:
+                    sessao.close()
+        return conta
+    
+    def itera_lote(self, plano, valores, ultimos, deslocamento, posicao,
+            linhas=False):
+        '''
+        Itera sobre os registros da pagina no modo lote, lidos do banco de
+        dados em lotes, e registra o link para a proxima pagina ao final.
+        '''
+        lidos = 0
+        ultimo = None
+        for obj in plano.lotes(self.session, valores, self.limite + 1,
+                self.tamanho_lote, ultimos, deslocamento, linhas):
+            if lidos == self.limite:
+                # ha ao menos mais um registro
+                self.ha_mais = True
+                self.dataset_split['next_url'] = self.proxima_url(plano,
+                    ultimo, posicao + lidos)
+                self.dataset_split['ha_mais'] = True
+                break
+            ultimo = obj
+            lidos += 1
+            yield obj
+    
+    def proxima_url(self, plano, ultimo, posicao):
+        '''
+        Retorna a url da pagina seguinte ao registro ultimo, que esta na
+        posicao informada.
+        '''
+        params = dict(self.request.params)
+        if self.offset:
+            # mantem a paginacao por offset para quem ja a utiliza
+            params['offset'] = "%d" % (self.offset + self.limite)
+        else:
+            params.pop('offset', None)
+            params['cursor'] = codifica_cursor(
+                plano.valores_cursor(ultimo), posicao,
+                self.request.params.get('ordem', None))
+        return self.request.route_url(self.rota,
+            metodo=self.slug,
+            formato=self.formato, _query=params)
+    
     def conneg(self):
         '''
         Realiza negociacao de conteudo HTTP e redireciona para o formato desejado.
@@ -701,41 +1269,42 @@ class APIMethod(Resource):
             return self.response
     
     def output(self):
-        # retorna o objeto
-        
+        '''
+        Retorna a resposta, cujo corpo e' gerado pelo agregador a medida que
+        e' enviado (no modo lote, tambem a medida que os registros sao
+        lidos). A sessao e' fechada quando o servidor termina (ou
+        interrompe) o envio.
+        '''
         if self.response is None:
             if self.result is None:
                 self.response = not_found(u"Recurso não encontrado.")
                 return self.response
-            else:
-                # serializa
-                ag = format_ag[self.formato](self.slug,
-                    atributo_serializar="__resumidos__",
-                    total_registros=self.total_registros,
-                    dataset_split=self.dataset_split,
-                    template=self.html_template,
-                    parameters=self.parameters,
-                    request=self.request)
-                #Chamada para o método na implementação do atributo_serializar
-                #ag = format_ag[self.formato](self.slug, atributo_serializar="__resumidos__")
-                for thing in self.result:
-                    ag.add(thing)
-                self.response = self.prepare_response(self.formato)
-                output = ag.serialize(format=self.formato)
-                if isinstance(output, str):
-                    output = output.decode('utf-8')
-                self.response.text = output
-            # fecha a sessao
-            self.session.close()
+            # se foram solicitados campos, eles sao escolhidos entre
+            # os atributos expostos; senao, serializa os resumidos
+            ag = format_ag[self.formato](self.slug,
+                atributo_serializar=("__resumidos__" if self.campos is None
+                    else "__expostos__"),
+                campos=self.campos,
+                total_registros=self.total_registros,
+                dataset_split=self.dataset_split,
+                template=self.html_template,
+                parameters=self.parameters,
+                request=self.request)
+            self.response = self.prepare_response(self.formato)
+            self.response.charset = 'utf-8'
+            self.response.app_iter = CorpoLote(
+                ag.serialize_iter(self.result, format=self.formato),
+                self.session.close)
         self.response = self.finalize_response()
         return self.response
     
     # metodos da classe para serem usados quando da exposicao da lista de
     # metodos da API
     @classmethod
-    def item_json(cls, atributo_serializar="__expostos__"):
+    def item_json(cls, atributo_serializar="__expostos__", campos=None):
         "Representacao em JSON do metodo da API"
-        return dict((atr, getattr(cls, atr)) for atr in getattr(cls,atributo_serializar))
+        return dict((atr, getattr(cls, atr)) for atr in getattr(cls,atributo_serializar)
+            if campos is None or atr in campos)
     # URI do documento que fala sobre a classe
     @classproperty
     @classmethod
@@ -748,6 +1317,184 @@ class APIMethod(Resource):
     def slug(cls):
         return cls.model_class.__slug_lista__
 
+class APIAgregacao(APIMethod):
+    """Representa a agregacao dos registros de um metodo da API.
+    
+    Aceita os mesmos filtros do metodo de consulta e agrupa os registros
+    pelas dimensoes informadas no parametro 'agrupar_por' (declaradas no
+    atributo __agrupamentos__ da classe do modelo), calculando no banco
+    de dados as medidas do parametro 'medidas': a contagem de registros e
+    a soma e a media das colunas numericas expostas.
+    
+    As agregacoes de cada metodo sao criadas por metodo_agregacao.
+    """
+    
+    rota = 'agregacao/metodo.formato'
+    parametros_nao_aceitos = ('cursor', 'ordem', 'campos')
+    dica_consulta_cara = u"Restrinja os filtros ou agrupe por menos dimensões."
+    # os grupos sao poucos: nao ha modo lote
+    formatos_lote = ()
+    
+    # template para a visualizacao em html
+    html_template = 'templates/agregacao.pt'
+    
+    # quantidade maxima de dimensoes no parametro 'agrupar_por'
+    max_dimensoes = 3
+    # medidas aceitas, calculadas por medidas_disponiveis na criacao
+    medidas_aceitas = [CONTAGEM]
+    
+    def read_parameters(self):
+        "Processa parametros de agregacao e de consulta"
+        self.agrupar_por = self.read_agrupar_por(
+            self.request.params.get('agrupar_por', u""))
+        self.medidas = self.read_medidas(
+            self.request.params.get('medidas', None))
+        super(APIAgregacao, self).read_parameters()
+    
+    def read_agrupar_por(self, valor):
+        "Processa o parametro 'agrupar_por', validando-o com as dimensoes declaradas"
+        agrupamentos = getattr(self.model_class, '__agrupamentos__', {})
+        dimensoes = []
+        for nome in valor.split(","):
+            nome = nome.strip()
+            if not nome or nome in dimensoes:
+                continue
+            if nome not in agrupamentos:
+                raise ValueError(u"Não é possível agrupar por '%s'. Os agrupamentos disponíveis são: %s." % \
+                    (nome, u", ".join(sorted(agrupamentos))))
+            dimensoes.append(nome)
+        if not dimensoes:
+            raise ValueError(u"Faltou especificar o parâmetro 'agrupar_por', que é obrigatório. Os agrupamentos disponíveis são: %s." % \
+                u", ".join(sorted(agrupamentos)))
+        if len(dimensoes) > self.max_dimensoes:
+            raise ValueError(u"O parâmetro 'agrupar_por' aceita até %d dimensões." % \
+                self.max_dimensoes)
+        return tuple(dimensoes)
+    
+    def read_medidas(self, valor):
+        """
+        Processa o parametro 'medidas'. Por padrao, calcula a contagem de
+        registros e a soma das colunas numericas.
+        """
+        if not valor:
+            return tuple(medida for medida in self.medidas_aceitas
+                if medida == CONTAGEM or medida.startswith('soma_'))
+        medidas = []
+        for nome in valor.split(","):
+            nome = nome.strip()
+            if not nome or nome in medidas:
+                continue
+            if nome not in self.medidas_aceitas:
+                raise ValueError(u"A medida especificada '%s' é desconhecida. As medidas disponíveis são: %s." % \
+                    (nome, u", ".join(self.medidas_aceitas)))
+            medidas.append(nome)
+        return tuple(medidas)
+    
+    def query(self):
+        # prepara a sessao
+        session = self.prepara_sessao()
+        
+        # plano de agregacao para os parametros, dimensoes e medidas
+        # informados, com os mesmos filtros do metodo de consulta
+        params = parametros_informados(self)
+        expressao = self.expressao
+        if expressao is not None:
+            expressao = forma(expressao)
+        plano = cache_planos.obtem_ou_monta(
+            (self.__class__, params, expressao, self.agrupar_por, self.medidas),
+            lambda: PlanoAgregacao(self, params, expressao,
+                self.agrupar_por, self.medidas))
+        valores = plano.valores(self.parameters, self.expressao)
+        
+        # grupos ordenados pelas dimensoes, paginados por offset
+        q = plano.consulta(session, valores)
+        if self.offset:
+            q = q.offset(self.offset)
+        # traz um grupo a mais para saber se ha proxima pagina
+        q = q.limit(self.limite + 1)
+        admite(session, q, custo.limites.custo_maximo(self.slug, self.formato))
+        linhas = q.all()
+        self.ha_mais = len(linhas) > self.limite
+        linhas = linhas[:self.limite]
+        self.session = session
+        
+        # o total de grupos so e' conhecido na ultima pagina
+        if self.ha_mais:
+            self.total_registros, self.contagem = None, 'nenhuma'
+        else:
+            self.total_registros = self.offset + len(linhas)
+            self.contagem = 'exata'
+        
+        # links para paginacao
+        prox_url = ""
+        if self.ha_mais:
+            params = dict(self.request.params)
+            params['offset'] = "%d" % (self.offset + self.limite)
+            prox_url = self.request.route_url(self.rota,
+                metodo=self.slug,
+                formato=self.formato, _query=params)
+        self.dataset_split = {
+            'dataset_url': self.url,
+            'current_url': self.url,
+            'current_offset': self.offset,
+            'split_size': self.limite,
+            'next_url': prox_url,
+            'contagem': self.contagem,
+            'ha_mais': self.ha_mais,
+        }
+        
+        metodo_uri = URI_BASE + "v%s/agregacao/%s" % (versao_api, self.slug)
+        self.result = [ResultadoAgregado(plano.nomes, linha, self.url,
+            metodo_uri) for linha in linhas]
+
+def metodo_agregacao(consulta):
+    '''
+    Cria a classe de agregacao de um metodo de consulta: herda os
+    parametros, a classe do modelo e a inicializacao da consulta.
+    '''
+    nome = consulta.__name__.replace("Consulta", "Agregacao", 1)
+    return type(nome, (APIAgregacao, consulta), {
+        'id': consulta.id.replace("consulta_", "agregacao_", 1),
+        'name': consulta.name.replace(u"Consulta", u"Agregação", 1),
+        'description': u"""Este método agrupa os registros do método
+    %s pelas dimensões informadas no parâmetro 'agrupar_por' e calcula as
+    medidas informadas no parâmetro 'medidas'.
+    """ % consulta.id,
+        'medidas_aceitas': medidas_disponiveis(consulta.model_class),
+    })
+
+def parametros_intervalo(model_class):
+    '''
+    Gera os parametros de intervalo das colunas de data e de valor expostas
+    pela classe: <coluna>_de (>=) e <coluna>_ate (<=). As comparacoes sao
+    feitas diretamente na coluna, podendo usar seus indices.
+    '''
+    expostos = getattr(model_class, '__expostos__', [])
+    parametros = {}
+    for prop in class_mapper(model_class).iterate_properties:
+        if not isinstance(prop, ColumnProperty) or prop.key not in expostos:
+            continue
+        tipo_coluna = prop.columns[0].type
+        if isinstance(tipo_coluna, (Date, DateTime)):
+            tipo = date
+            validador = lambda self, v: True
+        elif isinstance(tipo_coluna, Numeric):
+            tipo = Decimal
+            validador = lambda self, v: v.is_finite()
+        else:
+            continue
+        rotulo = HTMLAggregator.tidy_label(prop.key)
+        for sufixo, comparacao, limite in (("_de", ">=", u"a partir de"),
+                ("_ate", "<=", u"até")):
+            parametros[prop.key + sufixo] = {
+                "name": u"%s (%s)" % (rotulo, limite),
+                "type": tipo,
+                "validator": validador,
+                "comparison": comparacao,
+                "query_attribute": prop.key,
+            }
+    return parametros
+
 # views de consultas a API
 
 class ConsultaMunicipios(APIMethod):
@@ -1219,23 +1966,6 @@ class ConsultaProgramas(APIMethod):
             "type": unicode,
             "comparison": "=",
         },
-##        "data_publicacao_dou": {
-##            "name": u"Data de publicação no Diário Oficial da União",
-##            "type": date,
-##            "comparison": "=",
-##        },
-##        "data_publicacao_dou_min": {
-##            "name": u"Data mínima de publicação no Diário Oficial da União",
-##            "type": date,
-##            "comparison": ">=",
-##            "query_attribute": "data_publicacao_dou",
-##        },
-##            "data_publicacao_dou_max": {
-##            "name": u"Data máxima de publicação no Diário Oficial da União",
-##            "type": date,
-##            "comparison": "<=",
-##            "query_attribute": "data_publicacao_dou",
-##        },
         "id_orgao_superior": {
             "name": u"id do órgão superior associado ao programa",
             "type": int,
@@ -1344,22 +2074,6 @@ class ConsultaEmendas(APIMethod):
             "type": int,
             "comparison": "=",
         },
-##        "valor_min": {
-##            "name": u"valor mínimo da emenda",
-##            "type": Decimal,
-##            "comparison": ">=",
-##            "range": {
-##                "min": Decimal(0),
-##            },
-##        },
-##        "valor_max": {
-##            "name": u"valor mãximo da emenda",
-##            "type": Decimal,
-##            "comparison": "<=",
-##            "range": {
-##                "min": Decimal(0),
-##            },
-##        },
     }
     
     # importante: esta e' a classe principal a ser consultada
@@ -1384,25 +2098,9 @@ class ConsultaOrdensBancarias(APIMethod):
         },
         "numero": {
             "name": u"número da emenda",
-            "type": int,
+            "type": unicode,
             "comparison": "=",
         },
-##        "valor_min": {
-##            "name": u"valor mínimo da emenda",
-##            "type": Decimal,
-##            "comparison": ">=",
-##            "range": {
-##                "min": Decimal(0),
-##            },
-##        },
-##        "valor_max": {
-##            "name": u"valor mãximo da emenda",
-##            "type": Decimal,
-##            "comparison": "<=",
-##            "range": {
-##                "min": Decimal(0),
-##            },
-##        },
     }
     
     # importante: esta e' a classe principal a ser consultada
@@ -1573,8 +2271,24 @@ consultas = [
     ConsultaSubareasAtuacaoProponente,
     ConsultaHabilitacoesAreaAtuacao,
 ]
+
+for consulta in consultas:
+    # parametros de intervalo (_de e _ate) das colunas de data e valor
+    for param, declaracao in parametros_intervalo(consulta.model_class).items():
+        # os parametros declarados explicitamente tem precedencia
+        consulta.parameters.setdefault(param, declaracao)
+    # carregamento antecipado dos relacionamentos usados pelos resumidos
+    consulta.carregamento = plano_carregamento(consulta.model_class,
+        getattr(consulta.model_class, consulta.atributos_serializar),
+        consulta.preloaded_atrs, consulta.subquery_atrs)
+
 metodos_suportados = dict((cls.model_class.__slug_lista__, cls) for cls in consultas)
 
+# agregacoes dos metodos cujas classes declaram dimensoes de agrupamento
+agregacoes_suportadas = dict((cls.model_class.__slug_lista__,
+    metodo_agregacao(cls)) for cls in consultas
+    if getattr(cls.model_class, '__agrupamentos__', None))
+
 class Documentacao(Resource):
     @staticmethod
     def lista_metodos(request):
@@ -1655,6 +2369,13 @@ def consulta(request):
     else:
         return not_found(u"Método não suportado: %s" % slug)
 
+def agregacao(request):
+    slug = request.matchdict['metodo']
+    if slug in agregacoes_suportadas.keys():
+        return agregacoes_suportadas[slug](request).output()
+    else:
+        return not_found(u"Agregação não suportada: %s" % slug)
+
 # views para negociacao de conteudo e redirecionamento
 
 def conneg_api(request):
@@ -1686,6 +2407,17 @@ def conneg_api(request):
 
 # views que retornam dados sobre objetos unicos
 
+def detalhe_recursos(request):
+    '''
+    Retorna dados sobre varios recursos do mesmo tipo, pelos identificadores
+    informados no parametro 'ids', em um formato especifico.
+    '''
+    classe_slug = request.matchdict['classe']
+    if classe_slug in classes_suportadas.keys():
+        return LinkedDataCollection(classes_suportadas[classe_slug], request).output()
+    else:
+        return not_found(u"Método não suportado: %s" % classe_slug)
+
 def detalhe_recurso(request):
     '''
     Retorna dados sobre um recurso especifico em um formato especifico.
@@ -1709,12 +2441,17 @@ def view_relatorio(request):
     from csv import writer as csv_writer
     view_name = request.matchdict['dbview']
     
-    session = Session()
-    inspector = reflection.Inspector.from_engine(Base.metadata.bind)
-    view = Table(view_name, Base.metadata, autoload=True)
-    columns = [column['name'] for column in inspector.get_columns(view, None)]
-    results = [columns,]
-    results.extend(session.query(view).all())
+    session = SessionLeitura()
+    try:
+        bind = session.get_bind()
+        inspector = reflection.Inspector.from_engine(bind)
+        view = Table(view_name, Base.metadata, autoload=True,
+            autoload_with=bind)
+        columns = [column['name'] for column in inspector.get_columns(view, None)]
+        results = [columns,]
+        results.extend(session.query(view).all())
+    finally:
+        session.close()
     s = sio()
     w = csv_writer(s)
     w.writerows(results)